@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+from SmartCompress import byteSize
+from codec_library import Codec
+from benchmark_library import Benchmark, SYNTHETIC_HEADER, DEFAULT_CARDINALITIES, DEFAULT_ROW_COUNT, DEFAULT_SKEW, DEFAULT_SEED, \
+                              BENCHMARK_MODES, DEFAULT_REGRESSION_THRESHOLD
+
+#Function parses a cardinality, COLUMN=COUNT, the number of distinct values a generated column has
+def columnCardinality(cardinalityString):
+    columnName, equalsSign, countString = cardinalityString.partition('=')
+    if columnName not in DEFAULT_CARDINALITIES:
+        raise argparse.ArgumentTypeError("'" + columnName + "' is not one of the columns: " + str(sorted(DEFAULT_CARDINALITIES)))
+    try:
+        count = int(countString)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'" + countString + "' is not a number of distinct values")
+    if count < 1:
+        raise argparse.ArgumentTypeError('A column has to have at least 1 distinct value')
+    return (columnName, count)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog = 'SmartBenchmark', \
+                                     allow_abbrev = False, \
+                                     description = "Benchmark Smart Compress! Generates a synthetic CSV shaped like testInput.csv, \
+                                                    compresses and decompresses it, end to end, with every algorithm and version, \
+                                                    against the local store, so no Mongo Database is needed, and saves the results \
+                                                    as JSON, to compare against later runs")
+    parser.add_argument('-r', '--rows', \
+                        nargs = 1, \
+                        type = int, \
+                        required = False, \
+                        help = '[number of rows in the synthetic CSV, default is ' + str(DEFAULT_ROW_COUNT) + ']')
+    parser.add_argument('--cardinality', \
+                        nargs = '+', \
+                        type = columnCardinality, \
+                        metavar = 'COLUMN=COUNT', \
+                        required = False, \
+                        help = '[number of distinct values of a column, for any of ' + str(sorted(DEFAULT_CARDINALITIES)) + ', \
+                                the others keep their defaults, ' + str(DEFAULT_CARDINALITIES) + ']')
+    parser.add_argument('--skew', \
+                        nargs = 1, \
+                        type = float, \
+                        required = False, \
+                        help = '[exponent of the Zipf distribution the values of each column are drawn from, the k\'th most \
+                                common value is drawn in proportion to 1 / k^skew, 0 draws every value equally often, \
+                                default is ' + str(DEFAULT_SKEW) + ']')
+    parser.add_argument('--seed', \
+                        nargs = 1, \
+                        type = int, \
+                        required = False, \
+                        help = '[seed of the synthetic CSV, the same seed and settings always generate the same CSV, \
+                                default is ' + str(DEFAULT_SEED) + ']')
+    parser.add_argument('-f', '--fields', \
+                        nargs = '+', \
+                        type = str, \
+                        choices = SYNTHETIC_HEADER, \
+                        metavar = 'FIELD', \
+                        required = False, \
+                        help = "[columns the synthetic CSV is broken up on, default is 'OCCUPATION']")
+    parser.add_argument('-a', '--algorithms', \
+                        nargs = '+', \
+                        type = str, \
+                        choices = Codec.getCodecNames(), \
+                        required = False, \
+                        help = '[compression algorithms to benchmark, default is every one of ' + str(Codec.getCodecNames()) + ']')
+    parser.add_argument('--modes', \
+                        nargs = '+', \
+                        type = str, \
+                        choices = BENCHMARK_MODES, \
+                        required = False, \
+                        help = "[versions of compression to benchmark, 'default' loads the entire CSV into memory, 'memory' \
+                                is the memory sensitive version, -m, --memory, default is both]")
+    parser.add_argument('-m', '--memory', \
+                        nargs = 1, \
+                        type = byteSize, \
+                        metavar = 'BYTES', \
+                        required = False, \
+                        help = "[memory budget of the 'memory' version, a K, M or G suffix can be used, default is a quarter \
+                                of the synthetic CSV's size, at least 1M, so blocks are flushed before the CSV is read]")
+    parser.add_argument('--repeat', \
+                        nargs = 1, \
+                        type = int, \
+                        required = False, \
+                        help = '[number of times each algorithm and version is run, the fastest run of each stage is kept, \
+                                default is 1]')
+    parser.add_argument('-o', '--output', \
+                        nargs = 1, \
+                        type = str, \
+                        metavar = 'FILE-NAME', \
+                        required = False, \
+                        help = "[JSON file the results are written to, default is 'benchmarkResults.json']")
+    parser.add_argument('--compare', \
+                        nargs = 1, \
+                        type = str, \
+                        metavar = 'FILE-NAME', \
+                        required = False, \
+                        help = '[JSON results of an earlier run, every measurement that got worse by more than --threshold \
+                                is reported as a regression, and the program terminates with an error if there are any]')
+    parser.add_argument('--threshold', \
+                        nargs = 1, \
+                        type = float, \
+                        required = False, \
+                        help = '[with --compare, fractional change, for the worse, reported as a regression, default is ' + \
+                                str(DEFAULT_REGRESSION_THRESHOLD) + ']')
+    parser.add_argument('--work-dir', \
+                        nargs = 1, \
+                        type = str, \
+                        metavar = 'DIRECTORY', \
+                        required = False, \
+                        help = '[directory the synthetic CSV and local stores are written to, a temporary directory, removed \
+                                once the benchmark is done, is created inside it, default is the system temporary directory]')
+    #Using argparse as command line argument parser
+    args = parser.parse_args()
+
+    rowCount = args.rows[0] if args.rows is not None else DEFAULT_ROW_COUNT
+    if rowCount < 1:
+        sys.exit('Rows must be at least 1, program terminating')
+    cardinalities = dict(DEFAULT_CARDINALITIES)
+    if args.cardinality is not None:
+        cardinalities.update(args.cardinality)
+    skew = args.skew[0] if args.skew is not None else DEFAULT_SKEW
+    if skew < 0:
+        sys.exit('Skew cannot be negative, program terminating')
+    threshold = args.threshold[0] if args.threshold is not None else DEFAULT_REGRESSION_THRESHOLD
+    if threshold < 0:
+        sys.exit('Threshold cannot be negative, program terminating')
+    resultsFileName = args.output[0] if args.output is not None else 'benchmarkResults.json'
+
+    #Earlier results are read before anything is run, so a bad file does not waste a benchmark
+    previousResults = None
+    if args.compare is not None:
+        if not os.path.isfile(args.compare[0]):
+            sys.exit('Please enter a valid results file to compare against, program terminating')
+        try:
+            with open(args.compare[0]) as openFile:
+                previousResults = json.load(openFile)
+        except ValueError:
+            sys.exit("Results file '" + args.compare[0] + "' is not JSON, program terminating")
+    if args.work_dir is not None and not os.path.isdir(args.work_dir[0]):
+        sys.exit('Please enter a valid work directory, program terminating')
+
+    workDirectory = tempfile.mkdtemp(prefix = 'SmartBenchmark', dir = args.work_dir[0] if args.work_dir is not None else None)
+    try:
+        bench = Benchmark(workDirectory, rowCount, cardinalities, skew, args.seed[0] if args.seed is not None else DEFAULT_SEED, \
+                          args.fields if args.fields is not None else ['OCCUPATION'])
+        if args.memory is not None:
+            if args.memory[0] < 1:
+                sys.exit('Memory budget must be at least 1 byte, program terminating')
+            bench.memoryBudget = args.memory[0]
+        if args.repeat is not None:
+            if args.repeat[0] < 1:
+                sys.exit('Repeat must be at least 1, program terminating')
+            bench.repeatCount = args.repeat[0]
+
+        bench.generateInput()
+        for whichCompressionAlgToUse in (args.algorithms if args.algorithms is not None else Codec.getCodecNames()):
+            for mode in (args.modes if args.modes is not None else BENCHMARK_MODES):
+                bench.runCase(whichCompressionAlgToUse, mode)
+    finally:
+        shutil.rmtree(workDirectory, ignore_errors = True)
+
+    bench.writeResults(resultsFileName)
+    if previousResults is not None:
+        regressionCount = Benchmark.compareResults(bench.getResults(), previousResults, threshold)
+        if regressionCount > 0:
+            sys.exit(str(regressionCount) + ' measurements regressed by more than ' + str(threshold * 100) + '%, program terminating')
+        print('No measurement regressed by more than', str(threshold * 100) + '%')
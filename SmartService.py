@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+import sys
+import signal
+import argparse
+from SmartCompress import byteSize
+from mongo_library import Mongo
+from api_library import SmartCompressApi, SmartCompressError
+from service_library import SmartCompressService, UnixSocketService
+from cache_library import DEFAULT_CACHE_BYTES
+from metrics_library import runMetrics, DEFAULT_VERBOSITY
+
+#Default address the service listens on, only this machine can connect
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8642
+
+#Function stops the service on SIGTERM, the way Ctrl-C does, so the Pool is stopped and a Unix socket file is removed
+def stopService(signalNumber, frame):
+    raise KeyboardInterrupt
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog = 'SmartService', \
+                                     allow_abbrev = False, \
+                                     description = "Serve Smart Compress queries! Keeps a Pool of decompression processes and \
+                                                    connections to the Mongo Database warm, and answers queries over HTTP, \
+                                                    streaming the CSV back as it is decompressed. GET /extract?database=DB& \
+                                                    collection=COLLECTION&field=FIELD=VALUE&column=COLUMN&where=COLUMN<OPERATOR>VALUE& \
+                                                    aggregate=FUNCTION&aggregateColumn=COLUMN, list parameters are given once per \
+                                                    item, names are given without quotes. GET /metrics for Prometheus metrics, \
+                                                    GET /health to check the service is up")
+    parser.add_argument('--host', \
+                        nargs = 1, \
+                        type = str, \
+                        required = False, \
+                        help = '[address to listen on, default is ' + DEFAULT_HOST + ', only this machine can connect]')
+    parser.add_argument('--port', \
+                        nargs = 1, \
+                        type = int, \
+                        required = False, \
+                        help = '[port to listen on, default is ' + str(DEFAULT_PORT) + ']')
+    parser.add_argument('--unix-socket', \
+                        nargs = 1, \
+                        type = str, \
+                        metavar = 'FILE-NAME', \
+                        required = False, \
+                        help = '[listen on a Unix socket instead of a port, only processes on this machine that can open the \
+                                socket file can connect, for example curl --unix-socket FILE-NAME http://localhost/health]')
+    parser.add_argument('--connection', \
+                        nargs = 1, \
+                        type = str, \
+                        metavar = 'CONNECTION-STRING', \
+                        required = False, \
+                        help = "[connection string of the Mongo Database, without it, the SMART_COMPRESS_URI environment \
+                                variable is used, then the 'connection' option of the [mongo] section of --config, then \
+                                Mongo Database @ localhost, port 27017]")
+    parser.add_argument('--config', \
+                        nargs = 1, \
+                        type = str, \
+                        metavar = 'FILE-NAME', \
+                        required = False, \
+                        help = '[config file in INI format, holding the connection string as the \'connection\' option of a \
+                                [mongo] section]')
+    parser.add_argument('--store', \
+                        nargs = 1, \
+                        type = str, \
+                        choices = ['mongo', 'local'], \
+                        required = False, \
+                        help = "[where segments are stored, 'mongo' is a Mongo Database, 'local' is the local store under \
+                                --store-path, default is 'mongo']")
+    parser.add_argument('--store-path', \
+                        nargs = 1, \
+                        type = str, \
+                        metavar = 'DIRECTORY', \
+                        required = False, \
+                        help = "[with --store 'local', directory holding the local store, default is the current directory]")
+    parser.add_argument('--processes', \
+                        nargs = 1, \
+                        type = int, \
+                        required = False, \
+                        help = '[number of decompression processes kept warm, shared by every query, default is # of cores + 1]')
+    parser.add_argument('--cache', \
+                        nargs = 1, \
+                        type = str, \
+                        metavar = 'DIRECTORY', \
+                        required = False, \
+                        help = '[directory to cache decompressed blocks in, shared with SmartCompress.py --cache]')
+    parser.add_argument('--cache-size', \
+                        nargs = 1, \
+                        type = byteSize, \
+                        metavar = 'BYTES', \
+                        required = False, \
+                        help = '[with --cache, most bytes of decompressed blocks to keep in the cache directory, default is \
+                                1073741824 (1 GB)]')
+    parser.add_argument('--verbosity', \
+                        nargs = 1, \
+                        type = int, \
+                        choices = [0, 1, 2], \
+                        required = False, \
+                        help = '[0 prints what each query is doing, 1 adds a line for every request, 2 adds a line for every \
+                                segment decompressed. Default is 1]')
+    #Using argparse as command line argument parser
+    args = parser.parse_args()
+
+    if args.cache_size is not None:
+        if args.cache is None:
+            sys.exit('Cache size requires a cache directory, --cache, program terminating')
+        if args.cache_size[0] < 1:
+            sys.exit('Cache size must be at least 1 byte, program terminating')
+    if args.unix_socket is not None and (args.host is not None or args.port is not None):
+        sys.exit('Unix socket cannot be used with a host or port, program terminating')
+
+    connectionString = None
+    storePath = None
+    if args.store is not None and args.store[0] == 'local':
+        if args.connection is not None or args.config is not None:
+            sys.exit("Connection and config flags only apply to the Mongo Database store, --store 'mongo', program terminating")
+        storePath = args.store_path[0] if args.store_path is not None else '.'
+    else:
+        if args.store_path is not None:
+            sys.exit("Store path requires the local store, --store 'local', program terminating")
+        #The service has no one to ask, the default connection string is used if none is set
+        connectionString = Mongo.getConnectionString(args.connection[0] if args.connection is not None else None, \
+                                                     args.config[0] if args.config is not None else None)
+
+    verbosity = args.verbosity[0] if args.verbosity is not None else DEFAULT_VERBOSITY
+    #Pool is started before the server, so no request thread is running when the workers are forked
+    try:
+        api = SmartCompressApi(connectionString, storePath, args.processes[0] if args.processes is not None else None, \
+                               args.cache[0] if args.cache is not None else None, \
+                               args.cache_size[0] if args.cache_size is not None else DEFAULT_CACHE_BYTES, verbosity)
+    except SmartCompressError as error:
+        sys.exit(str(error) + ', program terminating')
+    runMetrics.startRun({'version': 'service'}, 0)
+    #Set once the Pool is started, its workers are stopped by the Pool, not by the signal
+    signal.signal(signal.SIGTERM, stopService)
+
+    try:
+        if args.unix_socket is not None:
+            server = UnixSocketService(args.unix_socket[0], api)
+            print("Serving Smart Compress queries on Unix socket '" + args.unix_socket[0] + "'")
+        else:
+            server = SmartCompressService((args.host[0] if args.host is not None else DEFAULT_HOST, \
+                                           args.port[0] if args.port is not None else DEFAULT_PORT), api)
+            print('Serving Smart Compress queries on http://' + server.server_address[0] + ':' + str(server.server_address[1]))
+    except (OSError, SmartCompressError) as error:
+        api.close()
+        sys.exit('Could not start the service: ' + str(error) + ', program terminating')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Service stopping')
+    finally:
+        server.server_close()
+        api.close()
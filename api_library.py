@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+import io
+import os
+import threading
+import multiprocessing
+from mongo_library import Mongo, DEFAULT_CONNECTION_STRING
+from storage_library import Storage, LocalStore, DEFAULT_CURSOR_BATCH_SIZE
+from decompression_library import Decompression
+from compression_library import Parallel, Table, DECOMPRESSION_WORKER_STAGES
+from cache_library import SegmentCache, DEFAULT_CACHE_BYTES
+from statistics_library import AGGREGATE_FUNCTIONS
+from metrics_library import runMetrics, DEFAULT_VERBOSITY
+
+#End of every message Smart Compress terminates with, left off the message of a SmartCompressError
+TERMINATING_SUFFIX = ', program terminating'
+
+class SmartCompressError(Exception):
+    #Raised by the library API wherever the command line program would terminate, with the same message
+    pass
+
+class SmartCompressApi:
+    #Smart Compress as a library, for running many queries from one long running process, such as the service
+    #A Pool of processCount workers, # of cores + 1 by default, is started once and kept warm, shared by every query
+    #Segments come from the Mongo Database at connectionString, or, when storePath is given, from the local store under it
+    #With cacheDirectory, decompressed blocks are cached there, kept within cacheBytes, and shared with the command line program
+    #Must be created before any threads are started, the Pool is forked from the process creating it
+    def __init__(self, connectionString = None, storePath = None, processCount = None, cacheDirectory = None, cacheBytes = DEFAULT_CACHE_BYTES, \
+                 verbosity = DEFAULT_VERBOSITY):
+        self.connectionString = None
+        self.storePath = storePath
+        self.cacheDirectory = cacheDirectory
+        self.cacheBytes = cacheBytes
+        self.processCount = processCount if processCount is not None else multiprocessing.cpu_count() + 1
+
+        #Storage object of every collection queried so far, keyed by database and collection name
+        self.stores = {}
+        self.storeLock = threading.Lock()
+
+        if storePath is not None:
+            if not os.path.isdir(storePath):
+                raise SmartCompressError('Please enter a valid store path')
+        else:
+            self.connectionString = connectionString if connectionString is not None else DEFAULT_CONNECTION_STRING
+            SmartCompressApi.runChecked(Mongo.checkForValidConnection, self.connectionString)
+        if cacheDirectory is not None and not os.path.isdir(cacheDirectory):
+            raise SmartCompressError('Please enter a valid cache directory')
+        if self.processCount < 1:
+            raise SmartCompressError('Processes must be at least 1')
+
+        runMetrics.verbosity = verbosity
+        runMetrics.setConcurrency(DECOMPRESSION_WORKER_STAGES, self.processCount)
+        #Workers start with no query settings, each task brings its query's settings with it
+        self.pool = multiprocessing.Pool(self.processCount, initializer = Parallel.initializeDecompressionWorker, initargs = ({}, verbosity))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exceptionValue, exceptionTraceback):
+        self.close()
+
+    #Function stops the Pool, once every query is done, segments of a query that stopped part way are not waited on
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    #Function runs a function of Smart Compress, turning it terminating, or a segment that cannot be decompressed, into a SmartCompressError
+    def runChecked(function, *arguments):
+        try:
+            return function(*arguments)
+        except SystemExit as error:
+            message = str(error)
+            raise SmartCompressError(message[:-len(TERMINATING_SUFFIX)] if message.endswith(TERMINATING_SUFFIX) else message) from None
+        except ValueError as error:
+            raise SmartCompressError(str(error)) from None
+
+    #Function wraps names in the 2 levels of quotes the command line program takes, so they are checked the same way
+    def quoteNames(names):
+        if any(name == '' for name in names):
+            raise SmartCompressError('Names cannot be empty')
+        return ['"' + name + '"' for name in names]
+
+    #Function returns the storage object of a collection, created on its first query and reused after
+    #A local store is read again once its file changes, so segments written by a compression run since are found
+    #Mongo Db objects share one client per process, so every collection queried uses the same pool of connections
+    def getStore(self, databaseName, collectionName):
+        databaseName, collectionName = Storage.checkValidDbAndConnectionName(*SmartCompressApi.quoteNames([databaseName, collectionName]))
+        storeKey = (databaseName, collectionName)
+
+        with self.storeLock:
+            if self.storePath is None:
+                if storeKey not in self.stores:
+                    self.stores[storeKey] = (SmartCompressApi.allowEmptyResult(Mongo(self.connectionString, databaseName, collectionName)), None)
+                return self.stores[storeKey][0]
+
+            LocalStore.checkValidCollectionFileName(collectionName)
+            storeObject = LocalStore(self.storePath, databaseName, collectionName)
+            try:
+                fileStat = os.stat(storeObject.fileName)
+                fileSignature = (fileStat.st_size, fileStat.st_mtime_ns)
+            except FileNotFoundError:
+                fileSignature = None
+            if storeKey not in self.stores or self.stores[storeKey][1] != fileSignature:
+                self.stores[storeKey] = (SmartCompressApi.allowEmptyResult(storeObject), fileSignature)
+            return self.stores[storeKey][0]
+
+    #Function makes a storage object return no segments for a query with no results, rather than terminate
+    #A query matching nothing is not an error, its CSV is just the header row
+    def allowEmptyResult(storeObject):
+        storeObject.exitOnEmptyResult = False
+        return storeObject
+
+    #Function readies a query, the same one the command line program runs with -v decompress, and sends it to the store
+    #fields are FIELD=VALUE or FIELD~PATTERN lookups, no fields matches every segment, columns, where and aggregateColumn
+    #are column names, where is COLUMN<OPERATOR>VALUE predicates, aggregate is any of count, sum, min, max, avg
+    #Names are given as they are, without the quotes the command line program takes
+    #Returns the Decompression object of the query, handed to streamExtraction, raises SmartCompressError if the query cannot run
+    def prepareExtraction(self, databaseName, collectionName, fields = None, columns = None, where = None, aggregate = None, \
+                          aggregateColumn = None, batchSize = DEFAULT_CURSOR_BATCH_SIZE):
+        return SmartCompressApi.runChecked(self.prepareDecompression, databaseName, collectionName, fields or [], columns, where, aggregate, \
+                                           aggregateColumn, batchSize)
+
+    #Function readies a query, as prepareExtraction, terminating where the command line program would
+    def prepareDecompression(self, databaseName, collectionName, fields, columns, where, aggregate, aggregateColumn, batchSize):
+        mongoObject = self.getStore(databaseName, collectionName)
+        if batchSize < 1:
+            raise SmartCompressError('Batch size must be at least 1')
+        decomp = Decompression(None, Table.checkValidFieldNames(SmartCompressApi.quoteNames(fields)), None)
+
+        #Lookup fields and header row of the collection, recorded when it was compressed
+        collectionMetadata = mongoObject.readCollectionMetadata()
+        #Collections written before the metadata was recorded still have segments, a collection with neither does not exist
+        if collectionMetadata is None and not mongoObject.hasSegments():
+            raise SmartCompressError("Collection '" + mongoObject.collectionName + "' does not exist in " + mongoObject.storeName + " '" + \
+                                     mongoObject.databaseName + "', or holds no segments")
+        decomp.applyCollectionMetadata(collectionMetadata)
+        if columns is not None:
+            decomp.applyColumnProjection(Table.checkValidFieldNames(SmartCompressApi.quoteNames(columns)))
+        if where is not None:
+            decomp.applyRowPredicates(Table.checkValidFieldNames(SmartCompressApi.quoteNames(where)))
+        if aggregate is not None:
+            if columns is not None:
+                raise SmartCompressError('Aggregate and columns cannot be used together')
+            if len(aggregate) == 0 or any(aggregateFunction not in AGGREGATE_FUNCTIONS for aggregateFunction in aggregate):
+                raise SmartCompressError('Aggregates must be any of: ' + str(AGGREGATE_FUNCTIONS))
+            decomp.applyAggregates(aggregate, Table.checkValidFieldNames(SmartCompressApi.quoteNames([aggregateColumn]))[0] \
+                                              if aggregateColumn is not None else None)
+        elif aggregateColumn is not None:
+            raise SmartCompressError('Aggregate column requires aggregates')
+        if self.cacheDirectory is not None and decomp.metadata is not None:
+            decomp.segmentCache = SegmentCache(self.cacheDirectory, self.cacheBytes, mongoObject.databaseName + '.' + mongoObject.collectionName)
+
+        #Only the fields of each block are fetched first, to find it in the cache, or to work out its aggregates from its statistics
+        if decomp.segmentCache is not None or (decomp.aggregateFunctions is not None and len(decomp.rowPredicates) == 0):
+            decomp.segments = decomp.retrieveListedSegments(mongoObject, batchSize)
+        else:
+            decomp.segments = mongoObject.retrieveSegmentsFromDatabase(decomp.columnsToReconstructOn, batchSize, decomp.metadata, \
+                                                                       decomp.getFetchColumns(), decomp.rowPredicates)
+        return decomp
+
+    #Function decompresses a prepared query on the warm Pool, writing the CSV, header row first, to an open binary stream, as it goes
+    #Any number of queries can stream at once, from different threads, each one's segments are written in order
+    def streamExtraction(self, decomp, outputStream):
+        SmartCompressApi.runChecked(decomp.decompressWithSharedPool, self.pool, outputStream)
+        #Cache is trimmed back to its size once the query is written
+        if decomp.segmentCache is not None:
+            decomp.segmentCache.evictSegments()
+
+    #Function runs a query, returns its CSV as bytes, takes the arguments of prepareExtraction
+    def extract(self, databaseName, collectionName, **queryArguments):
+        outputBuffer = io.BytesIO()
+        self.streamExtraction(self.prepareExtraction(databaseName, collectionName, **queryArguments), outputBuffer)
+        return outputBuffer.getvalue()
+
+    #Function runs a query, writes its CSV to a file, takes the arguments of prepareExtraction
+    def extractToFile(self, outputFileName, databaseName, collectionName, **queryArguments):
+        decomp = self.prepareExtraction(databaseName, collectionName, **queryArguments)
+        with open(outputFileName, 'wb') as openOutputFile:
+            self.streamExtraction(decomp, openOutputFile)
@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+import os
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import platform
+import itertools
+import subprocess
+import multiprocessing
+from datetime import datetime, timezone
+from metrics_library import Metrics
+
+#Header row of a generated CSV, the columns of testInput.csv, a Federal Election Commission individual contributions file
+SYNTHETIC_HEADER = ['CMTE_ID', 'AMNDT_IND', 'RPT_TP', 'TRANSACTION_PGI', 'IMAGE_NUM', 'TRANSACTION_TP', 'ENTITY_TP', 'NAME', 'CITY', \
+                    'STATE', 'ZIP_CODE', 'EMPLOYER', 'OCCUPATION', 'TRANSACTION_DT', 'TRANSACTION_AMT', 'OTHER_ID', 'TRAN_ID', \
+                    'FILE_NUM', 'MEMO_CD', 'MEMO_TEXT', 'SUB_ID']
+#Number of distinct values of the columns drawn from a set of values, the other columns are made up row by row
+DEFAULT_CARDINALITIES = {'CMTE_ID': 2000, 'NAME': 50000, 'CITY': 5000, 'STATE': 56, 'EMPLOYER': 10000, 'OCCUPATION': 1000}
+DEFAULT_ROW_COUNT = 100000
+#Exponent of the Zipf distribution the values of each column are drawn from, 0 draws every value equally often
+DEFAULT_SKEW = 1.1
+DEFAULT_SEED = 2016
+#Default is the whole CSV loaded into memory, memory is the memory sensitive version, -m, --memory
+BENCHMARK_MODES = ['default', 'memory']
+#Fraction of the generated CSV's size given as the memory budget of the memory sensitive version, when no budget is given
+DEFAULT_MEMORY_FRACTION = 4
+#Fractional change in a measurement, for the worse, that is reported as a regression
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+#Measurements compared between runs, and whether a larger value is better
+COMPARED_MEASUREMENTS = [('compress', 'rowsPerSecond', True), ('decompress', 'rowsPerSecond', True), (None, 'compressionRatio', True), \
+                         ('compress', 'peakRssBytes', False), ('decompress', 'peakRssBytes', False)]
+#Settings that have to match for two runs to be compared
+COMPARED_SETTINGS = ['rowCount', 'cardinalities', 'skew', 'seed', 'fields', 'memoryBudget']
+#Database and collection every case writes to, each case has its own local store directory
+BENCHMARK_DATABASE = 'Benchmark'
+#Number of lines at the end of a failed run's log that are printed, the work directory and the log with it are removed on exit
+FAILED_LOG_LINES = 20
+
+#Words the values of each column are built from, so values look like the text of the FEC data-set, not numbers
+LAST_NAMES = ['SMITH', 'JOHNSON', 'WILLIAMS', 'BROWN', 'JONES', 'GARCIA', 'MILLER', 'DAVIS', 'RODRIGUEZ', 'MARTINEZ', 'HERNANDEZ', \
+              'LOPEZ', 'GONZALEZ', 'WILSON', 'ANDERSON', 'THOMAS', 'TAYLOR', 'MOORE', 'JACKSON', 'MARTIN', 'LEE', 'PEREZ', 'THOMPSON', \
+              'WHITE', 'HARRIS', 'SANCHEZ', 'CLARK', 'RAMIREZ', 'LEWIS', 'ROBINSON', 'WALKER', 'YOUNG', 'ALLEN', 'KING', 'WRIGHT', \
+              'SCOTT', 'TORRES', 'NGUYEN', 'HILL', 'FLORES', 'GREEN', 'ADAMS', 'NELSON', 'BAKER', 'HALL', 'RIVERA', 'CAMPBELL', 'MITCHELL', \
+              'CARTER', 'ROBERTS', 'BURCH', 'KOUNTZ', 'DOSHI', 'NASTASE', 'SCHMIDT']
+FIRST_NAMES = ['MARY', 'DONALD', 'NIMISH', 'DAVID', 'GREGORY', 'JAMES', 'PATRICIA', 'JOHN', 'JENNIFER', 'ROBERT', 'LINDA', 'MICHAEL', \
+               'ELIZABETH', 'WILLIAM', 'BARBARA', 'RICHARD', 'SUSAN', 'JOSEPH', 'JESSICA', 'CHARLES', 'SARAH', 'THOMAS', 'KAREN']
+PLACE_WORDS = ['FALLS', 'CHURCH', 'SPRING', 'LAKE', 'RIVER', 'PORT', 'NEW', 'SAINT', 'MOUNT', 'FORT', 'GROVE', 'HILLS', 'PARK', 'VALLEY', \
+               'BEACH', 'CITY', 'HEIGHTS', 'CREEK', 'GLEN', 'OAK', 'CEDAR', 'MAPLE', 'UNION', 'FRANKLIN', 'CLINTON', 'SALEM']
+EMPLOYER_WORDS = ['NORTHROP', 'GRUMMAN', 'GENERAL', 'DYNAMICS', 'UNITED', 'AMERICAN', 'NATIONAL', 'SYSTEMS', 'HEALTH', 'ENERGY', \
+                  'FINANCIAL', 'SERVICES', 'GROUP', 'PARTNERS', 'HOLDINGS', 'CAPITAL', 'MEDICAL', 'UNIVERSITY', 'BANK', 'LAW']
+OCCUPATION_WORDS = ['VP', 'DIR', 'MANAGER', 'ENGINEER', 'ATTORNEY', 'PHYSICIAN', 'CONSULTANT', 'EXECUTIVE', 'ANALYST', 'PROGRAM', \
+                    'PROGRAMS', 'AND', 'CFO', 'CIO', 'GENERAL', 'SENIOR', 'SALES', 'OPERATIONS', 'RETIRED', 'OWNER', 'TEACHER']
+STATES = ['AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD', \
+          'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', \
+          'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY', 'PR', 'GU', 'VI', 'AS', 'MP']
+
+class Synthetic:
+    #Function returns the words of a value, the value's number written as digits in base len(words), at least minimumWords long
+    #so no two numbers have the same words
+    def getWords(valueNumber, words, minimumWords):
+        valueWords = []
+        while len(valueWords) < minimumWords or valueNumber > 0:
+            valueWords.append(words[valueNumber % len(words)])
+            valueNumber //= len(words)
+        return valueWords
+
+    #Function returns the text of the valueNumber'th distinct value of a column
+    def getColumnValue(columnName, valueNumber):
+        if columnName == 'CMTE_ID':
+            return 'C' + str(88591 + valueNumber * 7).zfill(8)
+        if columnName == 'NAME':
+            lastName = LAST_NAMES[valueNumber % len(LAST_NAMES)]
+            valueNumber //= len(LAST_NAMES)
+            firstName = FIRST_NAMES[valueNumber % len(FIRST_NAMES)]
+            valueNumber //= len(FIRST_NAMES)
+            initial = chr(ord('A') + valueNumber % 26)
+            return lastName + ', ' + firstName + ' ' + initial + '.' + (' ' + str(valueNumber // 26 + 1) if valueNumber >= 26 else '')
+        if columnName == 'CITY':
+            return ' '.join(Synthetic.getWords(valueNumber, PLACE_WORDS, 1))
+        if columnName == 'STATE':
+            return STATES[valueNumber] if valueNumber < len(STATES) else 'S' + str(valueNumber)
+        if columnName == 'EMPLOYER':
+            return ' '.join(Synthetic.getWords(valueNumber, EMPLOYER_WORDS, 2))
+        if columnName == 'OCCUPATION':
+            return ' '.join(Synthetic.getWords(valueNumber, OCCUPATION_WORDS, 1))
+        return columnName + ' ' + str(valueNumber)
+
+    #Function returns the cumulative Zipf weights of a column's values, the k'th value is drawn in proportion to 1 / k^skew
+    def getCumulativeWeights(cardinality, skew):
+        return list(itertools.accumulate(1.0 / (rank ** skew) for rank in range(1, cardinality + 1)))
+
+    #Function writes a CSV shaped like testInput.csv, the same seed and settings always write the same bytes
+    #Each row is one contributor's donation, the contributor's committee, city, state, employer and occupation are drawn
+    #from the distinct values of each column, the most common values most often, when skew is above 0
+    def generateCsv(fileName, rowCount, cardinalities, skew, seed):
+        randomGenerator = random.Random(seed)
+        columnValues = {}
+        cumulativeWeights = {}
+        for columnName in sorted(cardinalities):
+            columnValues[columnName] = [Synthetic.getColumnValue(columnName, valueNumber) for valueNumber in range(cardinalities[columnName])]
+            #Values are shuffled, so the most common value is not always the first one made
+            randomGenerator.shuffle(columnValues[columnName])
+            cumulativeWeights[columnName] = Synthetic.getCumulativeWeights(cardinalities[columnName], skew)
+
+        with open(fileName, 'w', newline = '') as openFile:
+            csvWriter = csv.writer(openFile, lineterminator = '\n')
+            csvWriter.writerow(SYNTHETIC_HEADER)
+
+            for rowNumber in range(rowCount):
+                row = {}
+                for columnName in sorted(cardinalities):
+                    row[columnName] = randomGenerator.choices(columnValues[columnName], cum_weights = cumulativeWeights[columnName])[0]
+                row['AMNDT_IND'] = randomGenerator.choice(['N', 'N', 'N', 'A', 'T'])
+                row['RPT_TP'] = randomGenerator.choice(['M3', 'Q1', 'Q2', 'YE', 'M10', '12G'])
+                row['TRANSACTION_PGI'] = randomGenerator.choice(['P', 'G', 'P'])
+                row['IMAGE_NUM'] = str(15970306895 + rowNumber * 13)
+                row['TRANSACTION_TP'] = randomGenerator.choice(['15', '15', '15', '15E', '22Y'])
+                row['ENTITY_TP'] = 'IND'
+                row['ZIP_CODE'] = str(randomGenerator.randrange(10000, 99999)) + str(randomGenerator.randrange(10000)).zfill(4)
+                row['TRANSACTION_DT'] = str(randomGenerator.randrange(1, 13)).zfill(2) + str(randomGenerator.randrange(1, 29)).zfill(2) + '2015'
+                #Most donations are small round amounts, a few are large
+                row['TRANSACTION_AMT'] = str(int(randomGenerator.paretovariate(1.2) * 25) // 5 * 5)
+                row['OTHER_ID'] = ''
+                row['TRAN_ID'] = '%020X' % randomGenerator.getrandbits(80)
+                row['FILE_NUM'] = str(998834 + rowNumber // 5000)
+                row['MEMO_CD'] = 'X' if randomGenerator.random() < 0.05 else ''
+                row['MEMO_TEXT'] = 'EARMARKED CONTRIBUTION' if row['MEMO_CD'] else ''
+                row['SUB_ID'] = str(4032020151240885624 + rowNumber)
+                csvWriter.writerow([row[columnName] for columnName in SYNTHETIC_HEADER])
+
+class Benchmark:
+    def __init__(self, workDirectory, rowCount, cardinalities, skew, seed, fieldsToBreakUpOn):
+        #Every case's child process runs in its own case directory, paths handed to it cannot be relative
+        self.workDirectory = os.path.abspath(workDirectory)
+        self.rowCount = rowCount
+        self.cardinalities = cardinalities
+        self.skew = skew
+        self.seed = seed
+        self.fieldsToBreakUpOn = fieldsToBreakUpOn
+
+        self.smartCompressPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SmartCompress.py')
+        self.csvFileName = os.path.join(self.workDirectory, 'synthetic.csv')
+        self.csvBytes = None
+        self.generateSeconds = None
+        #Memory budget of the memory sensitive version, a fraction of the CSV's size unless set
+        self.memoryBudget = None
+        #Number of times each case is run, the fastest run of each stage is kept
+        self.repeatCount = 1
+        self.cases = []
+
+    #Function writes the synthetic CSV every case compresses, and times it
+    def generateInput(self):
+        print('Generating synthetic CSV of', self.rowCount, 'rows, skew', str(self.skew) + ', seed', str(self.seed) + ':', self.csvFileName)
+        startTime = time.perf_counter()
+        Synthetic.generateCsv(self.csvFileName, self.rowCount, self.cardinalities, self.skew, self.seed)
+        self.generateSeconds = time.perf_counter() - startTime
+        self.csvBytes = os.path.getsize(self.csvFileName)
+        if self.memoryBudget is None:
+            self.memoryBudget = max(1024 * 1024, self.csvBytes // DEFAULT_MEMORY_FRACTION)
+
+    #Function runs Smart Compress in a child process, returning its wall time, CPU times, peak resident set size
+    #and the time, throughput and share of the run of every stage inside it, from the metrics it writes
+    #The child's own resource usage is read with wait4, it includes the Pool workers it waited on, and no other case
+    def runStage(self, arguments, caseDirectory, stageName):
+        metricsFileName = os.path.join(caseDirectory, stageName + 'Metrics.json')
+        with open(os.path.join(caseDirectory, stageName + '.log'), 'w') as logFile:
+            startTime = time.perf_counter()
+            process = subprocess.Popen([sys.executable, self.smartCompressPath] + arguments + ['--metrics', metricsFileName], cwd = caseDirectory, \
+                                       stdin = subprocess.DEVNULL, stdout = logFile, stderr = subprocess.STDOUT)
+            processId, exitStatus, resourceUsage = os.wait4(process.pid, 0)
+            wallSeconds = time.perf_counter() - startTime
+            #Popen has to be told the child is gone, or it waits on it again
+            process.returncode = os.waitstatus_to_exitcode(exitStatus)
+
+        if process.returncode != 0:
+            with open(os.path.join(caseDirectory, stageName + '.log'), errors = 'replace') as logFile:
+                logLines = logFile.readlines()[-FAILED_LOG_LINES:]
+            print('Last', len(logLines), 'lines of the', stageName, 'log of', os.path.basename(caseDirectory) + ':')
+            print(''.join(logLines), end = '')
+            sys.exit('Smart Compress failed on ' + stageName + ' of ' + os.path.basename(caseDirectory) + ', program terminating')
+        with open(metricsFileName) as openFile:
+            runReport = json.load(openFile)
+
+        #Linux reports the peak resident set size in kilobytes, macOS in bytes
+        peakRssBytes = resourceUsage.ru_maxrss if sys.platform == 'darwin' else resourceUsage.ru_maxrss * 1024
+        return {'seconds': wallSeconds, 'userSeconds': resourceUsage.ru_utime, 'systemSeconds': resourceUsage.ru_stime, \
+                'peakRssBytes': peakRssBytes, 'busiestStage': runReport['busiestStage'], \
+                'stages': {name: {fieldName: stage[fieldName] for fieldName in ['seconds', 'utilization', 'mbPerSecond', 'p95Seconds']} \
+                           for name, stage in runReport['stages'].items()}}
+
+    #Function returns the rows/s and MB/s of a stage, MB is 1024 * 1024 bytes
+    def addThroughput(self, stage, stageBytes):
+        stage['rowsPerSecond'] = self.rowCount / stage['seconds'] if stage['seconds'] > 0 else None
+        stage['mbPerSecond'] = stageBytes / (1024 * 1024) / stage['seconds'] if stage['seconds'] > 0 else None
+        return stage
+
+    #Function counts the rows of the decompressed output, after its header row, every row has to come back, in some order
+    def countOutputRows(self, outputFileName):
+        with open(outputFileName, newline = '') as openFile:
+            return sum(1 for row in csv.reader(openFile)) - 1
+
+    #Function compresses the synthetic CSV into a fresh local store with one codec and mode, then decompresses all of it
+    def runCase(self, whichCompressionAlgToUse, mode):
+        caseName = whichCompressionAlgToUse + '_' + mode
+        caseDirectory = os.path.join(self.workDirectory, caseName)
+        storePath = os.path.join(caseDirectory, 'store')
+        fieldArguments = ['"' + field + '"' for field in self.fieldsToBreakUpOn]
+        storeArguments = ['-d', '"' + BENCHMARK_DATABASE + '"', '-c', '"' + caseName + '"', '--store', 'local', '--store-path', storePath]
+
+        compressArguments = ['-v', 'compress', '-i', self.csvFileName, '-a', whichCompressionAlgToUse, '-f'] + fieldArguments + storeArguments
+        if mode == 'memory':
+            compressArguments += ['-m', str(self.memoryBudget)]
+        decompressArguments = ['-v', 'decompress', '-o', '"output.csv"', '-f'] + ['"' + field + '=*"' for field in self.fieldsToBreakUpOn] + \
+                              storeArguments
+
+        print("Benchmarking '" + whichCompressionAlgToUse + "' in", mode, 'mode')
+        compressStage, decompressStage = None, None
+        for repeatNumber in range(self.repeatCount):
+            #Every run starts from an empty store, a collection that already holds segments is not written to
+            shutil.rmtree(caseDirectory, ignore_errors = True)
+            os.makedirs(storePath)
+
+            stage = self.runStage(compressArguments, caseDirectory, 'compress')
+            if compressStage is None or stage['seconds'] < compressStage['seconds']:
+                compressStage = stage
+            stage = self.runStage(decompressArguments, caseDirectory, 'decompress')
+            if decompressStage is None or stage['seconds'] < decompressStage['seconds']:
+                decompressStage = stage
+
+        storeBytes = os.path.getsize(os.path.join(storePath, BENCHMARK_DATABASE, caseName + '.segments'))
+        outputFileName = os.path.join(caseDirectory, 'output.csv')
+        outputBytes = os.path.getsize(outputFileName)
+        outputRows = self.countOutputRows(outputFileName)
+        if outputRows != self.rowCount:
+            sys.exit("Decompressed " + str(outputRows) + " rows with '" + whichCompressionAlgToUse + "' in " + mode + \
+                     " mode, expected " + str(self.rowCount) + ", program terminating")
+
+        case = {'algorithm': whichCompressionAlgToUse, 'mode': mode, \
+                'compress': self.addThroughput(compressStage, self.csvBytes), \
+                'decompress': self.addThroughput(decompressStage, outputBytes), \
+                'storeBytes': storeBytes, 'outputBytes': outputBytes, 'compressionRatio': self.csvBytes / storeBytes}
+        self.cases.append(case)
+        Benchmark.printCase(case)
+        #Segments of one case are not needed by the next
+        shutil.rmtree(caseDirectory, ignore_errors = True)
+
+    #Function prints one line per stage of a finished case
+    def printCase(case):
+        for stageName in ['compress', 'decompress']:
+            stage = case[stageName]
+            print('  %-10s %8.2f s %12.0f rows/s %8.2f MB/s %8.2f MB peak RSS %8.2f s user %8.2f s system' % \
+                  (stageName, stage['seconds'], stage['rowsPerSecond'] or 0, stage['mbPerSecond'] or 0, \
+                   stage['peakRssBytes'] / (1024 * 1024), stage['userSeconds'], stage['systemSeconds']))
+            print('  ' + ' ' * 10 + ' ' + ', '.join('%s %.2f s %.0f%% busy' % (name, stage['stages'][name]['seconds'], stage['stages'][name]['utilization'] * 100) \
+                                                for name in Metrics.getStageNames(stage['stages'])) + \
+                  ", bounded by '" + str(stage['busiestStage']) + "'")
+        print('  compression ratio %.2f, %d bytes stored' % (case['compressionRatio'], case['storeBytes']))
+
+    #Function returns the results of every case, with the settings and machine they were measured with
+    def getResults(self):
+        return {'created': datetime.now(timezone.utc).isoformat(), \
+                'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpuCount': multiprocessing.cpu_count()}, \
+                'settings': {'rowCount': self.rowCount, 'cardinalities': self.cardinalities, 'skew': self.skew, 'seed': self.seed, \
+                             'fields': self.fieldsToBreakUpOn, 'memoryBudget': self.memoryBudget, 'repeatCount': self.repeatCount, \
+                             'csvBytes': self.csvBytes, 'generateSeconds': self.generateSeconds}, \
+                'cases': self.cases}
+
+    #Function writes the results to a JSON file, so later runs can be compared against them
+    def writeResults(self, resultsFileName):
+        with open(resultsFileName, 'w') as openFile:
+            json.dump(self.getResults(), openFile, indent = 2, sort_keys = True)
+        print('Benchmark results written to:', resultsFileName)
+
+    #Function compares the results against those of an earlier run, printing every measurement that got worse by more
+    #than the threshold, as a fraction, and returns the number of regressions
+    def compareResults(results, previousResults, threshold):
+        for settingName in COMPARED_SETTINGS:
+            if results['settings'].get(settingName) != previousResults['settings'].get(settingName):
+                print("Warning: setting '" + settingName + "' differs from the earlier run,", previousResults['settings'].get(settingName), \
+                      '->', results['settings'].get(settingName))
+        if results['machine'] != previousResults['machine']:
+            print('Warning: the earlier run was measured on a different machine or Python version')
+
+        previousCases = {(case['algorithm'], case['mode']): case for case in previousResults['cases']}
+        regressionCount = 0
+        for case in results['cases']:
+            previousCase = previousCases.get((case['algorithm'], case['mode']))
+            if previousCase is None:
+                print("No earlier result for '" + case['algorithm'] + "' in", case['mode'], 'mode')
+                continue
+
+            for stageName, measurementName, largerIsBetter in COMPARED_MEASUREMENTS:
+                value = case[stageName][measurementName] if stageName is not None else case[measurementName]
+                previousValue = previousCase[stageName][measurementName] if stageName is not None else previousCase[measurementName]
+                if not value or not previousValue:
+                    continue
+                change = value / previousValue - 1
+                regressed = (change < -threshold) if largerIsBetter else (change > threshold)
+                regressionCount += regressed
+                print('%-11s %-8s %-10s %-16s %14.2f -> %14.2f %+7.1f%%%s' % \
+                      (case['algorithm'], case['mode'], stageName or '', measurementName, previousValue, value, change * 100, \
+                       '  REGRESSION' if regressed else ''))
+
+        return regressionCount
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+import os
+import hashlib
+import tempfile
+
+#Default total size of the decompressed blocks kept in a cache directory
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+#Extension of a cached block, the decompressed CSV rows of the block, every column, no header row
+CACHE_FILE_EXTENSION = '.csv'
+
+class SegmentCache:
+    #Cache of decompressed blocks in a directory on local disk, shared by every run that uses the directory
+    #namespace is the database and collection the blocks are from, so collections with the same '_id's never share a block
+    def __init__(self, cacheDirectory, maxBytes, namespace):
+        self.cacheDirectory = cacheDirectory
+        self.maxBytes = maxBytes
+        self.namespace = namespace
+
+        self.hits = 0
+        self.misses = 0
+
+    #Function returns the cache key of a block, a hash of the collection, the block's '_id' and the hash of its rows
+    #Segment documents are never changed once written, a block that is merged or refreshed is written with a new '_id',
+    #so a key never goes stale, a block that is gone is simply never asked for again, and is evicted
+    def getKey(self, segment):
+        keyText = self.namespace + '\0' + str(segment['_id']) + '\0' + str(segment.get('blockHash'))
+        return hashlib.sha256(keyText.encode("utf-8")).hexdigest()
+
+    #Function returns the file a block is cached in
+    def getPath(self, key):
+        return os.path.join(self.cacheDirectory, key + CACHE_FILE_EXTENSION)
+
+    #Function returns True if a block is in the cache, and marks it as just used, so it is the last to be evicted
+    def touchSegment(self, key):
+        try:
+            os.utime(self.getPath(key))
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    #Function returns the decompressed rows of a cached block, None if it was evicted
+    def readSegment(self, key):
+        try:
+            with open(self.getPath(key), 'rb') as openFile:
+                return openFile.read()
+        except FileNotFoundError:
+            return None
+
+    #Function writes the decompressed rows of a block to the cache, through a temporary file, so no one reads part of a block
+    def writeSegment(self, key, csvBytes):
+        fileDescriptor, temporaryFileName = tempfile.mkstemp(dir = self.cacheDirectory, suffix = '.tmp')
+        with os.fdopen(fileDescriptor, 'wb') as openFile:
+            openFile.write(csvBytes)
+        os.replace(temporaryFileName, self.getPath(key))
+
+    #Function evicts the least recently used blocks until the cache is within its size, once the output file is written
+    #Another run using the directory may evict the same blocks at the same time, a block already gone is skipped
+    def evictSegments(self):
+        cachedFiles = []
+        for entry in os.scandir(self.cacheDirectory):
+            if entry.name.endswith(CACHE_FILE_EXTENSION) and entry.is_file():
+                fileStat = entry.stat()
+                cachedFiles.append((fileStat.st_mtime_ns, fileStat.st_size, entry.path))
+
+        cacheBytes = sum(fileSize for modifiedTime, fileSize, fileName in cachedFiles)
+        evictedCount = 0
+        for modifiedTime, fileSize, fileName in sorted(cachedFiles):
+            if cacheBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(fileName)
+            except FileNotFoundError:
+                pass
+            cacheBytes -= fileSize
+            evictedCount += 1
+
+        print('Segment cache:', self.hits, 'blocks read from the cache,', self.misses, 'fetched and decompressed,', evictedCount, 'evicted,', \
+              cacheBytes, 'bytes cached')
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+import sys
+import bz2
+import gzip
+import lzma
+import zlib
+import time
+import hashlib
+from collections import Counter
+
+#Number of bytes of the CSV, after the header row, compressed with every codec to pick one in 'auto' mode
+AUTO_SAMPLE_BYTES = 8 * 1024 * 1024
+#Size of a trained dictionary, zlib only looks back this far, so anything more is never used
+DICTIONARY_SIZE = 32 * 1024
+
+class Codec:
+    #Registered codecs, name is the key, value is the compress function, decompress function, valid levels, default level
+    #and whether the codec can use a preset dictionary
+    #Codec name and level are stored in every segment document, so decompression does not need to be told the codec
+    codecs = {}
+
+    #Function adds a codec to the registry, compressFunction takes the bytes, a level and a dictionary
+    #decompressFunction takes the bytes and a dictionary, the dictionary is None unless the codec supports dictionaries
+    def registerCodec(name, compressFunction, decompressFunction, levels, defaultLevel, supportsDictionary):
+        Codec.codecs[name] = (compressFunction, decompressFunction, levels, defaultLevel, supportsDictionary)
+
+    #Function returns the names of every registered codec, only those that can use a preset dictionary, if asked
+    def getCodecNames(dictionaryOnly = False):
+        return [name for name in Codec.codecs if Codec.codecs[name][4] or not dictionaryOnly]
+
+    #Function returns the level to compress with, the codec's default when None, terminates if the codec does not have it
+    def getLevel(name, level):
+        levels, defaultLevel = Codec.codecs[name][2:4]
+        if level is None:
+            return defaultLevel
+        if level not in levels:
+            sys.exit("Level " + str(level) + " is not valid for the '" + name + "' algorithm, valid levels are " + str(levels[0]) + \
+                     ' to ' + str(levels[-1]) + ', program terminating')
+        return level
+
+    #Function compresses bytes with a codec, at a level, with a preset dictionary if one is given
+    def compress(dataToCompress, name, level, dictionary = None):
+        return Codec.codecs[name][0](dataToCompress, level, dictionary)
+
+    #Function decompresses bytes with a codec, a codec that is not registered raises ValueError
+    def decompress(dataToDecompress, name, dictionary = None):
+        if name not in Codec.codecs:
+            raise ValueError("Segment was compressed with algorithm '" + str(name) + "', which is not one of " + str(Codec.getCodecNames()))
+        return Codec.codecs[name][1](dataToDecompress, dictionary)
+
+    #Function builds a preset dictionary from sample rows, the field values that would save the most bytes, repeated in many rows
+    #Values saving the most are put last, closest to the data, where zlib finds them with the shortest distances
+    #Returns the dictionary and its id, a hash of its contents, stored with every segment compressed with it
+    def trainDictionary(sampleRows):
+        valueCounts = Counter(value + ',' for row in sampleRows for value in row if value != '')
+        #A value seen once in the sample is not worth space in the dictionary
+        frequentValues = [value for value, count in valueCounts.items() if count > 1]
+        frequentValues.sort(key = lambda value: valueCounts[value] * len(value))
+
+        dictionary = ''.join(frequentValues).encode("utf-8")[-DICTIONARY_SIZE:]
+        return dictionary, hashlib.sha256(dictionary).hexdigest()[:16]
+
+    #Function compresses with zlib, using a preset dictionary if one is given
+    def compressZlib(dataToCompress, level, dictionary):
+        if dictionary is None:
+            return zlib.compress(dataToCompress, level)
+        compressor = zlib.compressobj(level, zdict = dictionary)
+        return compressor.compress(dataToCompress) + compressor.flush()
+
+    #Function decompresses with zlib, using the preset dictionary the data was compressed with, if there was one
+    def decompressZlib(dataToDecompress, dictionary):
+        if dictionary is None:
+            return zlib.decompress(dataToDecompress)
+        decompressor = zlib.decompressobj(zdict = dictionary)
+        return decompressor.decompress(dataToDecompress) + decompressor.flush()
+
+    #Function compresses sample blocks with every codec, at its default level, returns the codec to use for the data set
+    #codecNames are the codecs to choose from
+    def chooseCodec(sampleBlocks, targetThroughput, codecNames):
+        return Codec.pickCodec(Codec.measureCodecs(sampleBlocks, codecNames), targetThroughput)
+
+    #Function compresses sample blocks with every codec, at its default level
+    #Returns each codec's name, compression ratio and bytes compressed per CPU second
+    def measureCodecs(sampleBlocks, codecNames):
+        uncompressedBytes = sum(len(sampleBlock) for sampleBlock in sampleBlocks)
+        results = []
+
+        for name in codecNames:
+            level = Codec.getLevel(name, None)
+            compressedBytes = 0
+            startTime = time.process_time()
+            for sampleBlock in sampleBlocks:
+                compressedBytes += len(Codec.compress(sampleBlock, name, level))
+            #Timer resolution is not fine enough for tiny samples, a floor keeps the throughput finite
+            cpuSeconds = max(time.process_time() - startTime, 1e-6)
+
+            compressionRatio = uncompressedBytes / max(compressedBytes, 1)
+            throughput = uncompressedBytes / cpuSeconds
+            print("Sampled '" + name + "' algorithm: ratio " + str(round(compressionRatio, 2)) + ', ' + \
+                  str(round(throughput / (1024 * 1024), 1)) + ' MB per CPU second')
+            results.append((name, compressionRatio, throughput))
+
+        return results
+
+    #Function picks a codec from the results of measureCodecs
+    #Picks the best compression ratio among codecs compressing at least targetThroughput bytes per CPU second
+    #With no target, or when no codec meets it, picks the best compression ratio per CPU second
+    def pickCodec(results, targetThroughput):
+        if targetThroughput is not None:
+            fastEnough = [result for result in results if result[2] >= targetThroughput]
+            if len(fastEnough) != 0:
+                return max(fastEnough, key = lambda result: result[1])[0]
+            print('No algorithm met the target throughput, picking the best ratio per CPU second')
+
+        return max(results, key = lambda result: result[1] * result[2])[0]
+
+Codec.registerCodec('gzip', lambda data, level, dictionary: gzip.compress(data, compresslevel = level), \
+                     lambda data, dictionary: gzip.decompress(data), range(0, 10), 9, False)
+Codec.registerCodec('bzip2', lambda data, level, dictionary: bz2.compress(data, compresslevel = level), \
+                     lambda data, dictionary: bz2.decompress(data), range(1, 10), 9, False)
+Codec.registerCodec('xz', lambda data, level, dictionary: lzma.compress(data, preset = level), \
+                     lambda data, dictionary: lzma.decompress(data), range(0, 10), 6, False)
+Codec.registerCodec('zlib', Codec.compressZlib, Codec.decompressZlib, range(0, 10), 6, True)
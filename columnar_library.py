@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+import io
+import sys
+import csv
+import struct
+from array import array
+from statistics_library import Statistics
+
+#Encodings a column stream can be stored in, the first byte of every stream
+#Plain stores every value, dictionary stores each distinct value once and a code per row, RLE stores a code per run of equal values
+PLAIN_ENCODING = 0
+DICTIONARY_ENCODING = 1
+RLE_ENCODING = 2
+#A column is dictionary encoded when it has at most this many distinct values per row
+DICTIONARY_MAX_DISTINCT_RATIO = 0.5
+#A dictionary encoded column is run length encoded when it has at most this many runs per row
+RLE_MAX_RUN_RATIO = 0.25
+
+class Columnar:
+    #Function turns the rows of a block into one encoded stream per column, leaving out the tag columns
+    #Tag columns hold the same value in every row, it is already stored in the document, so it is put back on decode
+    #Returns the streams, keyed by column position, and the row lengths stream, None when every row is as long as the longest
+    def encodeBlock(rows, tagPositions):
+        columnCount = max(len(row) for row in rows)
+        columnStreams = {}
+
+        for columnPosition in range(columnCount):
+            if columnPosition in tagPositions:
+                continue
+            #Short rows are padded with empty values, their real length is stored in the row lengths stream
+            columnValues = [row[columnPosition] if columnPosition < len(row) else '' for row in rows]
+            columnStreams[columnPosition] = Columnar.encodeColumn(columnValues)
+
+        rowLengths = None
+        if any(len(row) != columnCount for row in rows):
+            rowLengths = Columnar.encodeColumn([str(len(row)) for row in rows])
+
+        return columnStreams, rowLengths, columnCount
+
+    #Function encodes the values of one column, picking the smallest of plain, dictionary and run length encoding
+    def encodeColumn(columnValues):
+        dictionary = {}
+        codes = []
+
+        #Codes are given out in order of first appearance
+        for value in columnValues:
+            code = dictionary.get(value)
+            if code is None:
+                code = len(dictionary)
+                dictionary[value] = code
+            codes.append(code)
+            #Too many distinct values for a dictionary to pay off, no need to keep building it
+            if len(dictionary) > len(columnValues) * DICTIONARY_MAX_DISTINCT_RATIO and len(dictionary) > 1:
+                return bytes([PLAIN_ENCODING]) + Columnar.packStrings(columnValues)
+
+        dictionaryBytes = Columnar.packStrings(list(dictionary))
+        runCodes = []
+        runLengths = []
+        for code in codes:
+            if len(runCodes) != 0 and runCodes[-1] == code:
+                runLengths[-1] += 1
+            else:
+                runCodes.append(code)
+                runLengths.append(1)
+
+        if len(runCodes) <= len(codes) * RLE_MAX_RUN_RATIO:
+            return bytes([RLE_ENCODING]) + dictionaryBytes + Columnar.packIntegers(runCodes) + Columnar.packIntegers(runLengths)
+        return bytes([DICTIONARY_ENCODING]) + dictionaryBytes + Columnar.packIntegers(codes)
+
+    #Function decodes one column stream back into its list of values
+    def decodeColumn(columnStream):
+        encoding = columnStream[0]
+        strings, position = Columnar.unpackStrings(columnStream, 1)
+
+        if encoding == PLAIN_ENCODING:
+            return strings
+        if encoding == DICTIONARY_ENCODING:
+            codes, position = Columnar.unpackIntegers(columnStream, position)
+            return [strings[code] for code in codes]
+
+        runCodes, position = Columnar.unpackIntegers(columnStream, position)
+        runLengths, position = Columnar.unpackIntegers(columnStream, position)
+        columnValues = []
+        for code, runLength in zip(runCodes, runLengths):
+            columnValues.extend([strings[code]] * runLength)
+        return columnValues
+
+    #Function puts decoded columns back together into rows, written out as CSV bytes
+    #columnValues is keyed by column position, tagValues holds the value of each tag column, by position
+    #columnPositions are the columns to write, in order, a column the block does not have is written as empty values
+    #Only rows matching every one of rowPredicates are written
+    def decodeBlock(columnValues, tagValues, rowCount, columnPositions, rowLengths, lineTerminator, rowPredicates):
+        outputBuffer = io.StringIO()
+        writer = csv.writer(outputBuffer, delimiter = ',', lineterminator = lineTerminator)
+
+        columns = [Columnar.getColumnValues(columnValues, tagValues, rowCount, columnPosition) for columnPosition in columnPositions]
+        rows = zip(*columns) if len(columns) != 0 else ([] for rowNumber in range(rowCount))
+        #Rows shorter than the longest row were padded, cutting them back to their real length
+        if rowLengths is not None:
+            rows = (row[:int(rowLength)] for row, rowLength in zip(rows, rowLengths))
+
+        #Predicates are checked on their own columns, which do not have to be written out
+        if len(rowPredicates) != 0:
+            predicateColumns = [Columnar.getColumnValues(columnValues, tagValues, rowCount, rowPredicate[0]) for rowPredicate in rowPredicates]
+            predicateValues = zip(*predicateColumns)
+            rows = (row for row, values in zip(rows, predicateValues) \
+                    if all(Statistics.valueMatches(value, *rowPredicate[1:]) for value, rowPredicate in zip(values, rowPredicates)))
+        writer.writerows(rows)
+
+        return outputBuffer.getvalue().encode("utf-8")
+
+    #Function returns every value of one column of a block, a tag column repeats its value, a column the block does not have is empty
+    def getColumnValues(columnValues, tagValues, rowCount, columnPosition):
+        if columnPosition in tagValues:
+            return [tagValues[columnPosition]] * rowCount
+        elif columnPosition in columnValues:
+            return columnValues[columnPosition]
+        return [''] * rowCount
+
+    #Function keeps only the rows of CSV bytes matching every one of rowPredicates, and only the given columns of them, in order
+    #None keeps every column, values missing from a short row are written as empty
+    def projectCsvBytes(csvBytes, columnPositions, lineTerminator, rowPredicates):
+        outputBuffer = io.StringIO()
+        writer = csv.writer(outputBuffer, delimiter = ',', lineterminator = lineTerminator)
+
+        for row in csv.reader(io.StringIO(csvBytes.decode("utf-8"), newline = ''), delimiter = ','):
+            if not Statistics.rowMatches(row, rowPredicates):
+                continue
+            if columnPositions is not None:
+                row = [row[columnPosition] if columnPosition < len(row) else '' for columnPosition in columnPositions]
+            writer.writerow(row)
+
+        return outputBuffer.getvalue().encode("utf-8")
+
+    #Function packs a list of strings as a count, the UTF-8 length of each string, then the strings themselves
+    def packStrings(strings):
+        encodedStrings = [string.encode("utf-8") for string in strings]
+        return struct.pack('<I', len(encodedStrings)) + Columnar.packIntegers([len(encodedString) for encodedString in encodedStrings]) + \
+               b''.join(encodedStrings)
+
+    #Function unpacks a list of strings packed by packStrings, starting at position, returns them and the position after them
+    def unpackStrings(stream, position):
+        stringCount = struct.unpack_from('<I', stream, position)[0]
+        lengths, position = Columnar.unpackIntegers(stream, position + 4)
+        strings = []
+
+        for length in lengths[:stringCount]:
+            strings.append(bytes(stream[position:position + length]).decode("utf-8"))
+            position += length
+
+        return strings, position
+
+    #Function packs a list of non negative integers as a count, the width of each integer, then the integers, little endian
+    #Each list uses the narrowest of 1, 2 or 4 byte integers its largest value fits in
+    def packIntegers(integers):
+        largestInteger = max(integers, default = 0)
+        typeCode = 'B' if largestInteger < 2 ** 8 else 'H' if largestInteger < 2 ** 16 else 'I'
+        integerArray = array(typeCode, integers)
+        if sys.byteorder == 'big':
+            integerArray.byteswap()
+
+        return struct.pack('<IB', len(integerArray), integerArray.itemsize) + integerArray.tobytes()
+
+    #Function unpacks a list of integers packed by packIntegers, starting at position, returns them and the position after them
+    def unpackIntegers(stream, position):
+        integerCount, itemSize = struct.unpack_from('<IB', stream, position)
+        position += 5
+        integerArray = array({1: 'B', 2: 'H', 4: 'I'}[itemSize])
+        integerArray.frombytes(bytes(stream[position:position + integerCount * itemSize]))
+        if sys.byteorder == 'big':
+            integerArray.byteswap()
+
+        return integerArray.tolist(), position + integerCount * itemSize
@@ -1,12 +1,63 @@
 #!/usr/bin/python3
-import gc
+import io
+import os
+import ast
 import sys
+import mmap
+import hashlib
+import tempfile
 import csv
-import bz2
-import gzip
-import lzma
 import zlib
+import time
 import multiprocessing 
+from storage_library import Storage
+from columnar_library import Columnar
+from codec_library import Codec, AUTO_SAMPLE_BYTES
+from statistics_library import Statistics
+from pipeline_library import InFlightWindow, WriteStage
+from metrics_library import runMetrics, InstrumentedTask, SEGMENT_VERBOSITY
+
+#Version of the segment payload written into each Mongo Db document
+#Version 1 (no 'formatVersion' field) stored the Python repr of a list of rows
+#Version 2 stores the original CSV row bytes, the header row is stored alongside in 'headerRow'
+SEGMENT_FORMAT_VERSION = 2
+#Version 3 is the columnar layout, each column is encoded and compressed on its own, under 'columns', tag columns are left out
+COLUMNAR_FORMAT_VERSION = 3
+
+#Default target uncompressed size of a block, segments larger than this are split into independently compressed blocks
+#Keeps a large segment spread across the Pool, and each compressed block well under Mongo Db's 16 MB document limit
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+#Memory held by a buffered row on top of its text, the str object header and the pointer to it in its block's list
+ROW_OVERHEAD_BYTES = 57
+#Share of the memory budget held back for blocks handed to the Pool but not yet written to Mongo Db
+MEMORY_IN_FLIGHT_SHARE = 0.25
+#Once buffered rows go over their share of the memory budget, the largest segments are flushed until rows fit in this much of it
+MEMORY_LOW_WATER_MARK = 0.75
+
+#Parallel ingest splits the CSV into byte ranges of about this size, or one range per Pool process if that gives more ranges
+DEFAULT_RANGE_SIZE = 128 * 1024 * 1024
+#Smallest byte range worth handing to its own Pool process
+MIN_RANGE_SIZE = 1024 * 1024
+#Blocks of each byte range are numbered from (range number << RANGE_BLOCK_NUMBER_BITS), so they sort after the ranges before it
+RANGE_BLOCK_NUMBER_BITS = 32
+#Blocks written by each append run are numbered from (run number << APPEND_BLOCK_NUMBER_BITS), so they sort after every earlier run's blocks
+APPEND_BLOCK_NUMBER_BITS = 48
+
+#Spilled partitions are sized so that one per Pool process, each taking about this many times its size in memory, fit in the memory budget
+SPILL_PARTITION_MEMORY_FACTOR = 2
+
+#Default number of threads writing compressed batches to the store, and of batches each one can have waiting for it
+#Writes wait on the store, not on a core, so the threads run alongside the Pool
+DEFAULT_WRITE_THREADS = 4
+DEFAULT_WRITE_QUEUE_PER_THREAD = 2
+
+#Stages run by Pool workers, as many at once as there are Pool processes, 'write' only where workers write to the store themselves
+COMPRESSION_WORKER_STAGES = ['serialize', 'compress', 'write']
+DECOMPRESSION_WORKER_STAGES = ['cacheRead', 'decompress', 'cacheWrite', 'aggregate']
+
+#Settings shared by every segment a Pool worker compresses, set once in each worker by the Pool initializer
+workerSettings = {}
 
 class Compression:
     def __init__(self, inputFileName, columnsToBreakUpOn, whichCompressionAlgToUse, mongoObject):
@@ -15,94 +66,502 @@ class Compression:
         self.whichCompressionAlgToUse = whichCompressionAlgToUse
         self.mongoObject = mongoObject
 
-        self.memoryCap = None
-        self.dataChunks = []
+        self.memoryBudget = None
+        self.compressionLevel = None
+        self.useDictionary = False
+        self.dictionary = None
+        self.dictionaryId = None
+        self.targetThroughput = None
+        self.layout = 'row'
+        self.statisticsColumns = []
+        self.processCount = None
+        self.writeThreads = DEFAULT_WRITE_THREADS
+        self.writeQueue = None
+        self.bufferedBytes = 0
+        self.segmentTasks = []
+        self.blockSize = DEFAULT_BLOCK_SIZE
+        self.dataChunks = {}
+        self.blockSizes = {}
+        self.blockNumbers = {}
+        self.firstBlockNumber = 0
+        self.mergeBlockSize = None
+        self.existingBlocks = None
+        self.headerRow = None
+        self.lineTerminator = '\n'
+        #Rows and bytes read since the time spent reading them was last recorded, and when that was
+        self.parsedRows = 0
+        self.parsedBytes = 0
+        self.parseStart = time.perf_counter()
+
+    #Function returns the tag, block number and rows of a single block, ready to be batched into the Pool
+    def getSegmentTask(self, tag, blockNumber, rawRows):
+        #Last row in the file may not have a line terminator, adding one so blocks can be concatenated
+        rawRows[-1] = Table.terminateRawRow(rawRows[-1], self.lineTerminator)
+        return (tag, blockNumber, rawRows)
+
+    #Function adds a row to the current block of its segment
+    #Returns the block's task once the block reaches the target block size, otherwise None
+    def addRowToBlock(self, tag, rawRow):
+        #If the segment with that 'tag' already exists, add to it
+        if tag in self.dataChunks:
+            self.dataChunks[tag].append(rawRow)
+            self.blockSizes[tag] += len(rawRow)
+        #Else, create the segment
+        else:
+            self.dataChunks[tag] = [rawRow]
+            self.blockSizes[tag] = len(rawRow)
+        #Running total of memory held by every buffered row, kept up to date here, so it is never recounted
+        self.bufferedBytes += len(rawRow) + ROW_OVERHEAD_BYTES
+        self.parsedRows += 1
+        self.parsedBytes += len(rawRow)
+
+        if self.blockSizes[tag] >= self.blockSize:
+            return self.sealBlock(tag)
+        return None
+
+    #Function removes the current block of a segment from memory, returning its task
+    #Blocks are numbered in the order their rows appear in the CSV, so decompression can put the segment back together in order
+    def sealBlock(self, tag):
+        rawRows = self.dataChunks.pop(tag)
+        self.bufferedBytes -= self.blockSizes.pop(tag) + len(rawRows) * ROW_OVERHEAD_BYTES
+        blockNumber = self.blockNumbers.get(tag, self.firstBlockNumber)
+        self.blockNumbers[tag] = blockNumber + 1
+
+        return self.getSegmentTask(tag, blockNumber, rawRows)
+
+    #Function records the time spent reading and segmenting rows since it was last recorded, with the rows and bytes read in it
+    #Called whenever rows are handed on, so time spent waiting on the Pool, or the store, is never counted as reading
+    def recordParse(self):
+        parseEnd = time.perf_counter()
+        runMetrics.recordStage('parse', parseEnd - self.parseStart, bytesIn = self.parsedBytes, rows = self.parsedRows)
+        self.parsedRows = 0
+        self.parsedBytes = 0
+        self.parseStart = parseEnd
+
+    #Function yields blocks out of the CSV reader, recording the time spent reading before them, and restarting the clock after them
+    def yieldParsedBlocks(self, segmentTasks):
+        self.recordParse()
+        yield from segmentTasks
+        self.parseStart = time.perf_counter()
+
+    #Function groups segments into batches, each batch is compressed by one Pool worker and written with insert_many
+    #Batches are limited by number of segments and by uncompressed bytes, so one batch does not hold up the rest of the Pool
+    def getBatchedSegmentTasks(self, segmentTasks, batchCount):
+        batch = []
+        batchBytes = 0
+
+        for tag, blockNumber, rawRows in segmentTasks:
+            batch.append((tag, blockNumber, rawRows))
+            batchBytes += sum(len(rawRow) for rawRow in rawRows)
+
+            #Size of the batch is passed along, so the Pool worker can hand it back once the batch is written
+            if len(batch) >= batchCount or batchBytes >= self.mongoObject.batchBytes:
+                yield (self.headerRow, batch, batchBytes)
+                batch = []
+                batchBytes = 0
+
+        if len(batch) != 0:
+            yield (self.headerRow, batch, batchBytes)
+
+    #Function returns the number of Pool processes, set with --processes, by default # of system cores, and one more when
+    #workers write to the store themselves, writesInWorkers, so a core is still busy while a worker waits on a write
+    def getProcessCount(self, writesInWorkers):
+        if self.processCount is not None:
+            return self.processCount
+        return multiprocessing.cpu_count() + (1 if writesInWorkers else 0)
+
+    #Function creates the Pool, every worker connects to Mongo Db once, in the initializer, and reuses the connection
+    #Workers still read from the store, when appending, to merge a segment's last block into its first block of the run
+    def getCompressionPool(self, processCount):
+        runMetrics.setConcurrency(COMPRESSION_WORKER_STAGES, processCount)
+
+        return multiprocessing.Pool(processCount, initializer = Parallel.initializeCompressionWorker, \
+                                    initargs = (self.mongoObject, self.whichCompressionAlgToUse, self.compressionLevel, self.columnsToBreakUpOn, \
+                                                self.layout, self.statisticsColumns, self.dictionary, self.dictionaryId, self.firstBlockNumber, \
+                                                self.mergeBlockSize, self.existingBlocks, runMetrics.verbosity))
+
+    #Function creates the write stage, writing the batches the Pool compresses to the store on threads of their own
+    def getWriteStage(self):
+        runMetrics.setConcurrency(['write'], self.writeThreads)
+        writeQueue = self.writeQueue if self.writeQueue is not None else self.writeThreads * DEFAULT_WRITE_QUEUE_PER_THREAD
+        return WriteStage(self.writeThreads, writeQueue, 'writeQueue')
+
+    #Function hands a batch compressed by the Pool to the write stage, blocking while the stage's queue is full
+    #onWritten is called once the batch is written, or has failed to be
+    def submitCompressedBatch(self, writeStage, compressedBatch, onWritten = None):
+        documents, mergedDocumentIds, batchBytes = compressedBatch
+        writeStage.submit(sum(Storage.getCompressedSize(document) for document in documents), onWritten, Parallel.writeDocuments, \
+                          self.mongoObject, documents, mergedDocumentIds, self.columnsToBreakUpOn)
    
-    #Function breaks up a csv file, on a given set of columns, into different segments
+    #Function breaks up a csv file, on a given set of columns, into different segments, each made up of one or more blocks
     #This function runs in the default version of Smart Compress, with no 'memory' flag, loads entire CSV into memory 
     def iterateCsvBreakUpOnAttributes(self):
-        dataChunks = {}
+        segmentTasks = []
         
-        #Opening CSV file, using generator
-        with open(self.fileName) as openFile:
-            reader = csv.reader(openFile, delimiter = ',')
+        #Opening CSV file, using generator, newline is left untranslated so the original row bytes are kept
+        with open(self.fileName, newline = '') as openFile:
+            reader = Table.readRowsWithRawText(openFile)
             
             #Finding column positions of the fields to segment on in the header row of the CSV
-            positionList = Table.findAttributeInHeaderRow(next(reader), self.columnsToBreakUpOn)
+            positionList = self.readHeaderRow(reader)
+            self.mongoObject.prepareCollection(self.columnsToBreakUpOn, self.headerRow, self.statisticsColumns, \
+                                              self.dictionary, self.dictionaryId)
             print('Breaking up CSV into segments, based on field/s:', self.columnsToBreakUpOn)
+            self.parseStart = time.perf_counter()
         
             #For every row, use known column positions to create segments of different values at those positions
-            for dataRow in reader:
-                tupleTag = Table.getChunkTuple(dataRow, positionList)
-                #If the segment with that 'tag' already exists, add to it
-                if tupleTag in dataChunks:
-                    dataChunks[tupleTag].append(dataRow)
-                #Else, create the segment
-                else:
-                    dataChunks[tupleTag] = [dataRow]
+            for dataRow, rawRow in reader:
+                segmentTask = self.addRowToBlock(Table.getChunkTuple(dataRow, positionList), rawRow)
+                if segmentTask is not None:
+                    segmentTasks.append(segmentTask)
+                    self.recordParse()
+
+        #Last block of every segment
+        for tupleTag in list(self.dataChunks):
+            segmentTasks.append(self.sealBlock(tupleTag))
+        self.recordParse()
             
-        self.dataChunks = dataChunks
+        self.segmentTasks = segmentTasks
+
+    #Function reads the first rows of the CSV, up to the sample size, returns each row's tag, fields and original bytes
+    def readSample(self):
+        sample = []
+        sampleBytes = 0
+
+        with open(self.fileName, newline = '') as openFile:
+            reader = Table.readRowsWithRawText(openFile)
+            positionList = self.readHeaderRow(reader)
+
+            for dataRow, rawRow in reader:
+                rawRow = rawRow.encode("utf-8")
+                sample.append((Table.getChunkTuple(dataRow, positionList), dataRow, rawRow))
+                sampleBytes += len(rawRow)
+                if sampleBytes >= AUTO_SAMPLE_BYTES:
+                    break
+
+        return sample
+
+    #Function picks the compression algorithm for the 'auto' algorithm, by compressing sample blocks with every algorithm
+    #Sample is the first rows of the CSV, broken up into segments and blocks the same way as the whole CSV is
+    def chooseCompressionAlgorithm(self):
+        sampleBlocks = {}
+        sampleBlockSizes = {}
+
+        for tupleTag, dataRow, rawRow in self.readSample():
+            #Starting a new block of the segment once the current one reaches the block size
+            if tupleTag not in sampleBlocks or sampleBlockSizes[tupleTag] >= self.blockSize:
+                sampleBlocks.setdefault(tupleTag, []).append([])
+                sampleBlockSizes[tupleTag] = 0
+            sampleBlocks[tupleTag][-1].append(rawRow)
+            sampleBlockSizes[tupleTag] += len(rawRow)
+
+        sampleBlocks = [b''.join(block) for blocks in sampleBlocks.values() for block in blocks]
+        print('Sampling', sum(len(block) for block in sampleBlocks), 'bytes of the CSV, in', len(sampleBlocks), 'blocks, with every compression algorithm')
+        #Only algorithms that can use a preset dictionary are tried, when one is going to be used
+        self.whichCompressionAlgToUse = Codec.chooseCodec(sampleBlocks, self.targetThroughput, Codec.getCodecNames(self.useDictionary))
+        print("Picked '" + self.whichCompressionAlgToUse + "' compression algorithm")
+
+    #Function trains a preset dictionary, shared by every segment, on the first rows of the CSV
+    #Stored once, in the collection's metadata document, tiny segments no longer start compressing from nothing
+    def trainCompressionDictionary(self):
+        self.dictionary, self.dictionaryId = Codec.trainDictionary([dataRow for tupleTag, dataRow, rawRow in self.readSample()])
+        print('Trained a', len(self.dictionary), "byte compression dictionary, id '" + self.dictionaryId + "'")
 
-    #Function launches multiprocessing Pool to compress and write to a Mongo Database instance in parallel
+    #Function readies an append run into a collection that already holds segments, before anything is written
+    #The CSV's header row has to match the one the collection was compressed with, the lookup fields are checked by prepareCollection
+    #Blocks of this run are numbered after every block already in the collection, and the first block of each segment
+    #is merged with the segment's last block, if that block is small enough
+    def prepareAppend(self, metadata):
+        self.checkHeaderRowMatches(metadata)
+
+        runNumber = self.mongoObject.startIngestRun()
+        self.firstBlockNumber = runNumber << APPEND_BLOCK_NUMBER_BITS
+        self.mergeBlockSize = self.blockSize
+        print('Appending to collection', "'" + self.mongoObject.collectionName + "',", 'run', runNumber)
+
+    #Function readies a refresh of a collection from a new version of its CSV, before anything is written
+    #Every block's content hash is read in one query, blocks whose rows have not changed are not compressed or written again
+    def prepareRefresh(self, metadata):
+        self.checkHeaderRowMatches(metadata)
+        self.existingBlocks = self.mongoObject.readBlockHashes(metadata['lookupFields'])
+        print('Refreshing collection', "'" + self.mongoObject.collectionName + "',", 'checking against', len(self.existingBlocks), 'existing blocks')
+
+    #Function terminates if the CSV's header row does not match the one the collection was compressed with
+    def checkHeaderRowMatches(self, metadata):
+        with open(self.fileName, newline = '') as openFile:
+            self.readHeaderRow(Table.readRowsWithRawText(openFile))
+
+        if Table.getHeaderFields(self.headerRow) != Table.getHeaderFields(metadata['headerRow']):
+            sys.exit("Header row of '" + self.fileName + "' does not match the header row collection '" + self.mongoObject.collectionName + \
+                     "' was compressed with, program terminating")
+
+    #Function removes the blocks of a refreshed collection that this run did not keep, changed blocks, and segments no longer in the CSV
+    #refreshedBlocks holds the tag, block number and hash of every block in the new CSV, written or kept
+    #A block is only kept once, so duplicates left behind by an interrupted run are cleaned up too
+    def removeStaleBlocks(self, refreshedBlocks):
+        staleDocumentIds = []
+        keptCount = 0
+
+        for (tag, blockNumber), existingVersions in self.existingBlocks.items():
+            kept = False
+            for blockHash, documentId in existingVersions:
+                if not kept and (tag, blockNumber, blockHash) in refreshedBlocks:
+                    kept = True
+                    keptCount += 1
+                else:
+                    staleDocumentIds.append(documentId)
+
+        for batchStart in range(0, len(staleDocumentIds), self.mongoObject.batchCount):
+            self.mongoObject.deleteSegments(staleDocumentIds[batchStart:batchStart + self.mongoObject.batchCount])
+        print('Kept', keptCount, 'unchanged blocks, wrote', len(refreshedBlocks) - keptCount, 'blocks, removed', len(staleDocumentIds), 'blocks')
+
+    #Function drops blocks whose rows have not changed since the collection was compressed, from tasks built in Smart Compress
+    #Tag, block number and hash of every block is added to refreshedBlocks, whether it is dropped or not
+    def skipUnchangedBlocks(self, segmentTasks, refreshedBlocks):
+        for tag, blockNumber, rawRows in segmentTasks:
+            blockHash = Parallel.getBlockHash(rawRows)
+            refreshedBlocks.add((tag, blockNumber, blockHash))
+            if not Parallel.isBlockUnchanged(self.existingBlocks, tag, blockNumber, blockHash):
+                yield (tag, blockNumber, rawRows)
+
+    #Function reads the header row of the CSV, keeping its original text so it can be stored with each segment
+    #Returns the column positions of the fields to segment on
+    def readHeaderRow(self, reader):
+        headerRow, rawHeaderRow = next(reader)
+        self.headerRow = Table.terminateRawRow(rawHeaderRow, '\n').encode("utf-8")
+        #Every row in a segment must end in a line terminator, the header row's terminator is reused for the last row in the file
+        self.lineTerminator = rawHeaderRow[len(rawHeaderRow.rstrip('\r\n')):] or '\n'
+        #Checking the columns to keep statistics on are in the header row, before any segment is compressed
+        Table.findAttributeInHeaderRow(headerRow, self.statisticsColumns)
+
+        return Table.findAttributeInHeaderRow(headerRow, self.columnsToBreakUpOn)
+
+    #Function launches multiprocessing Pool to compress, and the write stage to write to a Mongo Database instance, in parallel
     #This function runs in the default version of Smart Compress, with no 'memory' flag, it takes a full list already in memory
+    #Batches are written as the Pool hands them back, in any order, while the Pool compresses the rest
     def compressChunksInParallel(self):
         print("Compressing segments in parallel using '" + self.whichCompressionAlgToUse + "' compression algorithm")
-        self.dataChunks = [(tag, data, self.whichCompressionAlgToUse, self.mongoObject, self.columnsToBreakUpOn) for tag, data in self.dataChunks.items()]
+        #Refreshing, blocks that have not changed are dropped before they are handed to the Pool
+        refreshedBlocks = set()
+        if self.existingBlocks is not None:
+            self.segmentTasks = list(self.skipUnchangedBlocks(self.segmentTasks, refreshedBlocks))
+        #Every block is already in memory, so batches are also kept small enough to spread across the whole Pool
+        processCount = self.getProcessCount(False)
+        batchCount = max(1, min(self.mongoObject.batchCount, len(self.segmentTasks) // (processCount * 4)))
+        batchedTasks = list(self.getBatchedSegmentTasks(self.segmentTasks, batchCount))
+        self.segmentTasks = []
     
-        cpuCores = multiprocessing.cpu_count()
+        pool = self.getCompressionPool(processCount)
+        writeStage = self.getWriteStage()
+        for compressedBatch in runMetrics.collectResults(pool.imap_unordered(InstrumentedTask(Parallel.compressionParallelized), batchedTasks)):
+            self.submitCompressedBatch(writeStage, compressedBatch)
+        pool.close()
+        pool.join()
+        writeStage.close()
 
-        #Pool is created on # of system cores + 1 for performance
-        pool = multiprocessing.Pool(cpuCores + 1)
-        pool.map(Parallel.compressionParallelized, self.dataChunks)
+        #Only once every changed block is written, so the collection never goes without one of its blocks
+        if self.existingBlocks is not None:
+            self.removeStaleBlocks(refreshedBlocks)
 
     #Function breaks up a csv file, on a given set of columns, into different segments
-    #This function runs when the 'memory' flag is set, each segment has a max size, when this size is reached
-    #it is yielded out of the function into a Pool, and the segment, and its memory is deleted from Smart Compress
-    #This ensures that thrashing in memory will not occur for very large CSV files
+    #This function runs when the 'memory' flag is set, rows buffered in memory are held under the memory budget
+    #Once they go over it, the largest segments are yielded out of the function into a Pool, as blocks, and deleted from Smart Compress
+    #This ensures that thrashing in memory will not occur for very large CSV files, no matter how many segments there are
     def getCsvChunkGenerator(self):
-        dataChunks = {}
         firstYield = 1
+        #Rows get what is left of the budget once blocks handed to the Pool are accounted for
+        bufferBudget = int(self.memoryBudget * (1 - MEMORY_IN_FLIGHT_SHARE))
 
-        #Opening CSV file, using generator
-        with open(self.fileName) as openFile:
-            reader = csv.reader(openFile, delimiter = ',')
+        #Opening CSV file, using generator, newline is left untranslated so the original row bytes are kept
+        with open(self.fileName, newline = '') as openFile:
+            reader = Table.readRowsWithRawText(openFile)
         
             #Finding column positions of the fields to segment on in the header row of the CSV
-            positionList = Table.findAttributeInHeaderRow(next(reader), self.columnsToBreakUpOn)
-            print("Breaking up CSV into segments of max length '" + str(self.memoryCap) + "', based on field/s:", self.columnsToBreakUpOn)
+            positionList = self.readHeaderRow(reader)
+            self.mongoObject.prepareCollection(self.columnsToBreakUpOn, self.headerRow, self.statisticsColumns, \
+                                              self.dictionary, self.dictionaryId)
+            print("Breaking up CSV into segments with a memory budget of '" + str(self.memoryBudget) + "' bytes, based on field/s:", self.columnsToBreakUpOn)
+            self.parseStart = time.perf_counter()
         
             #For every row, use known column positions to create segments of different values at those positions
-            for dataRow in reader:
-                tupleTag = Table.getChunkTuple(dataRow, positionList)
-                #If the segment with the 'tag' already exists, add to it
-                if tupleTag in dataChunks:
-                    dataChunks[tupleTag].append(dataRow)
-                #Else, create the segment
-                else:
-                    dataChunks[tupleTag] = [dataRow]
-                
-                #If the segment just added to has reached the maximum length
-                if len(dataChunks[tupleTag]) >= self.memoryCap:
-                    #Yield it into the Pool to be compressed and written to Mongo Db
-                    yield (tupleTag, dataChunks[tupleTag], self.whichCompressionAlgToUse, self.mongoObject, self.columnsToBreakUpOn) 
-                    #Delete it from Smart Compress's memory
-                    del dataChunks[tupleTag]
-                    gc.collect()
-                
-                if firstYield == 1:
-                    firstYield = 0
-                    print("Compressing segments in parallel once max length of '" + str(self.memoryCap) + \
-                          "' is reached, using '" + self.whichCompressionAlgToUse + "' compression algorithm")
+            for dataRow, rawRow in reader:
+                #Yield full blocks into the Pool to be compressed and written to Mongo Db
+                segmentTask = self.addRowToBlock(Table.getChunkTuple(dataRow, positionList), rawRow)
+                if segmentTask is not None:
+                    yield from self.yieldParsedBlocks([segmentTask])
+
+                #Buffered rows went over the budget, flushing segments out of Smart Compress's memory
+                if self.bufferedBytes > bufferBudget:
+                    if firstYield == 1:
+                        firstYield = 0
+                        print("Compressing segments in parallel once the memory budget of '" + str(self.memoryBudget) + \
+                              "' bytes is reached, using '" + self.whichCompressionAlgToUse + "' compression algorithm")
+
+                    yield from self.yieldParsedBlocks(self.flushLargestBlocks(int(bufferBudget * MEMORY_LOW_WATER_MARK)))
+
+        #Rows still buffered once the whole CSV has been read
+        yield from self.yieldParsedBlocks(self.sealBlock(tupleTag) for tupleTag in list(self.dataChunks))
+
+    #Function flushes the largest buffered segments, as blocks, until buffered rows fit in the target number of bytes
+    #Largest first, so the fewest, and largest, blocks free the memory, keeping compression ratio as high as possible
+    def flushLargestBlocks(self, targetBytes):
+        for tupleTag in sorted(self.blockSizes, key = self.blockSizes.get, reverse = True):
+            if self.bufferedBytes <= targetBytes:
+                break
+            yield self.sealBlock(tupleTag)
+
+    #Function yields batches into the Pool, blocking while the blocks already handed out would go over their share of the memory budget
+    def getWindowedBatchTasks(self, batchedTasks, inFlightBatches):
+        for batchedTask in batchedTasks:
+            inFlightBatches.acquire(batchedTask[2])
+            yield batchedTask
                     
-    #Function launches multiprocessing Pool to compress and write to a Mongo Database instance in parallel
+    #Function launches multiprocessing Pool to compress, and the write stage to write to a Mongo Database instance, in parallel
     #This function runs when the 'memory' flag is set, it uses a generator to pass into the Pool the moment a segment is ready
     #so the entire iterable for the Pool does not have to be in memory
+    #Reading, compressing and writing are stages of one pipeline, each with its own concurrency, the Pool never waits on the store
     def breakUpCsvAndCompressChunksMemorySensative(self):
-        cpuCores = multiprocessing.cpu_count()
+        processCount = self.getProcessCount(False)
+        #Pool pulls batches from the generator as fast as it can, the window stops it from reading ahead past the memory budget
+        #A batch's room is only given back once it is written, so a slow store holds up reading, and memory stays under the budget
+        inFlightBatches = InFlightWindow(processCount * 4, int(self.memoryBudget * MEMORY_IN_FLIGHT_SHARE), 'compressWindow')
+        batchedTasks = self.getBatchedSegmentTasks(self.getCsvChunkGenerator(), self.mongoObject.batchCount)
 
-        #Pool is created on # of system cores + 1 for performance
-        pool = multiprocessing.Pool(cpuCores + 1)
-        list(pool.imap(Parallel.compressionParallelized, self.getCsvChunkGenerator()))
+        pool = self.getCompressionPool(processCount)
+        writeStage = self.getWriteStage()
+        for compressedBatch in runMetrics.collectResults(pool.imap_unordered(InstrumentedTask(Parallel.compressionParallelized), \
+                                                                             self.getWindowedBatchTasks(batchedTasks, inFlightBatches))):
+            self.submitCompressedBatch(writeStage, compressedBatch, lambda batchBytes = compressedBatch[2]: inFlightBatches.release(batchBytes))
+        pool.close()
+        pool.join()
+        writeStage.close()
+
+    #Function breaks up and compresses a csv file on every core at once, each Pool worker reads and segments its own byte range of the file
+    #Ranges are moved onto row boundaries using the number of quotes before them, so quoted fields containing newlines are never split
+    #Each range's part of a segment is written as its own blocks, numbered after the blocks of the ranges before it
+    def breakUpCsvAndCompressInParallelRanges(self):
+        #Header row is read on its own, the byte ranges cover everything after it
+        with open(self.fileName, newline = '') as openFile:
+            positionList = self.readHeaderRow(Table.readRowsWithRawText(openFile))
+        self.mongoObject.prepareCollection(self.columnsToBreakUpOn, self.headerRow, self.statisticsColumns, \
+                                          self.dictionary, self.dictionaryId)
+
+        fileSize = os.path.getsize(self.fileName)
+        dataStart = min(len(self.headerRow), fileSize)
+        #Every Pool worker writes the blocks of its own range
+        processCount = self.getProcessCount(True)
+        #At least one range per Pool process, no range over the default range size, and none so small it is not worth a process
+        rangeCount = max(processCount, -(-(fileSize - dataStart) // DEFAULT_RANGE_SIZE))
+        rangeCount = max(1, min(rangeCount, (fileSize - dataStart) // MIN_RANGE_SIZE))
+        rawOffsets = [dataStart + (fileSize - dataStart) * rangeIndex // rangeCount for rangeIndex in range(rangeCount + 1)]
+
+        print('Breaking up CSV into segments in parallel, over', rangeCount, 'byte ranges, based on field/s:', self.columnsToBreakUpOn)
+        pool = self.getCompressionPool(processCount)
+        #Every Pool worker reads and segments its own byte range
+        runMetrics.setConcurrency(['parse'], processCount)
+
+        #First pass, counting the quotes in every range, in parallel
+        quoteCounts = pool.map(Parallel.countQuotesParallelized, \
+                               [(self.fileName, rawOffsets[rangeIndex], rawOffsets[rangeIndex + 1]) for rangeIndex in range(rangeCount)])
+        #An odd number of quotes before an offset means it falls inside a quoted field
+        insideQuotes = [False]
+        quotesSoFar = 0
+        for quoteCount in quoteCounts:
+            quotesSoFar += quoteCount
+            insideQuotes.append(quotesSoFar % 2 == 1)
+
+        #Second pass, every range is segmented, compressed and written by its own Pool worker
+        print("Compressing segments in parallel using '" + self.whichCompressionAlgToUse + "' compression algorithm")
+        rangeTasks = [(rangeIndex, self.fileName, dataStart, rawOffsets[rangeIndex], rawOffsets[rangeIndex + 1], insideQuotes[rangeIndex], \
+                       insideQuotes[rangeIndex + 1], positionList, self.headerRow, self.lineTerminator, self.blockSize) for rangeIndex in range(rangeCount)]
+        rowCount = sum(runMetrics.collectResults(pool.imap_unordered(InstrumentedTask(Parallel.ingestRangeParallelized), rangeTasks)))
+        pool.close()
+        pool.join()
+        print('Broke up', rowCount, 'rows into segments')
+
+    #Function breaks up a csv file larger than memory into exactly one segment per tag, by spilling it to disk first
+    #Rows are hashed on their tag into partition files, every row of a tag lands in the same partition, under the memory budget
+    #Then every partition is segmented, compressed and written by its own Pool worker, as complete segments
+    def breakUpCsvAndCompressSpilledPartitions(self, spillDirectory = None):
+        fileSize = os.path.getsize(self.fileName)
+        #Every Pool worker writes the blocks of its own partition
+        processCount = self.getProcessCount(True)
+        #Every Pool process holds one partition at a time, so partitions are sized for all of them to fit in the budget at once
+        partitionBytes = max(1, self.memoryBudget // (processCount * SPILL_PARTITION_MEMORY_FACTOR))
+        partitionCount = max(processCount, -(-fileSize // partitionBytes))
+
+        with tempfile.TemporaryDirectory(prefix = 'smartcompress-', dir = spillDirectory) as partitionDirectory:
+            partitionFileNames = [os.path.join(partitionDirectory, 'partition-' + str(partitionNumber) + '.csv') \
+                                  for partitionNumber in range(partitionCount)]
+            positionList = self.spillRowsToPartitions(partitionFileNames)
+
+            print("Compressing segments in parallel, one partition at a time, using '" + self.whichCompressionAlgToUse + "' compression algorithm")
+            partitionTasks = [(partitionFileName, positionList, self.headerRow, self.lineTerminator, self.blockSize) \
+                              for partitionFileName in partitionFileNames]
+            pool = self.getCompressionPool(processCount)
+            #Every Pool worker reads and segments its own partition
+            runMetrics.setConcurrency(['parse'], processCount)
+            rowCount = 0
+            refreshedBlocks = set()
+            for partitionRowCount, partitionBlocks in runMetrics.collectResults(pool.imap_unordered(InstrumentedTask(Parallel.ingestPartitionParallelized), \
+                                                                                                    partitionTasks)):
+                rowCount += partitionRowCount
+                refreshedBlocks.update(partitionBlocks)
+            pool.close()
+            pool.join()
+            print('Broke up', rowCount, 'rows into segments')
+
+        #Only once every changed block is written, so the collection never goes without one of its blocks
+        if self.existingBlocks is not None:
+            self.removeStaleBlocks(refreshedBlocks)
+
+    #Function reads the CSV once, appending each row's original text to the partition file its tag hashes to
+    #Rows are buffered in memory, and every partition's buffer is appended to its file once they reach the memory budget
+    def spillRowsToPartitions(self, partitionFileNames):
+        partitionBuffers = [[] for partitionFileName in partitionFileNames]
+
+        #Opening CSV file, using generator, newline is left untranslated so the original row bytes are kept
+        with open(self.fileName, newline = '') as openFile:
+            reader = Table.readRowsWithRawText(openFile)
+
+            #Finding column positions of the fields to segment on in the header row of the CSV
+            positionList = self.readHeaderRow(reader)
+            self.mongoObject.prepareCollection(self.columnsToBreakUpOn, self.headerRow, self.statisticsColumns, \
+                                              self.dictionary, self.dictionaryId)
+            print("Spilling CSV to", len(partitionFileNames), "partition files, with a memory budget of '" + str(self.memoryBudget) + \
+                  "' bytes, based on field/s:", self.columnsToBreakUpOn)
+            self.parseStart = time.perf_counter()
+
+            for dataRow, rawRow in reader:
+                #Rows are appended one after another, so every one has to end in a line terminator
+                rawRow = Table.terminateRawRow(rawRow, self.lineTerminator)
+                partitionBuffers[Table.getPartitionNumber(Table.getChunkTuple(dataRow, positionList), len(partitionFileNames))].append(rawRow)
+                self.bufferedBytes += len(rawRow) + ROW_OVERHEAD_BYTES
+                self.parsedRows += 1
+                self.parsedBytes += len(rawRow)
+
+                if self.bufferedBytes > self.memoryBudget:
+                    self.flushPartitionBuffers(partitionFileNames, partitionBuffers)
+
+        self.flushPartitionBuffers(partitionFileNames, partitionBuffers)
+        return positionList
+
+    #Function appends every partition's buffered rows to its file, and empties the buffers
+    #Spill stage is the time spent reading and hashing the rows since the last flush, and writing them out
+    def flushPartitionBuffers(self, partitionFileNames, partitionBuffers):
+        spilledBytes = self.parsedBytes
+        for partitionFileName, partitionBuffer in zip(partitionFileNames, partitionBuffers):
+            #Every partition file is created, even if no rows hash to it, so every Pool worker has a file to read
+            with open(partitionFileName, 'a', encoding = 'utf-8', newline = '') as partitionFile:
+                partitionFile.writelines(partitionBuffer)
+            partitionBuffer.clear()
+
+        self.bufferedBytes = 0
+        spillEnd = time.perf_counter()
+        runMetrics.recordStage('spill', spillEnd - self.parseStart, bytesIn = spilledBytes, bytesOut = spilledBytes, rows = self.parsedRows)
+        self.parsedRows = 0
+        self.parsedBytes = 0
+        self.parseStart = spillEnd
 
 
 class Table(Compression):
@@ -131,7 +590,7 @@ class Table(Compression):
             if field[0] == '$':
                 sys.exit("Fields cannot start with '$', program terminating")
 
-            return fieldListWithRemovedQuotes
+        return fieldListWithRemovedQuotes
     
     #Function searches for the position of fields to segment on in the header row of the CSV
     def findAttributeInHeaderRow(headerRow, columnsToBreakUpOn):
@@ -164,52 +623,488 @@ class Table(Compression):
 
         return tuple(labelList)
 
+    #Function reads a CSV file, yielding each parsed row along with the exact text it was parsed from
+    #A row can span multiple lines when a quoted field contains a newline, so lines are collected until the reader finishes a row
+    def readRowsWithRawText(openFile):
+        rawLines = []
+
+        #Every line handed to the CSV reader is also kept, so it can be joined back into the row's original text
+        def lineSource():
+            for line in openFile:
+                rawLines.append(line)
+                yield line
+
+        for dataRow in csv.reader(lineSource(), delimiter = ','):
+            rawRow = ''.join(rawLines)
+            rawLines.clear()
+            #Skipping blank lines, they have no fields to segment on
+            if len(dataRow) != 0:
+                yield dataRow, rawRow
+
+    #Function yields the lines of a file between two byte offsets, which have to be on line boundaries
+    def readLinesInRange(openFile, startOffset, endOffset):
+        openFile.seek(startOffset)
+        position = startOffset
+
+        while position < endOffset:
+            line = openFile.readline()
+            #File is shorter than expected, nothing left to read
+            if len(line) == 0:
+                return
+            position += len(line)
+            yield line.decode("utf-8")
+
+    #Function finds the first row boundary after a byte offset of a memory mapped CSV file
+    #insideQuotes says if the offset falls inside a quoted field, a newline only ends a row when it is outside quotes
+    def findRowStart(mappedFile, offset, insideQuotes):
+        position = offset
+
+        while True:
+            newlinePosition = mappedFile.find(b'\n', position)
+            if newlinePosition == -1:
+                return len(mappedFile)
+
+            #Every quote between here and the newline flips whether we are inside a quoted field, "" escapes flip it twice
+            if mappedFile[position:newlinePosition].count(b'"') % 2 == 1:
+                insideQuotes = not insideQuotes
+            if not insideQuotes:
+                return newlinePosition + 1
+            position = newlinePosition + 1
+
+    #Function returns the partition a tag's rows are spilled to, the same tag always goes to the same partition
+    def getPartitionNumber(tupleTag, partitionCount):
+        return zlib.crc32('\x00'.join(tupleTag).encode("utf-8")) % partitionCount
+
+    #Function returns the fields of a header row, stored as its original bytes
+    def getHeaderFields(headerRow):
+        return next(csv.reader(io.StringIO(headerRow.decode("utf-8"), newline = ''), delimiter = ','))
+
+    #Function makes sure a row's original text ends in a line terminator
+    def terminateRawRow(rawRow, lineTerminator):
+        if rawRow.endswith('\n') or rawRow.endswith('\r'):
+            return rawRow
+        return rawRow + lineTerminator
+
 
 class Parallel():
-    #Function compresses segment
+    #Function runs once in every Pool worker, before any segment is compressed
+    #The storage object is pickled into the worker once, here, and connects to its store once for every batch the worker writes
+    #The preset dictionary, if there is one, is also pickled into the worker once, here, not with every batch
+    #When appending, blocks are numbered from firstBlockNumber, and mergeBlockSize is the largest a merged block can be, None otherwise
+    #When refreshing, existingBlocks holds the hash of every block already in the collection, None otherwise
+    def initializeCompressionWorker(mongoObject, algToUse, compressionLevel, mongoFieldNames, layout, statisticsColumns, dictionary, dictionaryId, \
+                                    firstBlockNumber, mergeBlockSize, existingBlocks, verbosity):
+        runMetrics.reset(verbosity)
+        workerSettings['mongoObject'] = mongoObject
+        workerSettings['algToUse'] = algToUse
+        workerSettings['compressionLevel'] = compressionLevel
+        workerSettings['mongoFieldNames'] = mongoFieldNames
+        workerSettings['layout'] = layout
+        workerSettings['statisticsColumns'] = statisticsColumns
+        workerSettings['dictionary'] = dictionary
+        workerSettings['dictionaryId'] = dictionaryId
+        workerSettings['firstBlockNumber'] = firstBlockNumber
+        workerSettings['mergeBlockSize'] = mergeBlockSize
+        workerSettings['existingBlocks'] = existingBlocks
+        #Blocks merged into a newer block, deleted once the newer block is written
+        workerSettings['mergedDocumentIds'] = []
+        mongoObject.connect()
+
+    #Function compresses a batch of segments, the Pool worker only compresses, the write stage writes them to Mongo Db
+    #Returns the documents, the '_id' of the blocks merged into them, deleted once they are written, and the batch's uncompressed size,
+    #so Smart Compress knows its memory is free once the batch is written
     def compressionParallelized(chunk):
-        compressedStream = ''
         #Unpacking tuple, passed in through Pool iterator
-        tag = chunk[0]
-        algToUse = chunk[2]
-        #Converting list to string and then to byte array
-        dataToCompress = str(chunk[1]).encode("utf-8")
-        mongoConnectionObject = chunk[3]
-        mongoFieldNames = chunk[4]
-       
-        #Compressing according to user input
-        if algToUse == 'bzip2':
-            compressedStream = bz2.compress(dataToCompress)
-        elif algToUse == 'gzip':
-            compressedStream = gzip.compress(dataToCompress)
-        elif algToUse == 'xz':
-            compressedStream = lzma.compress(dataToCompress)
+        headerRow = chunk[0]
+        documents = []
+
+        for tag, blockNumber, rawRows in chunk[1]:
+            documents.append(Parallel.compressSegment(tag, blockNumber, rawRows, headerRow))
+
+        mergedDocumentIds = workerSettings['mergedDocumentIds']
+        workerSettings['mergedDocumentIds'] = []
+        return documents, mergedDocumentIds, chunk[2]
+
+    #Function writes compressed segment documents to the store, on a thread of the write stage, or inside a Pool worker
+    #that reads its own part of the CSV, mongoFieldNames are the fields segments are broken up on
+    def writeDocuments(mongoObject, documents, mergedDocumentIds, mongoFieldNames):
+        writeStart = time.perf_counter()
+        mongoObject.writeToDatabase(documents)
+        #Only deleted once the blocks they were merged into are written, a failure in between leaves rows twice, never loses them
+        mongoObject.deleteSegments(mergedDocumentIds)
+        runMetrics.recordStage('write', time.perf_counter() - writeStart, bytesIn = sum(Storage.getCompressedSize(document) for document in documents), \
+                               blocks = len(documents))
+
+        for document in documents:
+            runMetrics.printVerbose(SEGMENT_VERBOSITY, 'Segment successfully written to', mongoObject.storeName + ':', \
+                                    [document[field] for field in mongoFieldNames], 'block', document['blockNumber'])
+
+    #Function writes compressed segment documents to the store from inside a Pool worker, with the blocks merged into them
+    def writeWorkerDocuments(documents):
+        mergedDocumentIds = workerSettings['mergedDocumentIds']
+        workerSettings['mergedDocumentIds'] = []
+        Parallel.writeDocuments(workerSettings['mongoObject'], documents, mergedDocumentIds, workerSettings['mongoFieldNames'])
+
+    #Function counts the quotes in a byte range of a file, through a memory map, a piece at a time
+    def countQuotesParallelized(chunk):
+        fileName, startOffset, endOffset = chunk
+        quoteCount = 0
+
+        with open(fileName, 'rb') as openFile, mmap.mmap(openFile.fileno(), 0, access = mmap.ACCESS_READ) as mappedFile:
+            for pieceStart in range(startOffset, endOffset, MIN_RANGE_SIZE):
+                quoteCount += mappedFile[pieceStart:min(pieceStart + MIN_RANGE_SIZE, endOffset)].count(b'"')
+
+        return quoteCount
+
+    #Function segments, compresses and writes one byte range of a CSV file, returns the number of rows in it
+    def ingestRangeParallelized(chunk):
+        #Unpacking tuple, passed in through Pool iterator
+        rangeIndex, fileName, dataStart, rawStart, rawEnd, startInsideQuotes, endInsideQuotes, positionList, headerRow, lineTerminator, blockSize = chunk
+
+        #Moving both ends of the range onto row boundaries, the range before this one moves its end the same way, so no row is lost or read twice
+        with open(fileName, 'rb') as openFile:
+            with mmap.mmap(openFile.fileno(), 0, access = mmap.ACCESS_READ) as mappedFile:
+                startOffset = dataStart if rangeIndex == 0 else Parallel.findRangeBoundary(mappedFile, rawStart, startInsideQuotes)
+                endOffset = Parallel.findRangeBoundary(mappedFile, rawEnd, endInsideQuotes)
+
+            #Blocks of each range are numbered after every block of the ranges before it
+            rowCount, _ = Parallel.ingestRows(Table.readRowsWithRawText(Table.readLinesInRange(openFile, startOffset, endOffset)), positionList, \
+                                           headerRow, lineTerminator, blockSize, workerSettings['firstBlockNumber'] + \
+                                           (rangeIndex << RANGE_BLOCK_NUMBER_BITS))
+
+        return rowCount
+
+    #Function segments rows into blocks, compresses and writes them, from inside a Pool worker
+    #Returns the number of rows, and, when refreshing, the tag, block number and hash of every block, written or not
+    def ingestRows(rows, positionList, headerRow, lineTerminator, blockSize, firstBlockNumber):
+        mongoObject = workerSettings['mongoObject']
+        rowCount = 0
+        refreshedBlocks = []
+
+        #Worker's own Compression object holds its blocks, so blocks are built exactly as they are in the other modes
+        rowsCompression = Compression(None, workerSettings['mongoFieldNames'], workerSettings['algToUse'], mongoObject)
+        rowsCompression.blockSize = blockSize
+        rowsCompression.headerRow = headerRow
+        rowsCompression.lineTerminator = lineTerminator
+        rowsCompression.firstBlockNumber = firstBlockNumber
+        documents = []
+        documentBytes = 0
+        rowsCompression.parseStart = time.perf_counter()
+
+        for dataRow, rawRow in rows:
+            rowCount += 1
+            segmentTask = rowsCompression.addRowToBlock(Table.getChunkTuple(dataRow, positionList), rawRow)
+            if segmentTask is None:
+                continue
+            rowsCompression.recordParse()
+
+            #Full blocks are compressed straight away, and written once there is a batch of them
+            if not Parallel.skipUnchangedBlock(segmentTask, refreshedBlocks):
+                documents.append(Parallel.compressSegment(segmentTask[0], segmentTask[1], segmentTask[2], headerRow))
+                documentBytes += Storage.getCompressedSize(documents[-1])
+                if len(documents) >= mongoObject.batchCount or documentBytes >= mongoObject.batchBytes:
+                    Parallel.writeWorkerDocuments(documents)
+                    documents = []
+                    documentBytes = 0
+            #Time spent hashing, compressing and writing is not reading
+            rowsCompression.parseStart = time.perf_counter()
+
+        #Last block of every segment
+        rowsCompression.recordParse()
+        for tupleTag in list(rowsCompression.dataChunks):
+            segmentTask = rowsCompression.sealBlock(tupleTag)
+            if not Parallel.skipUnchangedBlock(segmentTask, refreshedBlocks):
+                documents.append(Parallel.compressSegment(segmentTask[0], segmentTask[1], segmentTask[2], headerRow))
+        if len(documents) != 0:
+            Parallel.writeWorkerDocuments(documents)
+
+        return rowCount, refreshedBlocks
+
+    #Function returns True if a block built inside a Pool worker has not changed since the collection was compressed
+    #When refreshing, the block's tag, block number and hash are added to refreshedBlocks, whether it has changed or not
+    def skipUnchangedBlock(segmentTask, refreshedBlocks):
+        if workerSettings['existingBlocks'] is None:
+            return False
+
+        tag, blockNumber, rawRows = segmentTask
+        blockHash = Parallel.getBlockHash(rawRows)
+        refreshedBlocks.append((tag, blockNumber, blockHash))
+        return Parallel.isBlockUnchanged(workerSettings['existingBlocks'], tag, blockNumber, blockHash)
+
+    #Function returns the content hash of a block's rows, stored with the block so unchanged blocks are found without reading them
+    def getBlockHash(rawRows):
+        return hashlib.sha256(''.join(rawRows).encode("utf-8")).hexdigest()
+
+    #Function returns True if the collection already holds a block with this tag, block number and hash
+    def isBlockUnchanged(existingBlocks, tag, blockNumber, blockHash):
+        return any(existingHash == blockHash for existingHash, documentId in existingBlocks.get((tag, blockNumber), []))
+
+    #Function segments, compresses and writes one spilled partition file, returns the number of rows in it
+    #Every row of a tag is in the partition, so each segment is built whole, as it would be with the entire CSV in memory
+    def ingestPartitionParallelized(chunk):
+        #Unpacking tuple, passed in through Pool iterator
+        partitionFileName, positionList, headerRow, lineTerminator, blockSize = chunk
+
+        with open(partitionFileName, encoding = 'utf-8', newline = '') as partitionFile:
+            rowCount, refreshedBlocks = Parallel.ingestRows(Table.readRowsWithRawText(partitionFile), positionList, headerRow, lineTerminator, \
+                                                            blockSize, workerSettings['firstBlockNumber'])
+        #Partition is no longer needed, freeing its disk space before the rest are done
+        os.remove(partitionFileName)
+
+        return rowCount, refreshedBlocks
+
+    #Function returns the row boundary a raw range offset is moved to, the end of the file stays where it is
+    def findRangeBoundary(mappedFile, offset, insideQuotes):
+        if offset >= len(mappedFile):
+            return len(mappedFile)
+        return Table.findRowStart(mappedFile, offset, insideQuotes)
+
+    #Function compresses one block of a segment, returns the document to write to Mongo Db
+    def compressSegment(tag, blockNumber, rawRows, headerRow):
+        rowCount = len(rawRows)
+        #First block of a segment in an append run, the segment's last block is merged into it, if it is small enough
+        if workerSettings['mergeBlockSize'] is not None and blockNumber == workerSettings['firstBlockNumber']:
+            rawRows, mergedRowCount = Parallel.mergeLastBlock(tag, rawRows, headerRow)
+            #Merged block was written before row counts were stored
+            rowCount = rowCount + mergedRowCount if mergedRowCount is not None else None
+        #Serialize stage is everything done to the block's rows before they are compressed, not counting a merge, which reads the store
+        serializeStart = time.perf_counter()
+        #Joining the original CSV row text and converting to byte array
+        dataToCompress = ''.join(rawRows).encode("utf-8")
+        #Stored next to the compressed object, so decompression can write the output file without parsing
+        #Algorithm and level are stored too, so decompression picks the algorithm from the segment
+        segmentMetadata = {'formatVersion': SEGMENT_FORMAT_VERSION, 'headerRow': headerRow, 'uncompressedSize': len(dataToCompress), \
+                           'blockNumber': blockNumber, 'codec': workerSettings['algToUse'], 'level': workerSettings['compressionLevel'], \
+                           'blockHash': hashlib.sha256(dataToCompress).hexdigest()}
+        #Decompression looks the dictionary up in the collection's metadata document by its id
+        if workerSettings['dictionary'] is not None:
+            segmentMetadata['dictionaryId'] = workerSettings['dictionaryId']
+
+        rows = None
+        #Rows were kept as their original text, parsing them again into fields, only when the fields are needed
+        if workerSettings['layout'] == 'columnar' or len(workerSettings['statisticsColumns']) != 0:
+            rows = list(csv.reader(io.StringIO(''.join(rawRows), newline = ''), delimiter = ','))
+            rowCount = len(rows)
+            Parallel.readHeaderPositions(headerRow)
+        #Aggregate queries count rows from this, without decompressing the block
+        if rowCount is not None:
+            segmentMetadata['rowCount'] = rowCount
+        #Statistics of each column are keyed by its position, like columnar columns, values missing from a short row are empty
+        if len(workerSettings['statisticsColumns']) != 0:
+            segmentMetadata['stats'] = {str(columnPosition): Statistics.getColumnStatistics([row[columnPosition] if columnPosition < len(row) else '' \
+                                                                                               for row in rows]) \
+                                        for columnPosition in workerSettings['statisticsPositions']}
+
+        if workerSettings['layout'] == 'columnar':
+            return Parallel.compressColumnarSegment(tag, rows, segmentMetadata, serializeStart)
+
+        compressStart = time.perf_counter()
+        runMetrics.recordStage('serialize', compressStart - serializeStart, bytesIn = len(dataToCompress), bytesOut = len(dataToCompress), \
+                               rows = rowCount or 0, blocks = 1)
+        compressedFields = {'compressedObject': Codec.compress(dataToCompress, workerSettings['algToUse'], workerSettings['compressionLevel'], \
+                                                           workerSettings['dictionary'])}
+        runMetrics.recordStage('compress', time.perf_counter() - compressStart, bytesIn = len(dataToCompress), \
+                               bytesOut = len(compressedFields['compressedObject']), blocks = 1)
+        return Storage.buildSegmentDocument(compressedFields, tag, workerSettings['mongoFieldNames'], segmentMetadata)
+
+    #Function puts the rows of a segment's last block, from an earlier run, in front of the rows of its first block in this run
+    #Only when both fit in one block, the earlier block is deleted once this one is written
+    #Returns the rows, and the number of rows merged in, None if the earlier block did not store it
+    def mergeLastBlock(tag, rawRows, headerRow):
+        mongoObject = workerSettings['mongoObject']
+        lastBlock = mongoObject.findLastBlock(workerSettings['mongoFieldNames'], tag, workerSettings['firstBlockNumber'])
+        #Blocks written before the original row bytes, or the algorithm, were stored are left as they are
+        if lastBlock is None or lastBlock.get('formatVersion', 1) not in [SEGMENT_FORMAT_VERSION, COLUMNAR_FORMAT_VERSION] or 'codec' not in lastBlock:
+            return rawRows, 0
+        #uncompressedSize is counted in UTF-8 bytes, the rows are counted the same way
+        if lastBlock['uncompressedSize'] + sum(len(rawRow.encode("utf-8")) for rawRow in rawRows) > workerSettings['mergeBlockSize']:
+            return rawRows, 0
+
+        dictionary = None
+        if 'dictionaryId' in lastBlock:
+            dictionary = workerSettings['dictionary']
+            #Block was compressed with the dictionary of an earlier run
+            if lastBlock['dictionaryId'] != workerSettings['dictionaryId']:
+                dictionary = mongoObject.readCollectionMetadata()['dictionaries'][lastBlock['dictionaryId']]
+
+        if lastBlock['formatVersion'] == COLUMNAR_FORMAT_VERSION:
+            Parallel.readHeaderPositions(headerRow)
+            headerText = headerRow.decode("utf-8")
+            tagValues = dict(zip(workerSettings['tagPositions'], tag))
+            columnValues = {int(columnPosition): Columnar.decodeColumn(Codec.decompress(compressedColumn, lastBlock['codec'], dictionary)) \
+                            for columnPosition, compressedColumn in lastBlock['columns'].items()}
+            rowLengths = None
+            if 'rowLengths' in lastBlock:
+                rowLengths = Columnar.decodeColumn(Codec.decompress(lastBlock['rowLengths'], lastBlock['codec'], dictionary))
+            lastBlockBytes = Columnar.decodeBlock(columnValues, tagValues, lastBlock['rowCount'], range(lastBlock['columnCount']), rowLengths, \
+                                                  headerText[len(headerText.rstrip('\r\n')):] or '\n', [])
         else:
-            compressedStream = zlib.compress(dataToCompress)
+            lastBlockBytes = Codec.decompress(lastBlock['compressedObject'], lastBlock['codec'], dictionary)
+
+        workerSettings['mergedDocumentIds'].append(lastBlock['_id'])
+        runMetrics.printVerbose(SEGMENT_VERBOSITY, 'Merging segment', list(tag), 'block', lastBlock['blockNumber'], 'into its first block of this run')
+        return [lastBlockBytes.decode("utf-8")] + rawRows, lastBlock.get('rowCount')
+
+    #Function compresses one block of a segment in the columnar layout, every column is encoded and compressed on its own
+    #serializeStart is when work on the block's rows started, encoding the columns is part of serializing them
+    def compressColumnarSegment(tag, rows, segmentMetadata, serializeStart):
+        algToUse = workerSettings['algToUse']
+        compressionLevel = workerSettings['compressionLevel']
+        dictionary = workerSettings['dictionary']
+        columnStreams, rowLengths, columnCount = Columnar.encodeBlock(rows, workerSettings['tagPositions'])
+        encodedBytes = sum(len(columnStream) for columnStream in columnStreams.values()) + (len(rowLengths) if rowLengths is not None else 0)
+
+        compressStart = time.perf_counter()
+        runMetrics.recordStage('serialize', compressStart - serializeStart, bytesIn = segmentMetadata['uncompressedSize'], bytesOut = encodedBytes, \
+                               rows = len(rows), blocks = 1)
+        #Column positions are the keys, so a single column can be fetched from Mongo Db with a projection
+        compressedFields = {'columns': {str(columnPosition): Codec.compress(columnStream, algToUse, compressionLevel, dictionary) \
+                                        for columnPosition, columnStream in columnStreams.items()}}
+        if rowLengths is not None:
+            compressedFields['rowLengths'] = Codec.compress(rowLengths, algToUse, compressionLevel, dictionary)
+        runMetrics.recordStage('compress', time.perf_counter() - compressStart, bytesIn = encodedBytes, \
+                               bytesOut = Storage.getCompressedSize(compressedFields), blocks = 1)
+        segmentMetadata['formatVersion'] = COLUMNAR_FORMAT_VERSION
+        segmentMetadata['columnCount'] = columnCount
 
-        #Writing compressed object, and some other metadata to Mongo Db instance
-        mongoConnectionObject.writeToDatabase(compressedStream, tag, mongoFieldNames)
+        return Storage.buildSegmentDocument(compressedFields, tag, workerSettings['mongoFieldNames'], segmentMetadata)
 
-    #Function decompresses a segment
+    #Function finds the positions of the fields segments are broken up on, and of the columns to keep statistics on, in the header row
+    #Worked out once per worker, not once per segment
+    def readHeaderPositions(headerRow):
+        if workerSettings.get('positionsHeaderRow') != headerRow:
+            headerFields = Table.getHeaderFields(headerRow)
+            workerSettings['tagPositions'] = Table.findAttributeInHeaderRow(headerFields, workerSettings['mongoFieldNames'])
+            workerSettings['statisticsPositions'] = Table.findAttributeInHeaderRow(headerFields, workerSettings['statisticsColumns'])
+            workerSettings['positionsHeaderRow'] = headerRow
+
+    #Function runs once in every decompression Pool worker, before any segment is decompressed
+    #querySettings hold what is needed to rebuild columnar segments, the positions of the tag fields in the header row and its line
+    #terminator, the positions of the columns to write out, None writes every column, the predicates rows have to match
+    #the collection's preset dictionaries, keyed by id, loaded once per worker, and the segment cache, None when there is none
+    #When aggregate is True, each segment is turned into partial aggregates of its one output column, no rows are handed back
+    #A Pool shared by many queries is started with no query settings, each task brings its query's settings with it
+    def initializeDecompressionWorker(querySettings, verbosity):
+        runMetrics.reset(verbosity)
+        workerSettings.update(querySettings)
+
+    #Function decompresses a segment, returns the bytes to write to the output file, or its partial aggregates
     def decompressionParallelized(chunk):
         #Unpacking tuple, passed in through Pool iterator
-        sharedList = chunk[1]
-        dataToDecompress = chunk[0]
-        algToUse = chunk[2]
-        tag = chunk[3]
-
-        print('Decompressing segment:', tag)
-
-        #Decompressing according to user input
-        if algToUse == 'bzip2':
-            compressedStream = bz2.decompress(dataToDecompress)
-        elif algToUse == 'gzip':
-            compressedStream = gzip.decompress(dataToDecompress)
-        elif algToUse == 'xz':
-            compressedStream = lzma.decompress(dataToDecompress)
+        subsegment = chunk[0]
+        uncompressedSize = chunk[1]
+        tag = chunk[2]
+        #Task from a query on a Pool shared by many queries, its settings replace those of the last query the worker ran
+        if len(chunk) > 3:
+            workerSettings.update(chunk[3])
+        segmentCache = workerSettings['segmentCache']
+
+        #Block's aggregates were worked out from its statistics, nothing was fetched for it
+        if 'partial' in subsegment:
+            return (Parallel.getGroupedPartial(subsegment, subsegment['partial']), uncompressedSize, tag)
+
+        #Block is in the segment cache, its rows are read from local disk, nothing was fetched for it
+        if subsegment.get('cached', False):
+            readStart = time.perf_counter()
+            csvBytes = segmentCache.readSegment(subsegment['cacheKey'])
+            if csvBytes is None:
+                raise ValueError('Segment ' + tag + ' was evicted from the cache while it was being read, run again')
+            runMetrics.printVerbose(SEGMENT_VERBOSITY, 'Reading cached segment:', tag)
+            cachedBytes = len(csvBytes)
+            csvBytes = Parallel.projectSegmentBytes(csvBytes, workerSettings['outputColumns'], workerSettings['rowPredicates'])
+            runMetrics.recordStage('cacheRead', time.perf_counter() - readStart, bytesIn = cachedBytes, bytesOut = len(csvBytes), blocks = 1)
         else:
-            compressedStream = zlib.decompress(dataToDecompress)
+            csvBytes = Parallel.decompressFetchedSegment(subsegment, tag)
+
+        if workerSettings['aggregate']:
+            aggregateStart = time.perf_counter()
+            values = [row[0] if len(row) != 0 else '' for row in csv.reader(io.StringIO(csvBytes.decode("utf-8"), newline = ''), delimiter = ',')]
+            partial = Statistics.getAggregatePartial(values)
+            runMetrics.recordStage('aggregate', time.perf_counter() - aggregateStart, bytesIn = len(csvBytes), rows = len(values), blocks = 1)
+            return (Parallel.getGroupedPartial(subsegment, partial), uncompressedSize, tag)
+        #Returned straight to the writer in Smart Compress through the Pool, with the window room it took
+        return (csvBytes, uncompressedSize, tag)
+
+    #Function returns partial aggregates with the values of the lookup fields of the segment they are from, their group
+    def getGroupedPartial(subsegment, partial):
+        partial['group'] = [subsegment[field] for field in workerSettings['lookupFields']]
+        return partial
+
+    #Function decompresses a segment fetched from the store, returns the bytes to write to the output file
+    def decompressFetchedSegment(subsegment, tag):
+        segmentCache = workerSettings['segmentCache']
+        #Segments written before the algorithm was stored with them use the algorithm the user gave
+        algToUse = subsegment.get('codec', workerSettings['algToUse'])
+        if algToUse is None:
+            raise ValueError('Segment ' + tag + ' has no compression algorithm stored with it, provide it with -a, --algorithm')
+        #Segments written before the payload format was versioned have no 'formatVersion', they are version 1
+        formatVersion = subsegment.get('formatVersion', 1)
+        dictionary = None
+        if 'dictionaryId' in subsegment:
+            if subsegment['dictionaryId'] not in workerSettings['dictionaries']:
+                raise ValueError('Segment ' + tag + " was compressed with dictionary '" + subsegment['dictionaryId'] + \
+                                 "', which is not in the collection's metadata document")
+            dictionary = workerSettings['dictionaries'][subsegment['dictionaryId']]
+
+        runMetrics.printVerbose(SEGMENT_VERBOSITY, 'Decompressing segment:', tag)
+        decompressStart = time.perf_counter()
+        compressedBytes = Storage.getCompressedSize(subsegment)
+
+        #A block going into the segment cache is decompressed whole, so a later query for other columns or rows can use it too
+        if 'cacheKey' in subsegment:
+            csvBytes = Parallel.decompressSegment(subsegment, algToUse, dictionary, formatVersion, None, [])
+            cacheStart = time.perf_counter()
+            runMetrics.recordStage('decompress', cacheStart - decompressStart, bytesIn = compressedBytes, bytesOut = len(csvBytes), blocks = 1)
+            segmentCache.writeSegment(subsegment['cacheKey'], csvBytes)
+            runMetrics.recordStage('cacheWrite', time.perf_counter() - cacheStart, bytesIn = len(csvBytes), blocks = 1)
+            return Parallel.projectSegmentBytes(csvBytes, workerSettings['outputColumns'], workerSettings['rowPredicates'])
+
+        csvBytes = Parallel.decompressSegment(subsegment, algToUse, dictionary, formatVersion, workerSettings['outputColumns'], \
+                                              workerSettings['rowPredicates'])
+        runMetrics.recordStage('decompress', time.perf_counter() - decompressStart, bytesIn = compressedBytes, bytesOut = len(csvBytes), blocks = 1)
+        return csvBytes
+
+    #Function decompresses a segment into CSV bytes, only the given columns, None is every column, and only rows matching rowPredicates
+    def decompressSegment(subsegment, algToUse, dictionary, formatVersion, outputColumns, rowPredicates):
+        if formatVersion == COLUMNAR_FORMAT_VERSION:
+            return Parallel.decompressColumnarSegment(subsegment, algToUse, dictionary, outputColumns, rowPredicates)
+
+        csvBytes = Parallel.getCsvBytesFromSegment(Codec.decompress(subsegment['compressedObject'], algToUse, dictionary), formatVersion)
+        #Row segments hold every column, the requested columns, and matching rows, are picked out of the decompressed rows
+        return Parallel.projectSegmentBytes(csvBytes, outputColumns, rowPredicates)
+
+    #Function picks the requested columns, and matching rows, out of a segment's CSV bytes, returned as they are when there are neither
+    def projectSegmentBytes(csvBytes, outputColumns, rowPredicates):
+        if outputColumns is None and len(rowPredicates) == 0:
+            return csvBytes
+        return Columnar.projectCsvBytes(csvBytes, outputColumns, workerSettings['lineTerminator'], rowPredicates)
+
+    #Function decompresses and decodes the columns of a columnar segment, putting the tag columns back from the document
+    #When only some columns are written out, only those were fetched, so only those are decompressed
+    def decompressColumnarSegment(subsegment, algToUse, dictionary, outputColumns, rowPredicates):
+        tagValues = {tagPosition: subsegment[field] for tagPosition, field in zip(workerSettings['tagPositions'], workerSettings['lookupFields'])}
+        columnValues = {int(columnPosition): Columnar.decodeColumn(Codec.decompress(compressedColumn, algToUse, dictionary)) \
+                        for columnPosition, compressedColumn in subsegment.get('columns', {}).items()}
+        columnPositions = outputColumns
+        rowLengths = None
+        if columnPositions is None:
+            columnPositions = range(subsegment['columnCount'])
+            if 'rowLengths' in subsegment:
+                rowLengths = Columnar.decodeColumn(Codec.decompress(subsegment['rowLengths'], algToUse, dictionary))
+
+        return Columnar.decodeBlock(columnValues, tagValues, subsegment['rowCount'], columnPositions, rowLengths, \
+                                    workerSettings['lineTerminator'], rowPredicates)
+
+    #Function turns a decompressed segment into the bytes to write to the output file
+    def getCsvBytesFromSegment(decompressedStream, formatVersion):
+        #Current format already holds the original CSV row bytes
+        if formatVersion >= 2:
+            return decompressedStream
+
+        #Version 1 segments hold the Python repr of a list of rows, which has to be parsed and written back out as CSV
+        outputBuffer = io.StringIO()
+        writer = csv.writer(outputBuffer, delimiter = ',')
+        for row in ast.literal_eval(decompressedStream.decode("utf-8")):
+            writer.writerow(row)
 
-        #Passing decompressed string to multiprocessing shared list
-        #Write function in thread of Smart Compress has access to this list
-        sharedList.append((compressedStream, tag))
+        return outputBuffer.getvalue().encode("utf-8")
@@ -1,10 +1,26 @@
 #!/usr/bin/python3
-import ast
-import sys
+import io
 import csv
-import threading
+import sys
+import time
+import itertools
+import collections
 import multiprocessing
-from compression_library import Parallel
+from compression_library import Parallel, Table, DECOMPRESSION_WORKER_STAGES
+from storage_library import Storage
+from statistics_library import Statistics
+from pipeline_library import InFlightWindow
+from metrics_library import runMetrics, InstrumentedTask, SEGMENT_VERBOSITY
+
+#Fields every segment document has, they do not identify the segment
+SEGMENT_DOCUMENT_FIELDS = ['_id', 'compressedObject', 'formatVersion', 'headerRow', 'uncompressedSize', 'blockNumber', 'columns', \
+                           'rowLengths', 'rowCount', 'columnCount', 'stats', 'codec', 'level', 'dictionaryId', \
+                           'blockHash']
+#Default number of segments, and of decompressed bytes, handed to the Pool that have not yet been written to the output file
+DEFAULT_IN_FLIGHT_WINDOW = (multiprocessing.cpu_count() + 1) * 4
+DEFAULT_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+#Segments written before the uncompressed size was stored are assumed to decompress to this many times their compressed size
+LEGACY_COMPRESSION_RATIO_ESTIMATE = 4
 
 class Decompression:
     def __init__(self, outputFileName, columnsToReconstructOn, whichCompressionAlgToUse):
@@ -13,6 +29,20 @@ class Decompression:
         self.whichCompressionAlgToUse = whichCompressionAlgToUse
 
         self.segments = None
+        self.headerRow = None
+        self.lookupFields = None
+        self.metadata = None
+        self.dictionaries = {}
+        self.outputColumns = None
+        self.outputHeaderRow = None
+        self.rowPredicates = []
+        self.inFlightWindow = DEFAULT_IN_FLIGHT_WINDOW
+        self.inFlightBytes = DEFAULT_IN_FLIGHT_BYTES
+        self.inFlightSegments = None
+        self.segmentCache = None
+        self.aggregateFunctions = None
+        self.aggregateColumn = None
+        self.statisticsPartialCount = 0
 
     #Function checks output file name to see if it is valid
     def checkValidOutputFileName(self):
@@ -39,62 +69,335 @@ class Decompression:
         if len(self.fileName.split('\x00')) > 1:
             sys.exit("Output filename contains NULL character, program terminating")
 
+    #Function reads the lookup fields and header row from the collection's metadata document
+    #Collections written before the metadata document was stored have neither, they are found from the segments themselves
+    def applyCollectionMetadata(self, metadata):
+        self.metadata = metadata
+        if metadata is not None:
+            self.lookupFields = metadata['lookupFields']
+            self.headerRow = metadata.get('headerRow')
+            #Preset dictionaries segments were compressed with, keyed by id, each is only a few KB
+            self.dictionaries = metadata.get('dictionaries', {})
+
+    #Function returns the fields of the header row recorded in the collection's metadata
+    def getHeaderFields(self):
+        if self.headerRow is None:
+            sys.exit('Collection has no header row recorded, so columns cannot be picked out, program terminating')
+
+        return Table.getHeaderFields(self.headerRow)
+
+    #Function finds the positions of the columns to write out, in the header row recorded in the collection's metadata
+    #The header row written to the output file is narrowed to those columns
+    def applyColumnProjection(self, outputColumnNames):
+        self.outputColumns = Table.findAttributeInHeaderRow(self.getHeaderFields(), outputColumnNames)
+        headerText = self.headerRow.decode("utf-8")
+
+        outputBuffer = io.StringIO()
+        lineTerminator = headerText[len(headerText.rstrip('\r\n')):] or '\n'
+        csv.writer(outputBuffer, delimiter = ',', lineterminator = lineTerminator).writerow(outputColumnNames)
+        self.outputHeaderRow = outputBuffer.getvalue().encode("utf-8")
+
+    #Function turns COLUMN<OPERATOR>VALUE predicates into predicates on column positions, only rows matching all of them are written
+    def applyRowPredicates(self, predicateStrings):
+        predicates = Statistics.parsePredicates(predicateStrings)
+        columnPositions = Table.findAttributeInHeaderRow(self.getHeaderFields(), [predicate[0] for predicate in predicates])
+
+        self.rowPredicates = [(columnPosition,) + predicate[1:] for columnPosition, predicate in zip(columnPositions, predicates)]
+
+    #Function returns the positions of the columns to fetch from columnar segments, None fetches every column
+    #Predicate columns are fetched too, to check rows against, even when they are not written out
+    def getFetchColumns(self):
+        if self.outputColumns is None:
+            return None
+        return sorted(set(self.outputColumns + [rowPredicate[0] for rowPredicate in self.rowPredicates]))
+
+    #Function sets the aggregates to compute, grouped by the lookup fields, instead of writing rows, over the column named columnName
+    #The column is the only one decompressed, count alone needs no column, it decompresses the first lookup field's column
+    def applyAggregates(self, aggregateFunctions, columnName):
+        if self.metadata is None:
+            sys.exit('Collection was compressed before its fields and header row were recorded, so it cannot be aggregated, program terminating')
+        if columnName is None and aggregateFunctions != ['count'] * len(aggregateFunctions):
+            sys.exit('Aggregates other than count require a column, --aggregate-column, program terminating')
+
+        self.aggregateFunctions = aggregateFunctions
+        if columnName is not None:
+            self.aggregateColumn = Table.findAttributeInHeaderRow(self.getHeaderFields(), [columnName])[0]
+            self.outputColumns = [self.aggregateColumn]
+        else:
+            self.outputColumns = [self.getColumnarLayout()[0][0]]
+
+        #Header row of the output file, the lookup fields, then each aggregate, with the column it is over
+        columnLabel = '(' + columnName + ')' if columnName is not None else ''
+        outputBuffer = io.StringIO()
+        csv.writer(outputBuffer, delimiter = ',', lineterminator = self.getColumnarLayout()[1]).writerow(self.lookupFields + \
+            [aggregateFunction + (columnLabel if aggregateFunction != 'count' else '') for aggregateFunction in aggregateFunctions])
+        self.outputHeaderRow = outputBuffer.getvalue().encode("utf-8")
+
     #For each segment returned by the query, function finds idenfifying field names
     def getTagFromSubsegment(self, subsegment):
         tagString = '['
 
-        #Ignoring '_id' and 'compressedObject' since every segment has them, not unique
+        if self.lookupFields is not None:
+            tagString += ', '.join(field + ': ' + str(subsegment[field]) for field in self.lookupFields)
+            #Segments written before they were split into blocks have no block number
+            if 'blockNumber' in subsegment:
+                tagString += ', block: ' + str(subsegment['blockNumber'])
+            return tagString + ']'
+
+        #Ignoring '_id', 'compressedObject' and payload metadata since every segment has them, not unique
         for key, value in subsegment.items():
-            if not ((str(key) == 'compressedObject') or (str(key) == '_id')):
+            if str(key) not in SEGMENT_DOCUMENT_FIELDS:
                 tagString += str(key) + ': ' + str(value) + ', '
 
         #Getting rid of last comma
         tagString = tagString[:-2] + ']'
         return tagString
     
-    #Function launches multiprocessing Pool to decompress in parallel and a thread to write in parallel
+    #Function launches multiprocessing Pool to decompress in parallel, and writes each segment as soon as it is decompressed
+    #Segments are decompressed as the query cursor returns them, so only the in flight window of segments is ever held in memory
     def decompressAndCombineInParallel(self): 
-        #Shared list allows decompressed results to come back into Smart Compress from child processes
-        sharedList = multiprocessing.Manager().list()
-    
-        #For all the segments returned by the query, making tuple of info for each one
-        #Each tuple will be passed into the Pool
-        compressedList = [(subsegment['compressedObject'], sharedList, self.whichCompressionAlgToUse, \
-                          self.getTagFromSubsegment(subsegment)) for subsegment in self.segments]
+        #Each segment handed to the Pool takes room in the window, it is given back once the segment is written
+        #When the output file falls behind, no more segments are handed out, so the workers wait on the writer
+        self.inFlightSegments = InFlightWindow(self.inFlightWindow, self.inFlightBytes, 'decompressWindow')
+        #Header row is read from the first segment before the Pool starts pulling segments from the cursor, if metadata did not have it
+        if self.headerRow is None:
+            self.headerRow = self.getHeaderRow()
        
         cpuCores = multiprocessing.cpu_count()
+        runMetrics.setConcurrency(DECOMPRESSION_WORKER_STAGES, cpuCores + 1)
         #Pool is created on # of system cores + 1 for performance
-        poolDecompress = multiprocessing.Pool(cpuCores + 1)
-        #Shared list is passed into thread for writing, as decompressed results come available, they are written
-        writeThread = threading.Thread(target=self.writeOutputToCsv, args=(sharedList,))
+        poolDecompress = multiprocessing.Pool(cpuCores + 1, initializer = Parallel.initializeDecompressionWorker, \
+                                              initargs = (self.getQuerySettings(), runMetrics.verbosity))
     
-        print("Decompressing in parallel using '" + self.whichCompressionAlgToUse + "' algorithm") 
+        print("Decompressing in parallel using the algorithm stored with each segment") 
      
-        writeThread.start()
-        poolDecompress.map(Parallel.decompressionParallelized, compressedList)
-        #'KILL' signal kills thread
-        sharedList.append('KILL')
-    
-    #Function writes uncompressed segments to an output file
-    def writeOutputToCsv(self, uncompressedList):
-        #Opening output file, writing CSV
-        with open(self.fileName, 'w') as openOutputFile:
-            writer = csv.writer(openOutputFile, delimiter = ',')
+        #imap pulls tasks from the generator as window room frees up, and hands back segments in the order the query returned them
+        #so the blocks of a segment are written in order, a finished block waits, holding its window room, for the blocks before it
+        try:
+            if self.aggregateFunctions is not None:
+                #Order does not matter to aggregates, partials are merged as soon as any worker hands them back
+                self.writeAggregatesToCsv(runMetrics.collectResults(poolDecompress.imap_unordered(InstrumentedTask(Parallel.decompressionParallelized), \
+                                                                                                  self.getDecompressionTasks())))
+            else:
+                self.writeOutputToCsv(runMetrics.collectResults(poolDecompress.imap(InstrumentedTask(Parallel.decompressionParallelized), \
+                                                                                    self.getDecompressionTasks())))
+        #A segment's algorithm is not known, or not registered
+        except ValueError as error:
+            poolDecompress.terminate()
+            sys.exit(str(error) + ', program terminating')
+        poolDecompress.close()
+        poolDecompress.join()
+
+    #Function decompresses the query on a Pool shared with other queries, and writes it, in order, to an open binary stream
+    #Used by the service, whose Pool is started once and kept warm, a segment's task brings the query's settings with it
+    #A query whose segment cannot be decompressed raises ValueError, the shared Pool is left running for the other queries
+    def decompressWithSharedPool(self, pool, outputStream):
+        if self.headerRow is None:
+            self.headerRow = self.getHeaderRow()
+
+        if self.aggregateFunctions is not None:
+            self.writeAggregates(outputStream, self.getSharedPoolResults(pool))
+        else:
+            self.writeSegments(outputStream, self.getSharedPoolResults(pool))
+
+    #Function yields the decompressed segments of the query, in order, handing them to a shared Pool one task at a time
+    #imap would pull the tasks from the Pool's one feeder thread, which would stop feeding every other query while this one
+    #waited on room in its window, so here the window is a queue of pending results, filled from the calling thread
+    #A segment larger than the whole byte limit is still handed out once the queue is empty, so it cannot block forever
+    #If the caller stops reading, because the stream was closed, the pending segments finish in the Pool and are dropped
+    def getSharedPoolResults(self, pool):
+        pendingResults = collections.deque()
+        pendingBytes = 0
+        tasks = self.getDecompressionTasks(True)
+        task = next(tasks, None)
+
+        while task is not None or len(pendingResults) != 0:
+            while task is not None and (len(pendingResults) == 0 or (len(pendingResults) < self.inFlightWindow and \
+                                                                    pendingBytes + task[1] <= self.inFlightBytes)):
+                pendingResults.append(pool.apply_async(InstrumentedTask(Parallel.decompressionParallelized), (task,)))
+                pendingBytes += task[1]
+                task = next(tasks, None)
+
+            #Blocks until the oldest pending segment is decompressed, so segments are written in the order the query returned them
+            result, delta = pendingResults.popleft().get()
+            runMetrics.mergeDelta(delta)
+            pendingBytes -= result[1]
+            yield result
+
+    #Function returns the segments of the query, fetching only what is needed for each block
+    #The query first returns only the lookup fields, '_id', hash, row count and statistics of each block, without compressed bytes
+    #Aggregates a block's statistics can answer are worked out from them, blocks in the segment cache are read from local disk
+    #Only the other blocks are fetched, a batch at a time, in one query, those going into the cache are fetched whole
+    #Blocks come back in the order the query returned them, so each segment's blocks are still in order
+    def retrieveListedSegments(self, mongoObject, cursorBatchSize):
+        #Query is sent here, not when the Pool first pulls a segment, so a query with no results terminates straight away
+        blockListing = mongoObject.retrieveSegmentsFromDatabase(self.columnsToReconstructOn, cursorBatchSize, self.metadata, None, \
+                                                                self.rowPredicates, False)
+        return self.getListedSegments(mongoObject, blockListing, cursorBatchSize)
+
+    #Function yields the blocks of the query, in order, a batch at a time, those that do not need fetching as they are, the rest fetched
+    def getListedSegments(self, mongoObject, blockListing, cursorBatchSize):
+        #Blocks not going into the cache only need the columns written out, or aggregated
+        fetchColumns = self.getFetchColumns() if self.segmentCache is None else None
+
+        while True:
+            blocks = list(itertools.islice(blockListing, cursorBatchSize))
+            if len(blocks) == 0:
+                break
+
+            missingIds = []
+            for block in blocks:
+                #Statistics only describe every row of a block, with predicates they cannot answer for the matching rows
+                if self.aggregateFunctions is not None and len(self.rowPredicates) == 0:
+                    partial = Statistics.getStatisticsPartial(block, self.aggregateColumn, self.aggregateFunctions)
+                    if partial is not None:
+                        block['partial'] = partial
+                        self.statisticsPartialCount += 1
+                        continue
+                if self.segmentCache is not None:
+                    block['cacheKey'] = self.segmentCache.getKey(block)
+                    block['cached'] = self.segmentCache.touchSegment(block['cacheKey'])
+                    if block['cached']:
+                        continue
+                missingIds.append(block['_id'])
+
+            fetchedSegments = {}
+            if len(missingIds) != 0:
+                fetchedSegments = {segment['_id']: segment for segment in mongoObject.retrieveSegmentsByIds(missingIds, self.metadata, fetchColumns)}
+
+            for block in blocks:
+                if 'partial' in block or block.get('cached', False):
+                    yield block
+                    continue
+                #Block was deleted between the two queries, by a run appending to, or refreshing, the collection
+                #Pulled by the Pool, the error is raised where the Pool hands back segments, which terminates
+                if block['_id'] not in fetchedSegments:
+                    raise ValueError('Collection changed while it was being read, run again')
+                segment = fetchedSegments[block['_id']]
+                if 'cacheKey' in block:
+                    segment['cacheKey'] = block['cacheKey']
+                yield segment
+
+    #Function returns the positions of the lookup fields in the header row, and the header row's line terminator
+    #Columnar segments leave the lookup field columns out, they are put back at these positions, rows end in this terminator
+    def getColumnarLayout(self):
+        #Collections written before the header row was stored in metadata have no columnar segments
+        if self.headerRow is None or self.lookupFields is None:
+            return ([], '\n')
+
+        headerText = self.headerRow.decode("utf-8")
+        headerFields = next(csv.reader(io.StringIO(headerText, newline = ''), delimiter = ','))
+        lineTerminator = headerText[len(headerText.rstrip('\r\n')):] or '\n'
+
+        return (Table.findAttributeInHeaderRow(headerFields, self.lookupFields), lineTerminator)
+
+    #Function returns what every Pool worker needs to decompress the query's segments, handed to the Pool's initializer
+    def getQuerySettings(self):
+        tagPositions, lineTerminator = self.getColumnarLayout()
+        return {'algToUse': self.whichCompressionAlgToUse, 'lookupFields': self.lookupFields, 'tagPositions': tagPositions, \
+                'lineTerminator': lineTerminator, 'outputColumns': self.outputColumns, 'rowPredicates': self.rowPredicates, \
+                'dictionaries': self.dictionaries, 'segmentCache': self.segmentCache, 'aggregate': self.aggregateFunctions is not None}
+
+    #Function returns the query settings handed to a shared Pool with one of the query's segments
+    #Only the preset dictionary the segment was compressed with is sent, not every dictionary of the collection
+    def getTaskSettings(self, querySettings, subsegment):
+        taskSettings = dict(querySettings)
+        dictionaryId = subsegment.get('dictionaryId')
+        taskSettings['dictionaries'] = {dictionaryId: self.dictionaries[dictionaryId]} if dictionaryId in self.dictionaries else {}
+        return taskSettings
+
+    #Function yields a tuple of info for each segment returned by the query, each tuple is passed into the Pool
+    #Blocks until there is room in the in flight window, so the cursor is only read as fast as segments are written
+    #Fetch stage is the time spent waiting on the query for each segment, including fetching batches of blocks by '_id'
+    #For a Pool shared by many queries, the query's settings are added to each tuple, and the caller bounds the segments in flight
+    def getDecompressionTasks(self, sharedPool = False):
+        querySettings = self.getQuerySettings() if sharedPool else None
+        segments = iter(self.segments)
+        while True:
+            fetchStart = time.perf_counter()
+            subsegment = next(segments, None)
+            if subsegment is None:
+                break
+            #Blocks answered from their statistics, or from the segment cache, were listed without their compressed bytes
+            fetchedBytes = Storage.getCompressedSize(subsegment) if 'compressedObject' in subsegment or 'columns' in subsegment else 0
+            runMetrics.recordStage('fetch', time.perf_counter() - fetchStart, bytesOut = fetchedBytes, blocks = 1)
+
+            #Room taken in the window is the size the segment will decompress to
+            if 'uncompressedSize' in subsegment:
+                uncompressedSize = subsegment['uncompressedSize']
+            else:
+                uncompressedSize = len(subsegment['compressedObject']) * LEGACY_COMPRESSION_RATIO_ESTIMATE
+            if sharedPool:
+                yield (subsegment, uncompressedSize, self.getTagFromSubsegment(subsegment), self.getTaskSettings(querySettings, subsegment))
+            else:
+                self.inFlightSegments.acquire(uncompressedSize)
+                yield (subsegment, uncompressedSize, self.getTagFromSubsegment(subsegment))
     
+    #Function returns the header row stored with the first segment, None if that segment predates the header being stored,
+    #or if the query returned no segments
+    def getHeaderRow(self):
+        firstSegment = next(self.segments, None)
+        if firstSegment is None:
+            return None
+        #Putting the first segment back in front of the rest of the cursor
+        self.segments = itertools.chain([firstSegment], self.segments)
+
+        return firstSegment.get('headerRow')
+
+    #Function merges the partial aggregates of every block of each group, as the Pool hands them back, then writes them to the output file
+    def writeAggregatesToCsv(self, blockPartials):
+        with open(self.fileName, 'wb') as openOutputFile:
+            self.writeAggregates(openOutputFile, blockPartials)
+
+    #Function merges the partial aggregates of every block of each group, then writes one row per group to an open binary stream
+    def writeAggregates(self, openOutputFile, blockPartials):
+        groupPartials = {}
+        blockCount = 0
+
+        #Blocks until the next block's partials are handed back, loop ends once every block has been handed back
+        for partial, uncompressedSize, tag in blockPartials:
+            group = tuple(partial['group'])
+            if group not in groupPartials:
+                groupPartials[group] = {'count': 0, 'numericCount': 0, 'sums': [], 'min': None, 'max': None}
+            Statistics.mergeAggregatePartials(groupPartials[group], partial)
+            blockCount += 1
+            #Block is counted, its room in the window can be handed to another block
+            if self.inFlightSegments is not None:
+                self.inFlightSegments.release(uncompressedSize)
+
+        print('Aggregated', blockCount, 'blocks,', self.statisticsPartialCount, 'from their statistics alone, into', len(groupPartials), 'groups')
+        if self.fileName is not None:
+            print("Writing aggregates to file '" + self.fileName + "'")
+        openOutputFile.write(self.outputHeaderRow)
+
+        outputBuffer = io.StringIO()
+        writer = csv.writer(outputBuffer, delimiter = ',', lineterminator = self.getColumnarLayout()[1])
+        for group in sorted(groupPartials):
+            writer.writerow(list(group) + [Statistics.getAggregateValue(groupPartials[group], aggregateFunction) \
+                                           for aggregateFunction in self.aggregateFunctions])
+        openOutputFile.write(outputBuffer.getvalue().encode("utf-8"))
+
+    #Function writes uncompressed segments to an output file, in order, as the Pool hands them back
+    def writeOutputToCsv(self, uncompressedSegments):
+        #Opening output file, segments are already in CSV format, so bytes are written straight through
+        with open(self.fileName, 'wb') as openOutputFile:
             print("Writing uncompressed output to file '" + self.fileName + "' in parallel with decompression")
+            self.writeSegments(openOutputFile, uncompressedSegments)
+
+    #Function writes the header row, then uncompressed segments, in order, to an open binary stream
+    def writeSegments(self, openOutputFile, uncompressedSegments):
+        #Header row is written once, at the top of the output, narrowed to the requested columns if there are any
+        if self.outputHeaderRow is not None:
+            openOutputFile.write(self.outputHeaderRow)
+        elif self.headerRow is not None:
+            openOutputFile.write(self.headerRow)
 
-            #Will run until receives 'KILL' signal
-            while True:
-                #Decompression may take a while, so it only writes when decompressed objects are in queue
-                if len(uncompressedList) != 0:
-                    if uncompressedList[0] == 'KILL':
-                        return
-                    else:
-                        print('Writing segment', uncompressedList[0][1], "to file '" + self.fileName + "'")
-                        #Decoding byte array to string, converting to list of rows
-                        csvRows = ast.literal_eval((uncompressedList[0][0].decode("utf-8")))
-                        #For each row, printing in CSV format
-                        for row in csvRows:
-                            writer.writerow(row)
-                        #Removing segment from shared list (shared queue)
-                        uncompressedList.pop(0)
+        #Blocks until the next segment is decompressed, loop ends once every segment has been handed back
+        for csvBytes, uncompressedSize, tag in uncompressedSegments:
+            runMetrics.printVerbose(SEGMENT_VERBOSITY, 'Writing segment', tag)
+            writeStart = time.perf_counter()
+            openOutputFile.write(csvBytes)
+            runMetrics.recordStage('outputWrite', time.perf_counter() - writeStart, bytesIn = len(csvBytes), blocks = 1)
+            #Segment is written, its room in the window can be handed to another segment
+            if self.inFlightSegments is not None:
+                self.inFlightSegments.release(uncompressedSize)
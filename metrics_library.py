@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+import os
+import json
+import time
+import tempfile
+import threading
+
+#Stages of a run, in the order rows go through them, compression first, then decompression
+#parse reads and segments CSV rows, spill writes them to partition files, serialize joins, hashes and encodes a block's rows
+#compress and decompress are the compression algorithm, write and fetch are the store, outputWrite is the output file
+STAGE_ORDER = ['parse', 'spill', 'serialize', 'compress', 'write', 'fetch', 'cacheRead', 'decompress', 'cacheWrite', 'aggregate', 'outputWrite']
+#Upper bounds of the latency histogram buckets, in seconds, a last bucket holds everything slower
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+#Default number of seconds between progress lines
+DEFAULT_PROGRESS_INTERVAL = 5.0
+#Verbosity levels, 0 prints what each step of the run is doing, 1 adds a progress line and a summary of every stage
+#2 adds a line for every segment written, read or decompressed
+DEFAULT_VERBOSITY = 1
+SEGMENT_VERBOSITY = 2
+METRICS_FORMATS = ['json', 'prometheus']
+#Prefix of every metric in a Prometheus textfile report
+PROMETHEUS_PREFIX = 'smartcompress_'
+
+class Metrics:
+    #Counters, latency histograms and queue depths of one run of Smart Compress, in one process
+    #Pool workers keep their own, every task hands back what it added, and Smart Compress merges it into its own
+    def __init__(self):
+        self.reset(DEFAULT_VERBOSITY)
+
+    #Function empties every measurement, Pool workers call it first, so they do not hand back what Smart Compress measured before the fork
+    def reset(self, verbosity):
+        #Lock is replaced, not reused, one held by another thread when the worker was forked would never be released
+        self.lock = threading.Lock()
+        self.verbosity = verbosity
+        self.startTime = time.perf_counter()
+        self.labels = {}
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.stageConcurrency = {}
+        self.progressStop = None
+        self.progressThread = None
+
+    #Function prints a message if the verbosity is at least level
+    def printVerbose(self, level, *message):
+        if self.verbosity >= level:
+            print(*message)
+
+    #Function returns an empty stage, buckets are not cumulative, the last holds everything slower than the last bound
+    def getEmptyStage():
+        return {'count': 0, 'seconds': 0.0, 'bytesIn': 0, 'bytesOut': 0, 'rows': 0, 'blocks': 0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+
+    #Function records one piece of work done by a stage, how long it took, the bytes it took in and handed on, and the rows or blocks in it
+    def recordStage(self, stageName, seconds, bytesIn = 0, bytesOut = 0, rows = 0, blocks = 0):
+        bucketIndex = 0
+        while bucketIndex < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucketIndex]:
+            bucketIndex += 1
+
+        with self.lock:
+            if stageName not in self.stages:
+                self.stages[stageName] = Metrics.getEmptyStage()
+            stage = self.stages[stageName]
+            stage['count'] += 1
+            stage['seconds'] += seconds
+            stage['bytesIn'] += bytesIn
+            stage['bytesOut'] += bytesOut
+            stage['rows'] += rows
+            stage['blocks'] += blocks
+            stage['buckets'][bucketIndex] += 1
+
+    #Function adds to a counter
+    def addCount(self, counterName, amount = 1):
+        with self.lock:
+            self.counters[counterName] = self.counters.get(counterName, 0) + amount
+
+    #Function sets the current depth of a queue, the deepest it has been is kept alongside
+    def setGauge(self, gaugeName, value):
+        with self.lock:
+            previousMaximum = self.gauges.get(gaugeName, {'maximum': value})['maximum']
+            self.gauges[gaugeName] = {'current': value, 'maximum': max(previousMaximum, value)}
+
+    #Function sets the number of processes that run the given stages at once, one unless set
+    def setConcurrency(self, stageNames, concurrency):
+        for stageName in stageNames:
+            self.stageConcurrency[stageName] = concurrency
+
+    #Function returns the stages and counters added since the last call, and empties them, called in a Pool worker after every task
+    def takeDelta(self):
+        with self.lock:
+            delta = {'stages': self.stages, 'counters': self.counters}
+            self.stages = {}
+            self.counters = {}
+        return delta
+
+    #Function adds the stages and counters handed back by a Pool worker
+    def mergeDelta(self, delta):
+        with self.lock:
+            for stageName, workerStage in delta['stages'].items():
+                if stageName not in self.stages:
+                    self.stages[stageName] = Metrics.getEmptyStage()
+                stage = self.stages[stageName]
+                for fieldName in ['count', 'seconds', 'bytesIn', 'bytesOut', 'rows', 'blocks']:
+                    stage[fieldName] += workerStage[fieldName]
+                stage['buckets'] = [bucketCount + workerCount for bucketCount, workerCount in zip(stage['buckets'], workerStage['buckets'])]
+            for counterName, amount in delta['counters'].items():
+                self.counters[counterName] = self.counters.get(counterName, 0) + amount
+
+    #Function yields the results of tasks run through InstrumentedTask, merging what each worker measured as it comes back
+    def collectResults(self, instrumentedResults):
+        for result, delta in instrumentedResults:
+            self.mergeDelta(delta)
+            yield result
+
+    #Function starts the run's clock, and, at verbosity 1 and above, a thread printing a progress line every interval seconds
+    def startRun(self, labels, progressInterval):
+        self.startTime = time.perf_counter()
+        self.labels = labels
+        if self.verbosity >= DEFAULT_VERBOSITY and progressInterval > 0:
+            self.progressStop = threading.Event()
+            self.progressThread = threading.Thread(target = self.printProgress, args = (progressInterval,), daemon = True)
+            self.progressThread.start()
+
+    #Function stops the progress line, once the run is done
+    def stopRun(self):
+        if self.progressThread is not None:
+            self.progressStop.set()
+            self.progressThread.join()
+            self.progressThread = None
+
+    #Function prints a progress line every interval seconds, until the run is stopped
+    def printProgress(self, progressInterval):
+        while not self.progressStop.wait(progressInterval):
+            print(self.getProgressLine(), flush = True)
+
+    #Function returns one line with the work done by every stage so far, and the depth of every queue
+    def getProgressLine(self):
+        with self.lock:
+            progressParts = []
+            for stageName in Metrics.getStageNames(self.stages):
+                stage = self.stages[stageName]
+                progressParts.append(stageName + ' ' + (str(stage['rows']) + ' rows' if stage['rows'] != 0 else str(stage['blocks']) + ' blocks') + \
+                                     ' %.1f MB' % (max(stage['bytesIn'], stage['bytesOut']) / (1024 * 1024)))
+            for gaugeName in sorted(self.gauges):
+                progressParts.append(gaugeName + ' ' + str(self.gauges[gaugeName]['current']))
+
+        return 'Progress, %.1f s: ' % (time.perf_counter() - self.startTime) + ', '.join(progressParts)
+
+    #Function returns the names of the stages that did any work, in the order rows go through them
+    def getStageNames(stages):
+        return [stageName for stageName in STAGE_ORDER if stageName in stages] + sorted(set(stages) - set(STAGE_ORDER))
+
+    #Function returns the latency below which the given fraction of a stage's work finished, the upper bound of its bucket
+    #None if the bucket is the last one, which has no upper bound
+    def getLatencyQuantile(stage, quantile):
+        target = quantile * stage['count']
+        seenCount = 0
+        for bucketIndex, bucketCount in enumerate(stage['buckets']):
+            seenCount += bucketCount
+            if seenCount >= target and bucketCount != 0:
+                return LATENCY_BUCKETS[bucketIndex] if bucketIndex < len(LATENCY_BUCKETS) else None
+        return None
+
+    #Function returns every measurement of the run, each stage with its throughput and how busy it kept the processes running it
+    #The busiest stage is the one bounding the run's throughput, the others spent part of the run waiting on it
+    def getReport(self):
+        with self.lock:
+            wallSeconds = time.perf_counter() - self.startTime
+            stages = {}
+            for stageName in Metrics.getStageNames(self.stages):
+                stage = dict(self.stages[stageName])
+                stage['concurrency'] = self.stageConcurrency.get(stageName, 1)
+                stage['utilization'] = stage['seconds'] / (wallSeconds * stage['concurrency']) if wallSeconds > 0 else 0
+                stage['mbPerSecond'] = max(stage['bytesIn'], stage['bytesOut']) / (1024 * 1024) / stage['seconds'] if stage['seconds'] > 0 else None
+                stage['p50Seconds'] = Metrics.getLatencyQuantile(stage, 0.5)
+                stage['p95Seconds'] = Metrics.getLatencyQuantile(stage, 0.95)
+                stage['p99Seconds'] = Metrics.getLatencyQuantile(stage, 0.99)
+                stages[stageName] = stage
+
+            return {'labels': dict(self.labels), 'wallSeconds': wallSeconds, 'latencyBuckets': LATENCY_BUCKETS, 'stages': stages, \
+                    'counters': dict(self.counters), 'gauges': {gaugeName: dict(gauge) for gaugeName, gauge in self.gauges.items()}, \
+                    'busiestStage': max(stages, key = lambda stageName: stages[stageName]['utilization']) if len(stages) != 0 else None}
+
+    #Function prints one line per stage, then the counters, the deepest each queue went, and the stage bounding throughput
+    def printSummary(self):
+        report = self.getReport()
+        print('Run took %.2f s' % report['wallSeconds'])
+        for stageName, stage in report['stages'].items():
+            print('  %-11s %8d calls %9.2f s %7.1f%% busy of %d %10.1f MB/s  p50 %s  p95 %s  %d rows %d blocks %d bytes in %d bytes out' % \
+                  (stageName, stage['count'], stage['seconds'], stage['utilization'] * 100, stage['concurrency'], stage['mbPerSecond'] or 0, \
+                   Metrics.formatLatency(stage['p50Seconds']), Metrics.formatLatency(stage['p95Seconds']), stage['rows'], stage['blocks'], \
+                   stage['bytesIn'], stage['bytesOut']))
+        for counterName in sorted(report['counters']):
+            print('  ' + counterName + ':', round(report['counters'][counterName], 3))
+        for gaugeName in sorted(report['gauges']):
+            print('  ' + gaugeName + ': deepest', report['gauges'][gaugeName]['maximum'])
+        if report['busiestStage'] is not None:
+            print("Busiest stage, bounding throughput: '" + report['busiestStage'] + "'")
+
+    #Function returns a latency as text, the last bucket has no upper bound
+    def formatLatency(seconds):
+        return '<=%gs' % seconds if seconds is not None else '>%gs' % LATENCY_BUCKETS[-1]
+
+    #Function returns the report in the Prometheus text format, for the node exporter's textfile collector
+    def getPrometheusText(self):
+        report = self.getReport()
+        labelText = ','.join(labelName + '="' + str(labelValue).replace('\\', '\\\\').replace('"', '\\"') + '"' \
+                             for labelName, labelValue in sorted(report['labels'].items()))
+        lines = []
+
+        #Function adds one sample, with the run's labels and any of its own
+        def addSample(metricName, value, extraLabels = ''):
+            labels = ','.join(labelPart for labelPart in [labelText, extraLabels] if labelPart != '')
+            lines.append(PROMETHEUS_PREFIX + metricName + ('{' + labels + '}' if labels != '' else '') + ' ' + repr(float(value)))
+
+        lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'run_seconds gauge')
+        addSample('run_seconds', report['wallSeconds'])
+        lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'stage_seconds histogram')
+        for stageName, stage in report['stages'].items():
+            cumulativeCount = 0
+            for bucketBound, bucketCount in zip(LATENCY_BUCKETS + ['+Inf'], stage['buckets']):
+                cumulativeCount += bucketCount
+                addSample('stage_seconds_bucket', cumulativeCount, 'stage="' + stageName + '",le="' + str(bucketBound) + '"')
+            addSample('stage_seconds_sum', stage['seconds'], 'stage="' + stageName + '"')
+            addSample('stage_seconds_count', stage['count'], 'stage="' + stageName + '"')
+        for fieldName, metricName in [('bytesIn', 'stage_bytes_in_total'), ('bytesOut', 'stage_bytes_out_total'), ('rows', 'stage_rows_total'), \
+                                      ('blocks', 'stage_blocks_total')]:
+            lines.append('# TYPE ' + PROMETHEUS_PREFIX + metricName + ' counter')
+            for stageName, stage in report['stages'].items():
+                addSample(metricName, stage[fieldName], 'stage="' + stageName + '"')
+        lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'stage_utilization gauge')
+        for stageName, stage in report['stages'].items():
+            addSample('stage_utilization', stage['utilization'], 'stage="' + stageName + '"')
+        lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'counter_total counter')
+        for counterName in sorted(report['counters']):
+            addSample('counter_total', report['counters'][counterName], 'counter="' + counterName + '"')
+        lines.append('# TYPE ' + PROMETHEUS_PREFIX + 'queue_depth_max gauge')
+        for gaugeName in sorted(report['gauges']):
+            addSample('queue_depth_max', report['gauges'][gaugeName]['maximum'], 'queue="' + gaugeName + '"')
+
+        return '\n'.join(lines) + '\n'
+
+    #Function writes the report to a file, through a temporary file, so a collector never reads half a report
+    def writeReport(self, fileName, reportFormat):
+        if reportFormat == 'prometheus':
+            reportText = self.getPrometheusText()
+        else:
+            reportText = json.dumps(self.getReport(), indent = 2, sort_keys = True) + '\n'
+
+        fileDescriptor, temporaryFileName = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(fileName)), suffix = '.tmp')
+        with os.fdopen(fileDescriptor, 'w') as openFile:
+            openFile.write(reportText)
+        os.replace(temporaryFileName, fileName)
+        self.printVerbose(DEFAULT_VERBOSITY, "Wrote run metrics to '" + fileName + "'")
+
+class InstrumentedTask:
+    #Pool task that runs a function, then hands back what the worker measured while running it, alongside its result
+    #Picklable, the function is pickled by its name, so it can be handed to Pool.map and Pool.imap like the function itself
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, chunk):
+        result = self.function(chunk)
+        return (result, runMetrics.takeDelta())
+
+#Measurements of this process's run, Pool workers empty theirs in their initializer
+runMetrics = Metrics()
@@ -1,70 +1,173 @@
 #!/usr/bin/python3
 import os
 import sys
-from pymongo import MongoClient, errors
+import time
+import threading
+import configparser
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument, errors
+from storage_library import Storage, DEFAULT_BATCH_COUNT, DEFAULT_CURSOR_BATCH_SIZE, LISTING_FIELDS
+
+#Collection, in the same database, holding one metadata document per segment collection, '_id' is the collection name
+METADATA_COLLECTION_NAME = 'smartCompressMetadata'
+#Fields of a segment document decompression needs, on top of the lookup fields
+SEGMENT_PROJECTION_FIELDS = ['compressedObject', 'formatVersion', 'uncompressedSize', 'blockNumber', 'columns', 'rowLengths', 'rowCount', \
+                             'columnCount', 'codec', 'dictionaryId']
+#Number of times a batch is written before giving up, when Mongo Db returns a transient error
+WRITE_RETRY_ATTEMPTS = 5
+#Connection string used when none is given, a Mongo Database on this machine, on the default port
+DEFAULT_CONNECTION_STRING = 'mongodb://localhost:27017'
+#Environment variable the connection string is read from, when it is not given with --connection
+CONNECTION_ENVIRONMENT_VARIABLE = 'SMART_COMPRESS_URI'
+#Section and option of a config file holding the connection string, [mongo] connection = <CONNECTION STRING>
+CONFIG_SECTION = 'mongo'
+CONFIG_CONNECTION_OPTION = 'connection'
+#Milliseconds to wait for the server to answer when checking the connection, before giving up on it
+CONNECTION_TIMEOUT_MS = 5000
+
+class Mongo(Storage):
+    #Clients shared by every Mongo object in a process, keyed by process id and connection string
+    clients = {}
+    clientLock = threading.Lock()
 
-class Mongo:
     def __init__(self, connectionString, databaseName, collectionName):
+        Storage.__init__(self, databaseName, collectionName)
         self.connectionString = connectionString
-        self.databaseName = databaseName
-        self.collectionName = collectionName
-
-    #Function ensures that user defined database and collection names are valid
-    def checkValidDbAndConnectionName(mongoDbName, mongoCollectionName):
-        #Illegal characters in a Mongo database name
-        invalidCharDbList = ['/',"\\",'.',' ','"','$']
-
-        #Database name has to be wrapped in two levels of quotes, single quotes, and inside them, double quotes
-        #This is done in an attempt to sanitize the data, though this can still be overcome by using 4 levels of quotes
-        if not ((mongoDbName[0] == '"') and (mongoDbName[-1] == '"')):
-            sys.exit('Database name must be wrapped in 2 levels of quotes, \'"<DB NAME>"\', \
-                      \nthe quotes will be removed automatically, program terminating')
-        else:
-            #Stripping away double quotes, single quotes are eaten by bash automatically
-            mongoDbName = mongoDbName[1:-1]
-    
-        #Python 'exec' function will be used later, pass cannot be present in this function
-        if (mongoDbName == 'pass') or (mongoCollectionName == 'pass'):
-            sys.exit("Database name or collection name cannot be 'pass', program terminating")
-        
-        #Collection name has to be wrapped in two levels of quotes, single quotes, and inside them, double quotes
-        #This is done in an attempt to sanitize the data, though this can still be overcome by using 4 levels of quotes
-        if not ((mongoCollectionName[0] == '"') and (mongoCollectionName[-1] == '"')):
-            sys.exit('Collection name must be wrapped in 2 levels of quotes, \'"<COLLECTION NAME>"\', \
-                      \nthe quotes will be removed automatically, program terminating')
-        else:
-            #Stripping away double quotes, single quotes are eaten by bash automatically
-            mongoCollectionName = mongoCollectionName[1:-1]
+        self.storeName = 'Mongo Database'
+        self.client = None
 
-        #Mongo Database will not allow database names to be over 63 characters
-        if len(mongoDbName) >= 64:
-            sys.exit('Length of database name is over 63 characters, program terminating')
+    #Function drops the client when the object is pickled into a Pool worker, each process makes its own connection
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['client'] = None
+        return state
 
-        #Making sure any character from list above ^, is not present
-        for invalidChar in invalidCharDbList:
-            if invalidChar in mongoDbName:
-                sys.exit("Invalid char: '" + invalidChar + "' in database name, program terminating")
+    #Function returns the client for a connection string, created once per process, shared by every Mongo object and thread in it
+    #MongoClient keeps its own pool of connections, and is not safe to use in a process forked after it was created,
+    #so the process id is part of the key, a Pool worker makes its own client rather than using its parent's
+    def getClient(connectionString):
+        clientKey = (os.getpid(), connectionString)
+        with Mongo.clientLock:
+            if clientKey not in Mongo.clients:
+                Mongo.clients[clientKey] = MongoClient(connectionString)
+            return Mongo.clients[clientKey]
 
-        #Only illegal character for collections is '$'
-        if '$' in mongoCollectionName:
-            sys.exit("Invalid char: '$' in collection name, program terminating")
-        
-        #Both collection and database names cannot be empty string
-        if mongoCollectionName == '':
-            sys.exit('Collection name cannot be empty string, program terminating')
-        if mongoDbName == '':
-            sys.exit('Database name cannot be empty string, program terminating') 
-    
-        #Collection name cannot start with 'system.'
-        if '.' in mongoCollectionName:
-            if mongoCollectionName.split('.')[0] == 'system':
-                sys.exit("Collection name cannot start with 'system.', program terminating")
+    #Function returns the collection segments are stored in
+    #The client is created once per process and reused, MongoClient keeps its own pool of connections
+    def getCollection(self):
+        if self.client is None:
+            self.client = Mongo.getClient(self.connectionString)
+
+        return self.client[self.databaseName][self.collectionName]
+
+    #Function connects to Mongo Db in a Pool worker, once, the connection is reused for every batch the worker writes
+    def connect(self):
+        self.getCollection()
+
+    #Function returns the collection holding the metadata document of every segment collection in the database
+    def getMetadataCollection(self):
+        self.getCollection()
+        return self.client[self.databaseName][METADATA_COLLECTION_NAME]
+
+    #Function returns the metadata document of the segment collection, None if the collection was written before it was stored
+    def readCollectionMetadata(self):
+        return self.getMetadataCollection().find_one({'_id': self.collectionName})
+
+    #Function returns True if the segment collection holds any segments
+    def hasSegments(self):
+        return self.getCollection().find_one({}, {'_id': 1}) is not None
+
+    #Function counts one more ingest run into the collection, in its metadata document, returns the run's number
+    #Counted atomically, so two runs appending at once never get the same number
+    def startIngestRun(self):
+        metadata = self.getMetadataCollection().find_one_and_update({'_id': self.collectionName}, {'$inc': {'ingestRuns': 1}}, \
+                                                                    return_document = ReturnDocument.AFTER)
+        return metadata['ingestRuns']
+
+    #Function returns the last block of a segment numbered before a block number, None if the segment has no such block
+    #Walks the index on the lookup fields and block number backwards, so only one document is read
+    def findLastBlock(self, lookupFields, tag, beforeBlockNumber):
+        queryDict = dict(zip(lookupFields, tag))
+        queryDict['blockNumber'] = {'$lt': beforeBlockNumber}
+        indexSpec = [(field, DESCENDING) for field in lookupFields + ['blockNumber']]
+
+        return next(self.getCollection().find(queryDict).sort(indexSpec).limit(1), None)
+
+    #Function reads the content hash of every block in the collection, in one query, only the lookup fields and hash are fetched
+    #Returns a dictionary, the tag and block number are the key, the value lists the hash and '_id' of each document with them
+    #Blocks written before hashes were stored have a hash of None, so they never match
+    def readBlockHashes(self, lookupFields):
+        existingBlocks = {}
+        projectionDict = dict.fromkeys(lookupFields + ['blockNumber', 'blockHash'], 1)
+
+        for document in self.getCollection().find({}, projectionDict, batch_size = DEFAULT_BATCH_COUNT):
+            blockKey = (tuple(document.get(field) for field in lookupFields), document.get('blockNumber', 0))
+            existingBlocks.setdefault(blockKey, []).append((document.get('blockHash'), document['_id']))
+
+        return existingBlocks
+
+    #Function deletes segment documents by '_id', used once a block has been merged into, or replaced by, a newer one
+    def deleteSegments(self, documentIds):
+        if len(documentIds) != 0:
+            self.getCollection().delete_many({'_id': {'$in': documentIds}})
+
+    #Function readies the segment collection for writing, before any segment is written
+    #Creates, or verifies, a compound index on the lookup fields and block number, records them, with the header row
+    #and the columns statistics are kept on, in the metadata document, along with the preset dictionary, if there is one
+    def prepareCollection(self, lookupFields, headerRow, statisticsColumns, dictionary, dictionaryId):
+        metadata = self.readCollectionMetadata()
+
+        #Every segment in a collection has to be looked up on the same fields
+        if metadata is not None and metadata['lookupFields'] != lookupFields:
+            sys.exit("Collection '" + self.collectionName + "' is already broken up on field/s: " + str(metadata['lookupFields']) + \
+                     ', program terminating')
 
-        #Total length of collection namespace has to be below 120 bytes, so 119 characters (there is a mandatory dot)
-        if len(mongoDbName) + len(mongoCollectionName) > 119:
-            sys.exit("Max size of collection namespace '<db name>.<collection name>' is 120 bytes, program terminating")
+        #Does nothing if the index already exists
+        #Block number is last, so the blocks of each segment come back from the index in order
+        indexKeys = lookupFields + ['blockNumber']
+        indexName = self.getCollection().create_index([(field, ASCENDING) for field in indexKeys])
+        metadataFields = {'lookupFields': lookupFields, 'headerRow': headerRow, 'indexName': indexName, 'indexKeys': indexKeys, \
+                          'statisticsColumns': statisticsColumns}
+        #Dictionaries are kept by id, segments compressed earlier with another dictionary can still be decompressed
+        if dictionary is not None:
+            metadataFields['dictionaries.' + dictionaryId] = dictionary
+        self.getMetadataCollection().update_one({'_id': self.collectionName}, {'$set': metadataFields}, upsert = True)
 
-        return mongoDbName, mongoCollectionName
+    #Function returns the connection string to use, from --connection, the SMART_COMPRESS_URI environment variable, or
+    #the config file given with --config, in that order, the first one set is used
+    #When none is set, the user is asked, if there is someone at a terminal to ask, otherwise the default is used
+    def getConnectionString(flagConnectionString, configFileName):
+        if flagConnectionString is not None:
+            return flagConnectionString
+        if os.environ.get(CONNECTION_ENVIRONMENT_VARIABLE, '') != '':
+            return os.environ[CONNECTION_ENVIRONMENT_VARIABLE]
+        if configFileName is not None:
+            return Mongo.readConnectionConfig(configFileName)
+
+        connectionString = None
+        if sys.stdin is not None and sys.stdin.isatty():
+            #See if the user wants to keep default connection string (localhost at port 27017) or supply their own inside a file
+            connectionString = Mongo.askUserForConnectionString()
+        else:
+            print('Program connects to Mongo Database @ localhost, port 27017, no connection string was given')
+
+        return connectionString if connectionString is not None else DEFAULT_CONNECTION_STRING
+
+    #Function reads the connection string from a config file, in INI format, the 'connection' option of its [mongo] section
+    #Interpolation is turned off, so a password with a '%' escape in it is read as it is
+    def readConnectionConfig(configFileName):
+        if not os.path.isfile(configFileName):
+            sys.exit('Could not open config file, program terminating')
+
+        config = configparser.ConfigParser(interpolation = None)
+        try:
+            config.read(configFileName)
+        except configparser.Error:
+            sys.exit("Config file '" + configFileName + "' is not in INI format, program terminating")
+        if not config.has_option(CONFIG_SECTION, CONFIG_CONNECTION_OPTION):
+            sys.exit("Config file '" + configFileName + "' has no '" + CONFIG_CONNECTION_OPTION + "' option in a [" + CONFIG_SECTION + \
+                     '] section, program terminating')
+
+        return config.get(CONFIG_SECTION, CONFIG_CONNECTION_OPTION).strip()
 
     #Function checks to see if the user wants to use default connection string or supply their own in a file
     def askUserForConnectionString():
@@ -94,91 +197,110 @@ class Mongo:
             sys.exit('Could not open file containing connection string, program terminating')    
         
         #If it does, opening it, entire contents become connection string
-        #If file is correct, it should only be one line long
+        #If file is correct, it should only be one line long, the newline ending it is not part of the string
         with open(connectionStringFileName) as openFile:
-            connectionString = openFile.read()
+            connectionString = openFile.read().strip()
 
         return connectionString
 
     #Function checks to see if a connection can be established to a Mongo Database instance
-    def checkForValidConnection(userDefinedConnectionString):
-        timeOutVal = 1
-        connectionString = ''
-
-        #If the user opted to use the default string, with connects to localhost at port 27017
-        if userDefinedConnectionString != None:
-            connectionString = 'mongodb://localhost:27017'
-        #If they provided their own string
-        else:
-            connectionString = userDefinedConnectionString
-
-        #Modifying timeout, default is 30 seconds, now it is 1 microsecond
-        client = MongoClient(connectionString, serverSelectionTimeoutMS = timeOutVal)
-        db= client.admin
+    def checkForValidConnection(connectionString):
+        #Modifying timeout, default is 30 seconds, the client used to check is closed once it has answered
+        try:
+            client = MongoClient(connectionString, serverSelectionTimeoutMS = CONNECTION_TIMEOUT_MS)
+        except errors.ConfigurationError as error:
+            sys.exit('Connection string is not valid: ' + str(error) + ', program terminating')
 
-        #Seeing if server responds, or if timeout error occurs
+        #Seeing if server responds, or if timeout, or authentication, error occurs
         try:
-            client.server_info()
+            client.admin.command('ping')
             print("Established connection to Mongo Database")
-        except errors.ServerSelectionTimeoutError:
-            sys.exit('Could not establish connection with Mongo Database, program terminating')
-
-    #Function writes compressed string, and lookup information into Mongo Database
-    def writeToDatabase(self, compressedStream, tag, mongoFieldNames):
-        #mongoFieldNames are the field (column) names defined by the user to break up the CSV on
-        #tag is the set of actual values for each field that make up this segment
-        #Zipping them together to create dictionary (JSON), allows for lookup in Mongo Db
-        dataTagDict = dict(zip(mongoFieldNames, tag))
-        #Adding a new field to dictionary for our compressed object
-        dataTagDict['compressedObject'] = compressedStream
-
-        #Reconnecting to Mongo Database
-        client = MongoClient(self.connectionString) 
-
-        #Has to be done in exec, because code doesn't allow for dynamic database names
-        dbString = 'db = client.' + self.databaseName
-        exec(dbString)
-        
-        #Has to be done in exec, because code doesn't allow for dynamic collection names
-        collectionString = 'result = db.' + self.collectionName + '.insert_one(dataTagDict)'
-        exec(collectionString)
+        except errors.PyMongoError as error:
+            sys.exit('Could not establish connection with Mongo Database: ' + str(error) + ', program terminating')
+        finally:
+            client.close()
+
+    #Function writes segment documents into Mongo Database, in batches limited by number of segments and compressed bytes
+    def writeToDatabase(self, documents):
+        batch = []
+        batchBytes = 0
+
+        for document in documents:
+            #Current batch is full, writing it before adding to it
+            documentBytes = Storage.getCompressedSize(document)
+            if len(batch) != 0 and (len(batch) >= self.batchCount or batchBytes + documentBytes > self.batchBytes):
+                self.writeBatchToDatabase(batch)
+                batch = []
+                batchBytes = 0
+
+            batch.append(document)
+            batchBytes += documentBytes
+
+        if len(batch) != 0:
+            self.writeBatchToDatabase(batch)
 
-        print('Segment successfully written to Mongo Database:', list(tag))
+    #Function writes one batch of segment documents with insert_many, retrying when Mongo Db returns a transient error
+    def writeBatchToDatabase(self, batch):
+        collection = self.getCollection()
+
+        for attempt in range(WRITE_RETRY_ATTEMPTS):
+            try:
+                collection.insert_many(batch, ordered = False)
+                return
+            #A retried batch may have been partly written by the failed attempt, those segments come back as duplicate '_id' errors
+            except errors.BulkWriteError as bulkError:
+                if attempt == 0 or any(writeError['code'] != 11000 for writeError in bulkError.details['writeErrors']):
+                    raise
+                return
+            #Network errors, elections and timeouts are transient, waiting before trying again
+            except errors.ConnectionFailure:
+                if attempt == WRITE_RETRY_ATTEMPTS - 1:
+                    raise
+                time.sleep(0.5 * (2 ** attempt))
 
     #Function retrieves compressed string from Mongo Databased based on lookup information
-    def retrieveSegmentsFromDatabase(self, columnsToReconstructOn):
-        queryDict = {}
+    #Segments are streamed from the query cursor, batchSize segments at a time, instead of all being loaded into memory
+    #When the lookup fields are known, only they and the fields decompression needs are fetched, and the query uses their index
+    #Segments split into blocks are returned in index order, so each segment's blocks are in order
+    #fetchColumns are the positions of the only columns needed, columnar segments fetch just those columns, None fetches all
+    #rowPredicates rule out blocks whose statistics show they hold no matching rows, they are never fetched
+    #With payloads False, only the lookup fields and LISTING_FIELDS are fetched, the query is cheap, nothing compressed is sent
+    def retrieveSegmentsFromDatabase(self, columnsToReconstructOn, batchSize = DEFAULT_CURSOR_BATCH_SIZE, metadata = None, fetchColumns = None, \
+                                     rowPredicates = None, payloads = True):
         queryResult = None
+        queryDict = Storage.buildRetrievalQuery(columnsToReconstructOn, metadata, rowPredicates)
 
-        #Reconnecting into Mongo Database
-        client = MongoClient(self.connectionString)
-
-        #Since argument is in format FIELD=VALUE, splitting on '='
-        for fieldValuePair in columnsToReconstructOn:
-            brockenUp = fieldValuePair.split('=')
-            #User forgot to include '='
-            if len(brockenUp) == 1:
-                sys.exit('Field name for decompression must be in format FIELD=VALUE, no equal sign detected, program terminating')
-            #'FIELD=VALUE' becomes {FIELD: VAlUE} entries in a dictionary
-            else:
-                queryDict[brockenUp[0]] = brockenUp[1]
-
-        #Has to be done in exec, because code doesn't allow for dynamic database names
-        dbString = 'db = client.' + self.databaseName
-        exec(dbString)
-        
-        #Has to be done in exec, because code doesn't allow for dynamic collection names
-        _locals = locals()
-        queryString = 'queryResult = db.' + self.collectionName + '.find(' + str(queryDict) + ')'
-        exec(queryString, globals(), _locals)
+        #Collections written before the metadata document was stored, every field of every segment is fetched
+        if metadata is None:
+            projectionDict = None
+        elif not payloads:
+            projectionDict = dict.fromkeys(metadata['lookupFields'] + LISTING_FIELDS, 1)
+        else:
+            projectionDict = dict.fromkeys(metadata['lookupFields'] + SEGMENT_PROJECTION_FIELDS, 1)
+            projectionDict['_id'] = 0
+            #Only the requested columns of columnar segments are sent over the network, row lengths are not needed
+            #since missing values are written as empty, row segments still fetch their whole compressed object
+            if fetchColumns is not None:
+                del projectionDict['columns']
+                del projectionDict['rowLengths']
+                projectionDict.update(dict.fromkeys(['columns.' + str(columnPosition) for columnPosition in fetchColumns], 1))
 
-        queryResult = list(_locals['queryResult'])
+        queryResult = self.getCollection().find(queryDict, projectionDict, batch_size = batchSize)
+        #Walking the index in order, rather than sorting, so the order costs nothing and works for any query
+        if metadata is not None and 'blockNumber' in metadata.get('indexKeys', []):
+            indexSpec = [(field, ASCENDING) for field in metadata['indexKeys']]
+            queryResult = queryResult.sort(indexSpec).hint(indexSpec)
 
-        #Query returned nothing
-        if len(queryResult) == 0:
-            sys.exit('Successfully queried input, 0 results, program terminating')
-        #Query returned something
-        else:
-            print('Successfully retrieved query results on:', self.collectionName + ', from Mongo Database:', self.databaseName)
+        return self.checkQueryResult(queryResult)
+
+    #Function fetches segment documents by '_id', with every field decompression needs, in any order
+    #Used for the blocks of a query that have to be fetched, after the query itself only fetched their lookup fields, one query per batch
+    #fetchColumns are the only columns of columnar segments fetched, None fetches every column
+    def retrieveSegmentsByIds(self, documentIds, metadata, fetchColumns):
+        projectionDict = dict.fromkeys(metadata['lookupFields'] + SEGMENT_PROJECTION_FIELDS, 1)
+        if fetchColumns is not None:
+            del projectionDict['columns']
+            del projectionDict['rowLengths']
+            projectionDict.update(dict.fromkeys(['columns.' + str(columnPosition) for columnPosition in fetchColumns], 1))
 
-        return queryResult
+        return list(self.getCollection().find({'_id': {'$in': documentIds}}, projectionDict))
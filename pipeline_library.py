@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+import sys
+import time
+import threading
+import concurrent.futures
+from metrics_library import runMetrics
+
+class InFlightWindow:
+    #name is the queue the window's depth, and the time spent waiting for room in it, are recorded under
+    def __init__(self, maxItems, maxBytes, name):
+        self.maxItems = maxItems
+        self.maxBytes = maxBytes
+        self.name = name
+
+        self.items = 0
+        self.bytes = 0
+        self.condition = threading.Condition()
+
+    #Function blocks, without using CPU, until there is room in the window for an item of the given size
+    #An item larger than the whole byte limit is still let in once the window is empty, so it cannot block forever
+    def acquire(self, itemBytes):
+        with self.condition:
+            if self.items != 0 and (self.items >= self.maxItems or self.bytes + itemBytes > self.maxBytes):
+                #Time spent waiting is time whatever fills the window was ahead of whatever empties it
+                waitStart = time.perf_counter()
+                while self.items != 0 and (self.items >= self.maxItems or self.bytes + itemBytes > self.maxBytes):
+                    self.condition.wait()
+                runMetrics.addCount(self.name + 'WaitSeconds', time.perf_counter() - waitStart)
+
+            self.items += 1
+            self.bytes += itemBytes
+            runMetrics.setGauge(self.name + 'Items', self.items)
+            runMetrics.setGauge(self.name + 'Bytes', self.bytes)
+
+    #Function gives an item's room in the window back, waking up anything waiting in acquire
+    def release(self, itemBytes):
+        with self.condition:
+            self.items -= 1
+            self.bytes -= itemBytes
+            runMetrics.setGauge(self.name + 'Items', self.items)
+            runMetrics.setGauge(self.name + 'Bytes', self.bytes)
+            self.condition.notify_all()
+
+class WriteStage:
+    #I/O stage of the ingest pipeline, runs writes to the store on threadCount threads of its own, so Pool processes only compress
+    #At most queueLength writes wait for a thread, submitting one more blocks until one is done, so a slow store holds up
+    #whatever submits to the stage, never the writes already running, name is the queue its depth and waits are recorded under
+    #A write that fails is raised from the next submit, or from close, writes still waiting are dropped
+    def __init__(self, threadCount, queueLength, name):
+        self.executor = concurrent.futures.ThreadPoolExecutor(threadCount, thread_name_prefix = name)
+        #Queued bytes are only recorded, writes are already limited in size by the store's batch size
+        self.window = InFlightWindow(threadCount + queueLength, sys.maxsize, name)
+        self.failure = None
+
+    #Function queues a write, function called with arguments, itemBytes is its size, onDone is called once it is done, written or not
+    def submit(self, itemBytes, onDone, function, *arguments):
+        self.raiseFailure()
+        self.window.acquire(itemBytes)
+        future = self.executor.submit(function, *arguments)
+        future.add_done_callback(lambda future: self.finishWrite(future, itemBytes, onDone))
+
+    #Function runs once a write is done, on its thread, keeps the first failure, and frees its room in the queue
+    def finishWrite(self, future, itemBytes, onDone):
+        if not future.cancelled() and future.exception() is not None and self.failure is None:
+            self.failure = future.exception()
+        self.window.release(itemBytes)
+        if onDone is not None:
+            onDone()
+
+    #Function raises the first write that failed, once the writes running are done, dropping the writes still waiting
+    def raiseFailure(self):
+        if self.failure is not None:
+            self.executor.shutdown(wait = True, cancel_futures = True)
+            raise self.failure
+
+    #Function waits for every queued write to be done, then raises the first one that failed
+    def close(self):
+        self.executor.shutdown(wait = True)
+        self.raiseFailure()
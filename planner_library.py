@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+import os
+import sys
+import math
+import time
+import hashlib
+import itertools
+import multiprocessing
+from codec_library import Codec, AUTO_SAMPLE_BYTES
+from compression_library import Table, DEFAULT_BLOCK_SIZE, ROW_OVERHEAD_BYTES, MEMORY_IN_FLIGHT_SHARE
+from metrics_library import runMetrics
+
+#Number of bits of a tag's hash picking its HyperLogLog register, 2^12 registers, a standard error of about 1.6%
+HLL_PRECISION = 12
+#Number of tags each heavy hitter sketch keeps a count of bytes for, any tag holding more than 1 / 64 of the bytes is always kept
+HEAVY_HITTER_COUNT = 64
+#Number of heavy hitters printed for each candidate
+PRINTED_HEAVY_HITTERS = 5
+#Most fields that can be given with -f, every combination of them is a candidate, 2^6 - 1 = 63 candidates
+MAX_PLAN_FIELDS = 6
+#Segments averaging less than this compress poorly, and each one still costs a document and an index entry
+MIN_SEGMENT_BYTES = 64 * 1024
+#Smallest block size recommended, smaller blocks give up too much compression ratio
+MIN_PLAN_BLOCK_SIZE = 256 * 1024
+#Bytes each segment document takes on top of its compressed bytes, its lookup fields, metadata and index entry, a rough estimate
+DOCUMENT_OVERHEAD_BYTES = 256
+#Share of physical memory the default version, which holds every row of the CSV in memory, is recommended up to
+PLAN_MEMORY_SHARE = 0.5
+#Upper bounds of the segment size buckets of the expected distribution, in bytes, a last bucket holds everything larger
+SEGMENT_SIZE_BUCKETS = [4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024]
+
+class HyperLogLog:
+    #Sketch of the number of distinct tags added to it, in 2^HLL_PRECISION bytes, however many tags there are
+    def __init__(self):
+        self.registers = bytearray(1 << HLL_PRECISION)
+
+    #Function adds a tag, given as a 64 bit hash, its first bits pick a register, which keeps the longest run of leading zeros after them
+    def addHash(self, tagHash):
+        registerIndex = tagHash >> (64 - HLL_PRECISION)
+        remainingBits = tagHash & ((1 << (64 - HLL_PRECISION)) - 1)
+        rank = (64 - HLL_PRECISION) - remainingBits.bit_length() + 1
+        if rank > self.registers[registerIndex]:
+            self.registers[registerIndex] = rank
+
+    #Function returns the estimated number of distinct tags added
+    def getEstimate(self):
+        registerCount = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registerCount)
+        rawEstimate = alpha * registerCount * registerCount / sum(2.0 ** -register for register in self.registers)
+        #Small counts are estimated from the number of empty registers, linear counting, which is more accurate there
+        emptyRegisters = self.registers.count(0)
+        if rawEstimate <= 2.5 * registerCount and emptyRegisters != 0:
+            return registerCount * math.log(registerCount / emptyRegisters)
+        return rawEstimate
+
+class HeavyHitters:
+    #Weighted Space-Saving sketch of the HEAVY_HITTER_COUNT tags holding the most bytes
+    #A tag that is not kept replaces the kept tag holding the fewest bytes, taking over its bytes as its possible overcount
+    #While no tag has been replaced, every tag seen is kept, and the counts are exact
+    def __init__(self):
+        self.counters = {}
+        self.replaced = False
+
+    #Function adds a row of a tag, with the row's bytes, returns whether the tag was already kept
+    def addTag(self, tag, rowBytes):
+        counter = self.counters.get(tag)
+        if counter is not None:
+            counter[0] += rowBytes
+            counter[1] += 1
+            return True
+        if len(self.counters) < HEAVY_HITTER_COUNT:
+            self.counters[tag] = [rowBytes, 1, 0]
+        else:
+            smallestTag = min(self.counters, key = lambda keptTag: self.counters[keptTag][0])
+            smallestBytes = self.counters.pop(smallestTag)[0]
+            self.counters[tag] = [smallestBytes + rowBytes, 1, smallestBytes]
+            self.replaced = True
+        return False
+
+    #Function returns the kept tags, with their bytes, rows and possible overcount of bytes, the most bytes first
+    def getHeavyHitters(self):
+        return sorted(((tag,) + tuple(counter) for tag, counter in self.counters.items()), key = lambda heavyHitter: heavyHitter[1], reverse = True)
+
+class PlanCandidate:
+    #Set of fields the CSV could be broken up on, with a sketch of its number of segments and of its largest segments
+    def __init__(self, fields, positions):
+        self.fields = fields
+        self.positions = positions
+        self.distinctTags = HyperLogLog()
+        self.heavyHitters = HeavyHitters()
+
+    #Function adds a row, by its tag, the values of the candidate's fields
+    #A tag the heavy hitter sketch already keeps was hashed into the distinct count when it was first kept, so it is not hashed again
+    def addRow(self, dataRow, rowBytes):
+        tag = Table.getChunkTuple(dataRow, self.positions)
+        if not self.heavyHitters.addTag(tag, rowBytes):
+            tagHash = hashlib.blake2b('\x00'.join(tag).encode("utf-8"), digest_size = 8).digest()
+            self.distinctTags.addHash(int.from_bytes(tagHash, 'big'))
+
+    #Function returns the estimated number of segments, exact while every tag seen is still kept by the heavy hitter sketch
+    def getSegmentCount(self):
+        if not self.heavyHitters.replaced:
+            return len(self.heavyHitters.counters)
+        return max(len(self.heavyHitters.counters), int(round(self.distinctTags.getEstimate())))
+
+class Planner:
+    #Reads the CSV once, with bounded memory, to plan how to compress it, nothing is written
+    #candidateFields are the fields that could be broken up on, every combination of them is a candidate, None makes every
+    #column a candidate on its own, sampleBytes stops reading after that many bytes of rows, None reads the whole CSV
+    def __init__(self, inputFileName, candidateFields, sampleBytes):
+        self.fileName = inputFileName
+        self.candidateFields = candidateFields
+        self.sampleBytes = sampleBytes
+
+        self.blockSize = None
+        self.memoryBudget = None
+        self.targetThroughput = None
+        self.candidates = []
+        self.rowCount = 0
+        self.scannedBytes = 0
+        self.dataBytes = 0
+        self.sampleRows = []
+        self.headerRow = None
+
+    #Function builds the candidates from the header row, every non empty combination of the candidate fields
+    def buildCandidates(self, headerFields):
+        if self.candidateFields is None:
+            fieldCombinations = [[field] for field in headerFields if field != '']
+        else:
+            if len(self.candidateFields) > MAX_PLAN_FIELDS:
+                sys.exit('Plan can combine at most ' + str(MAX_PLAN_FIELDS) + ' candidate fields, program terminating')
+            fieldCombinations = [list(fields) for fieldCount in range(1, len(self.candidateFields) + 1) \
+                                 for fields in itertools.combinations(self.candidateFields, fieldCount)]
+
+        self.candidates = [PlanCandidate(fields, Table.findAttributeInHeaderRow(headerFields, fields)) for fields in fieldCombinations]
+
+    #Function reads the CSV once, adding every row to every candidate's sketches, each holds a fixed number of tags
+    #The first rows, up to the sample size 'auto' compresses, are kept, to measure each algorithm's compression ratio on
+    def scanCsv(self):
+        scanStart = time.perf_counter()
+
+        with open(self.fileName, newline = '') as openFile:
+            reader = Table.readRowsWithRawText(openFile)
+            headerRow, rawHeaderRow = next(reader, (None, None))
+            if headerRow is None:
+                sys.exit('CSV file is empty, program terminating')
+            self.headerRow = rawHeaderRow
+            self.buildCandidates(headerRow)
+            print('Planning from', 'the first ' + str(self.sampleBytes) + ' bytes of' if self.sampleBytes is not None else 'every row of', \
+                  "'" + self.fileName + "',", len(self.candidates), 'candidate field combinations')
+
+            for dataRow, rawRow in reader:
+                rowBytes = len(rawRow)
+                for candidate in self.candidates:
+                    candidate.addRow(dataRow, rowBytes)
+                if self.scannedBytes < AUTO_SAMPLE_BYTES:
+                    self.sampleRows.append((dataRow, rawRow.encode("utf-8")))
+                self.rowCount += 1
+                self.scannedBytes += rowBytes
+                if self.sampleBytes is not None and self.scannedBytes >= self.sampleBytes:
+                    break
+
+        if self.rowCount == 0:
+            sys.exit('CSV file has no rows after its header row, program terminating')
+        #Projections are scaled from the rows read to every row of the CSV, which is only an estimate when it was not all read
+        self.dataBytes = max(self.scannedBytes, os.path.getsize(self.fileName) - len(self.headerRow.encode("utf-8")))
+        runMetrics.recordStage('parse', time.perf_counter() - scanStart, bytesIn = self.scannedBytes, rows = self.rowCount)
+
+    #Function returns how much larger the whole CSV is than the rows read
+    def getScale(self):
+        return self.dataBytes / self.scannedBytes
+
+    #Function projects a candidate's segments onto the whole CSV, returns its segment count, bytes of each heavy hitter,
+    #the number of segments in each size bucket, and the number of documents, blocks, it is written as
+    #Segments not kept by the heavy hitter sketch are assumed to share the rest of the bytes equally
+    def projectCandidate(self, candidate, blockSize):
+        scale = self.getScale()
+        segmentCount = candidate.getSegmentCount()
+        heavyHitters = [(tag, tagBytes * scale, rows * scale, overcount * scale) for tag, tagBytes, rows, overcount in \
+                        candidate.heavyHitters.getHeavyHitters()]
+
+        restCount = max(segmentCount - len(heavyHitters), 0)
+        restBytes = max(self.dataBytes - sum(heavyHitter[1] for heavyHitter in heavyHitters), 0)
+        segmentSizes = [(heavyHitter[1], 1) for heavyHitter in heavyHitters]
+        if restCount != 0:
+            segmentSizes.append((restBytes / restCount, restCount))
+
+        sizeBuckets = [0] * (len(SEGMENT_SIZE_BUCKETS) + 1)
+        documentCount = 0
+        for segmentBytes, count in segmentSizes:
+            bucketIndex = 0
+            while bucketIndex < len(SEGMENT_SIZE_BUCKETS) and segmentBytes > SEGMENT_SIZE_BUCKETS[bucketIndex]:
+                bucketIndex += 1
+            sizeBuckets[bucketIndex] += count
+            documentCount += count * max(1, math.ceil(segmentBytes / blockSize))
+
+        return {'segmentCount': segmentCount, 'averageBytes': self.dataBytes / max(segmentCount, 1), 'heavyHitters': heavyHitters, \
+                'largestShare': heavyHitters[0][1] / self.dataBytes if len(heavyHitters) != 0 else 0, 'sizeBuckets': sizeBuckets, \
+                'documentCount': documentCount}
+
+    #Function picks the fields to break up on, the candidate with the most segments whose segments average at least MIN_SEGMENT_BYTES,
+    #so lookups read as little as possible without segments too small to compress well, fewer fields break ties
+    #When no candidate's segments are that large, the candidate with the fewest segments is picked
+    def recommendCandidate(self, projections):
+        largeEnough = [candidate for candidate in self.candidates if projections[id(candidate)]['averageBytes'] >= MIN_SEGMENT_BYTES]
+        if len(largeEnough) != 0:
+            return max(largeEnough, key = lambda candidate: (projections[id(candidate)]['segmentCount'], -len(candidate.fields)))
+        return min(self.candidates, key = lambda candidate: (projections[id(candidate)]['segmentCount'], len(candidate.fields)))
+
+    #Function returns the block size to use, the default, unless the largest segment is too small to give every Pool process a block
+    #of it, then the largest power of 2 that does, so reading it back uses every core, no smaller than MIN_PLAN_BLOCK_SIZE
+    def recommendBlockSize(self, projection):
+        if self.blockSize is not None:
+            return self.blockSize
+
+        processCount = multiprocessing.cpu_count() + 1
+        largestBytes = projection['heavyHitters'][0][1] if len(projection['heavyHitters']) != 0 else 0
+        blockSize = DEFAULT_BLOCK_SIZE
+        while blockSize > MIN_PLAN_BLOCK_SIZE and largestBytes / blockSize < processCount:
+            blockSize //= 2
+        return blockSize
+
+    #Function returns the bytes of physical memory, None where it cannot be found
+    def getPhysicalMemory():
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        except (ValueError, OSError, AttributeError):
+            return None
+
+    #Function returns the version to run, and its memory budget, None for the default version
+    #The default version holds every row in memory, it is used when that fits in PLAN_MEMORY_SHARE of physical memory
+    #Otherwise the memory sensitive version, with room to buffer a block of every segment, so blocks are not cut small,
+    #and when even that does not fit, spilling to disk, which gives one segment per tag under any budget
+    def recommendMemory(self, projection, blockSize):
+        physicalMemory = Planner.getPhysicalMemory()
+        memoryLimit = self.memoryBudget if self.memoryBudget is not None else \
+                      int(physicalMemory * PLAN_MEMORY_SHARE) if physicalMemory is not None else None
+        inMemoryBytes = self.dataBytes + self.rowCount * self.getScale() * ROW_OVERHEAD_BYTES
+        if memoryLimit is None or inMemoryBytes <= memoryLimit:
+            return ('default', None, inMemoryBytes)
+
+        averageRowBytes = self.scannedBytes / self.rowCount
+        bufferedBytes = projection['segmentCount'] * min(blockSize, projection['averageBytes']) * (1 + ROW_OVERHEAD_BYTES / averageRowBytes)
+        memoryBudget = int(math.ceil(bufferedBytes / (1 - MEMORY_IN_FLIGHT_SHARE) / (1024 * 1024))) * 1024 * 1024
+        if memoryBudget <= memoryLimit:
+            return ('memory', memoryBudget, inMemoryBytes)
+        return ('spill', memoryLimit, inMemoryBytes)
+
+    #Function compresses the sample rows, broken up on the recommended fields and cut into blocks, with every algorithm
+    #Returns each algorithm's name, compression ratio and bytes compressed per CPU second
+    #Segments in the sample are smaller than in the whole CSV, so ratios of fields with many segments are underestimated
+    def measureCodecs(self, candidate, blockSize):
+        sampleBlocks = {}
+        sampleBlockSizes = {}
+        for dataRow, rawRow in self.sampleRows:
+            tag = Table.getChunkTuple(dataRow, candidate.positions)
+            if tag not in sampleBlocks or sampleBlockSizes[tag] >= blockSize:
+                sampleBlocks.setdefault(tag, []).append([])
+                sampleBlockSizes[tag] = 0
+            sampleBlocks[tag][-1].append(rawRow)
+            sampleBlockSizes[tag] += len(rawRow)
+
+        sampleBlocks = [b''.join(block) for blocks in sampleBlocks.values() for block in blocks]
+        print('Sampling', sum(len(block) for block in sampleBlocks), 'bytes of the CSV, in', len(sampleBlocks), 'blocks, with every compression algorithm')
+        return Codec.measureCodecs(sampleBlocks, Codec.getCodecNames())
+
+    #Function prints every candidate, then the recommended fields, block size, version, memory budget and algorithm,
+    #with the number of documents and the storage they are projected to take
+    def printPlan(self):
+        scale = self.getScale()
+        print('Read', self.rowCount, 'rows,', Planner.formatBytes(self.scannedBytes), 'of rows' + \
+              (', projected onto ' + Planner.formatBytes(self.dataBytes) + ', about ' + str(int(self.rowCount * scale)) + ' rows' if scale > 1 else ''))
+
+        projections = {id(candidate): self.projectCandidate(candidate, self.blockSize or DEFAULT_BLOCK_SIZE) for candidate in self.candidates}
+        print('Candidate fields, by estimated number of segments:')
+        for candidate in sorted(self.candidates, key = lambda candidate: projections[id(candidate)]['segmentCount']):
+            projection = projections[id(candidate)]
+            print('  %-40s %10d segments, average %10s, largest %5.1f%% of rows' % (str(candidate.fields), projection['segmentCount'], \
+                  Planner.formatBytes(projection['averageBytes']), projection['largestShare'] * 100))
+
+        candidate = self.recommendCandidate(projections)
+        blockSize = self.recommendBlockSize(projections[id(candidate)])
+        projection = self.projectCandidate(candidate, blockSize)
+        print('Recommended fields:', candidate.fields)
+        if projection['averageBytes'] < MIN_SEGMENT_BYTES:
+            print('  No candidate gives segments averaging', Planner.formatBytes(MIN_SEGMENT_BYTES) + ', these give the fewest, consider fewer fields')
+        if candidate.heavyHitters.replaced:
+            print('  Segment count is estimated, +/- %.1f%%' % (104 / math.sqrt(1 << HLL_PRECISION)))
+        if scale > 1:
+            print('  Only part of the CSV was read, segments only in the rest of it are not counted')
+        print('  Largest segments:')
+        for tag, tagBytes, rows, overcount in projection['heavyHitters'][:PRINTED_HEAVY_HITTERS]:
+            print('    %-40s %10s, %5.1f%% of rows%s' % (str(list(tag)), Planner.formatBytes(tagBytes), tagBytes / self.dataBytes * 100, \
+                  ', may be ' + Planner.formatBytes(overcount) + ' less' if overcount > 0 else ''))
+        print('  Segment sizes:')
+        for bucketIndex, segmentCount in enumerate(projection['sizeBuckets']):
+            bucketLabel = '<= ' + Planner.formatBytes(SEGMENT_SIZE_BUCKETS[bucketIndex]) if bucketIndex < len(SEGMENT_SIZE_BUCKETS) else \
+                          '>  ' + Planner.formatBytes(SEGMENT_SIZE_BUCKETS[-1])
+            print('    %-12s %10d segments' % (bucketLabel, segmentCount))
+
+        print('Recommended block size:', Planner.formatBytes(blockSize) + (' (given)' if self.blockSize is not None else ''))
+        version, memoryBudget, inMemoryBytes = self.recommendMemory(projection, blockSize)
+        print('Holding every row in memory takes about', Planner.formatBytes(inMemoryBytes))
+        if version == 'default':
+            print('Recommended version: default, every row fits in memory, no -m, --memory')
+        elif version == 'memory':
+            print('Recommended version: memory sensitive, -m, --memory', Planner.formatBytes(memoryBudget) + ', room to buffer a block of every segment')
+        else:
+            print('Recommended version: --spill, -m, --memory', Planner.formatBytes(memoryBudget) + ', too many segments to buffer a block of each')
+
+        codecResults = self.measureCodecs(candidate, blockSize)
+        print('Projected documents:', projection['documentCount'])
+        for name, compressionRatio, throughput in codecResults:
+            storageBytes = self.dataBytes / compressionRatio + projection['documentCount'] * DOCUMENT_OVERHEAD_BYTES
+            print("  '%s': ratio %.2f, projected storage %s, %.1f CPU seconds to compress" % (name, compressionRatio, \
+                  Planner.formatBytes(storageBytes), self.dataBytes / throughput))
+        whichCompressionAlgToUse = Codec.pickCodec(codecResults, self.targetThroughput)
+        print("Recommended algorithm: '" + whichCompressionAlgToUse + "'")
+
+        commandParts = ['python SmartCompress.py -v compress -i', self.fileName, '-a', whichCompressionAlgToUse, '-f'] + \
+                       ["'\"" + field + "\"'" for field in candidate.fields]
+        if blockSize != DEFAULT_BLOCK_SIZE:
+            commandParts += ['--block-size', str(blockSize)]
+        if version != 'default':
+            commandParts += (['--spill'] if version == 'spill' else []) + ['-m', str(memoryBudget)]
+        print('Recommended command:', ' '.join(commandParts + ['-d', '\'"<DB NAME>"\'', '-c', '\'"<COLLECTION NAME>"\'']))
+
+    #Function returns a number of bytes as text, in B, KB, MB, GB or TB
+    def formatBytes(byteCount):
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if byteCount < 1024:
+                return '%.1f %s' % (byteCount, unit)
+            byteCount /= 1024
+        return '%.1f TB' % byteCount
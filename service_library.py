@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+import os
+import stat
+import socketserver
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from api_library import SmartCompressError
+from metrics_library import runMetrics, DEFAULT_VERBOSITY
+
+#Query string parameters of /extract, and the argument of SmartCompressApi.prepareExtraction each one is
+#Parameters that take a list are given once per item, field=OCCUPATION%3DENGINEER&field=STATE%3DCA
+LIST_PARAMETERS = {'field': 'fields', 'column': 'columns', 'where': 'where', 'aggregate': 'aggregate'}
+VALUE_PARAMETERS = {'aggregateColumn': 'aggregateColumn', 'batchSize': 'batchSize'}
+#Content type of /metrics, the Prometheus text format
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class ChunkedWriter:
+    #Binary stream writing to an HTTP response in chunks, so the response can be sent before its length is known
+    def __init__(self, outputFile):
+        self.outputFile = outputFile
+
+    #Function sends bytes as one chunk, an empty write is skipped, an empty chunk ends the response
+    def write(self, data):
+        if len(data) != 0:
+            self.outputFile.write(b'%x\r\n' % len(data))
+            self.outputFile.write(data)
+            self.outputFile.write(b'\r\n')
+
+    #Function ends the response, with the empty chunk
+    def close(self):
+        self.outputFile.write(b'0\r\n\r\n')
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    #Every request is handled in its own thread, queries share the server's SmartCompressApi, and its warm Pool
+    protocol_version = 'HTTP/1.1'
+
+    #Function routes a GET request to its handler
+    def do_GET(self):
+        requestUrl = urllib.parse.urlsplit(self.path)
+        if requestUrl.path == '/extract':
+            self.handleExtract(urllib.parse.parse_qs(requestUrl.query, keep_blank_values = True))
+        elif requestUrl.path == '/metrics':
+            self.sendText(200, runMetrics.getPrometheusText(), PROMETHEUS_CONTENT_TYPE)
+        elif requestUrl.path == '/health':
+            self.sendText(200, 'OK\n')
+        else:
+            self.sendText(404, "No such path, use '/extract', '/metrics' or '/health'\n")
+
+    #Function sends a whole response, with its length, the connection can be used again after it
+    def sendText(self, statusCode, text, contentType = 'text/plain; charset=utf-8'):
+        body = text.encode("utf-8")
+        self.send_response(statusCode)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    #Function turns the query string of /extract into the arguments of SmartCompressApi.prepareExtraction
+    def getQueryArguments(queryParameters):
+        for parameterName in queryParameters:
+            if parameterName not in LIST_PARAMETERS and parameterName not in VALUE_PARAMETERS and parameterName not in ['database', 'collection']:
+                raise SmartCompressError("Unknown parameter '" + parameterName + "'")
+        for parameterName in ['database', 'collection']:
+            if len(queryParameters.get(parameterName, [])) != 1:
+                raise SmartCompressError("Parameter '" + parameterName + "' has to be given once")
+
+        queryArguments = {argumentName: queryParameters[parameterName] for parameterName, argumentName in LIST_PARAMETERS.items() \
+                          if parameterName in queryParameters}
+        for parameterName, argumentName in VALUE_PARAMETERS.items():
+            if parameterName in queryParameters:
+                queryArguments[argumentName] = queryParameters[parameterName][-1]
+        if 'batchSize' in queryArguments:
+            try:
+                queryArguments['batchSize'] = int(queryArguments['batchSize'])
+            except ValueError:
+                raise SmartCompressError("Parameter 'batchSize' has to be a number") from None
+
+        return queryParameters['database'][0], queryParameters['collection'][0], queryArguments
+
+    #Function runs a query, streaming its CSV back as it is decompressed, in order
+    #Anything wrong with the query is found before the response starts, and sent back as a 400
+    #Once the CSV is streaming, a segment that cannot be decompressed ends the response without its last chunk, so it is seen as cut short
+    def handleExtract(self, queryParameters):
+        runMetrics.addCount('extractRequests')
+        try:
+            databaseName, collectionName, queryArguments = ServiceRequestHandler.getQueryArguments(queryParameters)
+            decomp = self.server.api.prepareExtraction(databaseName, collectionName, **queryArguments)
+        except SmartCompressError as error:
+            runMetrics.addCount('failedRequests')
+            self.sendText(400, str(error) + '\n')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        outputStream = ChunkedWriter(self.wfile)
+        try:
+            self.server.api.streamExtraction(decomp, outputStream)
+            outputStream.close()
+        except SmartCompressError as error:
+            runMetrics.addCount('failedRequests')
+            self.log_error('Query stopped part way: %s', str(error))
+            self.close_connection = True
+        #Client closed the connection, the query's pending segments are dropped
+        except (BrokenPipeError, ConnectionResetError):
+            runMetrics.addCount('disconnectedRequests')
+            self.close_connection = True
+
+    #Function returns the client's address, requests over a Unix socket have none
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix socket'
+
+    #Function prints a line for every request at verbosity 1 and above
+    def log_message(self, format, *arguments):
+        if runMetrics.verbosity >= DEFAULT_VERBOSITY:
+            BaseHTTPRequestHandler.log_message(self, format, *arguments)
+
+class SmartCompressService(ThreadingHTTPServer):
+    #HTTP server answering queries over TCP, every request in its own thread, api is the SmartCompressApi they share
+    daemon_threads = True
+
+    def __init__(self, serverAddress, api):
+        ThreadingHTTPServer.__init__(self, serverAddress, ServiceRequestHandler)
+        self.api = api
+
+class UnixSocketService(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    #HTTP server answering queries over a Unix socket, only processes on the same machine that can open the socket file can connect
+    daemon_threads = True
+
+    #A socket file left behind by a service that did not shut down cleanly is removed, any other file is not
+    def __init__(self, socketPath, api):
+        if os.path.exists(socketPath):
+            if not stat.S_ISSOCK(os.stat(socketPath).st_mode):
+                raise SmartCompressError("'" + socketPath + "' already exists and is not a socket")
+            os.remove(socketPath)
+        socketserver.UnixStreamServer.__init__(self, socketPath, ServiceRequestHandler)
+        self.api = api
+
+    #Function removes the socket file once the server is closed
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+import sys
+import math
+
+#Comparison operators a predicate can use, two character operators are listed first so they are matched before '<', '>' and '='
+PREDICATE_OPERATORS = ['>=', '<=', '!=', '>', '<', '=']
+#Aggregates decompression can compute instead of writing rows, count is the number of rows, the others only use values that are numbers
+AGGREGATE_FUNCTIONS = ['count', 'sum', 'min', 'max', 'avg']
+
+class Statistics:
+    #Function works out the statistics of one column of a block, stored in the segment document so blocks can be skipped
+    #min and max compare values as strings, numericMin and numericMax compare them as numbers, when every non empty value is one
+    def getColumnStatistics(columnValues):
+        nonEmptyValues = [value for value in columnValues if value != '']
+        numericValues = [Statistics.getNumericValue(value) for value in nonEmptyValues]
+        numeric = None not in numericValues
+        columnStatistics = {'min': min(columnValues, default = ''), 'max': max(columnValues, default = ''), \
+                            'nulls': len(columnValues) - len(nonEmptyValues), 'distinct': len(set(columnValues)), 'numeric': numeric}
+
+        #A column with no values at all is numeric, its numeric min and max are None, so no numeric predicate can match it
+        if numeric:
+            columnStatistics['numericMin'] = min(numericValues, default = None)
+            columnStatistics['numericMax'] = max(numericValues, default = None)
+            #Aggregate queries sum the column from this, without decompressing the block
+            columnStatistics['numericSum'] = math.fsum(numericValues)
+
+        return columnStatistics
+
+    #Function returns a value as a number, None if it is not a finite number
+    def getNumericValue(value):
+        try:
+            numericValue = float(value)
+        except ValueError:
+            return None
+
+        if not math.isfinite(numericValue):
+            return None
+        return numericValue
+
+    #Function turns each COLUMN<OPERATOR>VALUE predicate into a tuple of column name, operator, value and numeric value
+    #A value that is a number is compared as a number, rows whose value is not a number do not match it
+    def parsePredicates(predicateStrings):
+        predicates = []
+
+        for predicateString in predicateStrings:
+            #Splitting on the first operator, column names cannot contain one
+            operatorPosition = min((predicateString.find(char) for char in '<>!=' if char in predicateString), default = -1)
+            if operatorPosition < 1:
+                sys.exit("Predicate: '" + predicateString + "' must be in format COLUMN<OPERATOR>VALUE, with one of the operators: " + \
+                         str(PREDICATE_OPERATORS) + ', program terminating')
+
+            for operator in PREDICATE_OPERATORS:
+                if predicateString.startswith(operator, operatorPosition):
+                    break
+            else:
+                sys.exit("Predicate: '" + predicateString + "' has no valid operator, use one of: " + str(PREDICATE_OPERATORS) + \
+                         ', program terminating')
+
+            value = predicateString[operatorPosition + len(operator):]
+            predicates.append((predicateString[:operatorPosition], operator, value, Statistics.getNumericValue(value)))
+
+        return predicates
+
+    #Function returns True if a value satisfies a predicate
+    def valueMatches(value, operator, predicateValue, numericPredicateValue):
+        if numericPredicateValue is not None:
+            value = Statistics.getNumericValue(value)
+            if value is None:
+                return False
+            predicateValue = numericPredicateValue
+
+        if operator == '=':
+            return value == predicateValue
+        elif operator == '!=':
+            return value != predicateValue
+        elif operator == '>':
+            return value > predicateValue
+        elif operator == '>=':
+            return value >= predicateValue
+        elif operator == '<':
+            return value < predicateValue
+        else:
+            return value <= predicateValue
+
+    #Function returns True if a row satisfies every predicate, predicates here hold the column position instead of its name
+    #Values missing from a short row are empty
+    def rowMatches(row, predicates):
+        for columnPosition, operator, predicateValue, numericPredicateValue in predicates:
+            value = row[columnPosition] if columnPosition < len(row) else ''
+            if not Statistics.valueMatches(value, operator, predicateValue, numericPredicateValue):
+                return False
+
+        return True
+
+    #Function returns the condition on a segment document's statistics that every block holding a matching row satisfies
+    #Blocks that fail it hold no matching rows, so Mongo Db never returns them, None when the statistics cannot rule anything out
+    #columnPosition is the position of the predicate's column in the header row, statistics are stored under it
+    def buildStatisticsQuery(columnPosition, operator, predicateValue, numericPredicateValue):
+        statisticsField = 'stats.' + str(columnPosition)
+
+        if operator == '!=':
+            return None
+        #Numeric predicates can only use the numeric min and max, blocks with values that are not numbers are always fetched
+        if numericPredicateValue is not None:
+            minField, maxField, predicateValue = statisticsField + '.numericMin', statisticsField + '.numericMax', numericPredicateValue
+        else:
+            minField, maxField = statisticsField + '.min', statisticsField + '.max'
+
+        if operator == '=':
+            rangeQuery = {minField: {'$lte': predicateValue}, maxField: {'$gte': predicateValue}}
+        elif operator == '>':
+            rangeQuery = {maxField: {'$gt': predicateValue}}
+        elif operator == '>=':
+            rangeQuery = {maxField: {'$gte': predicateValue}}
+        elif operator == '<':
+            rangeQuery = {minField: {'$lt': predicateValue}}
+        else:
+            rangeQuery = {minField: {'$lte': predicateValue}}
+
+        #Blocks compressed without statistics on this column are always fetched
+        alternatives = [{statisticsField: {'$exists': False}}, rangeQuery]
+        if numericPredicateValue is not None:
+            alternatives.append({statisticsField + '.numeric': False})
+
+        return {'$or': alternatives}
+
+    #Function returns the partial aggregates of one block, from the values of its aggregate column, one value per row
+    #Partials of every block of a group are merged, sums are kept as a list, so they are added up once, without rounding error
+    def getAggregatePartial(values):
+        numericValues = [numericValue for numericValue in map(Statistics.getNumericValue, values) if numericValue is not None]
+        return {'count': len(values), 'numericCount': len(numericValues), 'sums': [math.fsum(numericValues)], \
+                'min': min(numericValues, default = None), 'max': max(numericValues, default = None)}
+
+    #Function returns the partial aggregates of a block from its row count and the statistics of the aggregate column
+    #None when they cannot give them, the block was written without them, or the column holds values that are not numbers
+    #columnPosition is None when only rows are counted
+    def getStatisticsPartial(segment, columnPosition, aggregateFunctions):
+        if 'rowCount' not in segment:
+            return None
+        partial = {'count': segment['rowCount'], 'numericCount': 0, 'sums': [], 'min': None, 'max': None}
+        if columnPosition is None or aggregateFunctions == ['count']:
+            return partial
+
+        columnStatistics = segment.get('stats', {}).get(str(columnPosition))
+        if columnStatistics is None or not columnStatistics['numeric'] or 'numericSum' not in columnStatistics:
+            return None
+        partial.update({'numericCount': segment['rowCount'] - columnStatistics['nulls'], 'sums': [columnStatistics['numericSum']], \
+                        'min': columnStatistics['numericMin'], 'max': columnStatistics['numericMax']})
+        return partial
+
+    #Function merges the partial aggregates of a block into those of its group
+    def mergeAggregatePartials(groupPartial, partial):
+        groupPartial['count'] += partial['count']
+        groupPartial['numericCount'] += partial['numericCount']
+        groupPartial['sums'].extend(partial['sums'])
+        groupPartial['min'] = min((value for value in [groupPartial['min'], partial['min']] if value is not None), default = None)
+        groupPartial['max'] = max((value for value in [groupPartial['max'], partial['max']] if value is not None), default = None)
+
+    #Function returns the value of an aggregate of a group, written out as text, empty when the group has no values that are numbers
+    def getAggregateValue(groupPartial, aggregateFunction):
+        if aggregateFunction == 'count':
+            return str(groupPartial['count'])
+        if groupPartial['numericCount'] == 0:
+            return ''
+
+        if aggregateFunction == 'sum':
+            value = math.fsum(groupPartial['sums'])
+        elif aggregateFunction == 'avg':
+            value = math.fsum(groupPartial['sums']) / groupPartial['numericCount']
+        else:
+            value = groupPartial[aggregateFunction]
+        #Whole numbers are written without a decimal point, as they were in the CSV
+        if value.is_integer() and abs(value) < 2 ** 53:
+            return str(int(value))
+        return repr(value)
@@ -0,0 +1,646 @@
+#!/usr/bin/python3
+import os
+import re
+import sys
+import json
+import mmap
+import fcntl
+import base64
+import struct
+import operator
+import itertools
+from bson import ObjectId
+from statistics_library import Statistics
+
+#Default number of segments, and number of compressed bytes, written to the store in one call
+DEFAULT_BATCH_COUNT = 500
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+#Default number of segments the query cursor fetches from the store in one round trip
+DEFAULT_CURSOR_BATCH_SIZE = 100
+#Local store files start with this, then the offset and length of the index footer, a length of 0 means no footer was written yet
+LOCAL_STORE_MAGIC = b'SMARTCS1'
+LOCAL_STORE_HEADER = struct.Struct('<8sQQ')
+#Every record appended to a local store file starts with the length of its JSON description, then of the compressed bytes after it
+LOCAL_RECORD_HEADER = struct.Struct('<QQ')
+#Extension of a local store file, one file per collection, in a directory per database
+LOCAL_STORE_EXTENSION = '.segments'
+#Fields of a segment document holding compressed bytes, kept in the data file, the index holds their offset and length
+#'columns' holds one compressed stream per column, each is kept the same way
+LOCAL_PAYLOAD_FIELDS = ['compressedObject', 'rowLengths']
+#Fields of a segment document returned by a query without compressed bytes, on top of the lookup fields
+#Enough to find each block in the segment cache, to size it in the in flight window, and to answer aggregates from statistics
+LISTING_FIELDS = ['_id', 'blockNumber', 'uncompressedSize', 'blockHash', 'rowCount', 'stats']
+#Stands in for a field a document does not have, when checking it against a query
+MISSING_VALUE = object()
+#Comparison operators a query can use, and the Python comparison each one is
+QUERY_OPERATORS = {'$lt': operator.lt, '$lte': operator.le, '$gt': operator.gt, '$gte': operator.ge}
+
+class Storage:
+    #Function sets what every storage backend has, the database and collection segments are kept in, and the size of a write batch
+    #Backends implement every function below that terminates, compression and decompression only call these
+    def __init__(self, databaseName, collectionName):
+        self.databaseName = databaseName
+        self.collectionName = collectionName
+        self.storeName = None
+
+        self.batchCount = DEFAULT_BATCH_COUNT
+        self.batchBytes = DEFAULT_BATCH_BYTES
+        #Command line program terminates on a query with no results, the library API returns no segments instead
+        self.exitOnEmptyResult = True
+
+    #Function readies the backend in a Pool worker, once, before the worker writes or reads anything
+    def connect(self):
+        pass
+
+    #Function finishes a compression run, once every segment has been written, nothing is left to do by default
+    def closeStore(self):
+        pass
+
+    #Function returns the metadata document of the collection, None if there is none
+    def readCollectionMetadata(self):
+        raise NotImplementedError
+
+    #Function returns True if the collection holds any segments
+    def hasSegments(self):
+        raise NotImplementedError
+
+    #Function counts one more ingest run into the collection's metadata, returns the run's number
+    def startIngestRun(self):
+        raise NotImplementedError
+
+    #Function returns the last block of a segment numbered before a block number, None if the segment has no such block
+    def findLastBlock(self, lookupFields, tag, beforeBlockNumber):
+        raise NotImplementedError
+
+    #Function returns the hash and '_id' of every block in the collection, keyed by the tag and block number
+    def readBlockHashes(self, lookupFields):
+        raise NotImplementedError
+
+    #Function deletes segment documents by '_id'
+    def deleteSegments(self, documentIds):
+        raise NotImplementedError
+
+    #Function readies the collection for writing, records its lookup fields, header row, statistics columns and dictionary
+    def prepareCollection(self, lookupFields, headerRow, statisticsColumns, dictionary, dictionaryId):
+        raise NotImplementedError
+
+    #Function writes segment documents into the collection
+    def writeToDatabase(self, documents):
+        raise NotImplementedError
+
+    #Function returns the segments matching the lookup information, each segment's blocks in order
+    #With payloads False, only the fields LISTING_FIELDS names, and the lookup fields, are returned, no compressed bytes
+    def retrieveSegmentsFromDatabase(self, columnsToReconstructOn, batchSize = DEFAULT_CURSOR_BATCH_SIZE, metadata = None, fetchColumns = None, \
+                                     rowPredicates = None, payloads = True):
+        raise NotImplementedError
+
+    #Function returns segment documents by '_id', in any order, fetchColumns are the only columns fetched, None fetches every column
+    def retrieveSegmentsByIds(self, documentIds, metadata, fetchColumns):
+        raise NotImplementedError
+
+    #Function ensures that user defined database and collection names are valid
+    def checkValidDbAndConnectionName(mongoDbName, mongoCollectionName):
+        #Illegal characters in a Mongo database name
+        invalidCharDbList = ['/',"\\",'.',' ','"','$']
+
+        #Database name has to be wrapped in two levels of quotes, single quotes, and inside them, double quotes
+        #This is done in an attempt to sanitize the data, though this can still be overcome by using 4 levels of quotes
+        if not ((mongoDbName[0] == '"') and (mongoDbName[-1] == '"')):
+            sys.exit('Database name must be wrapped in 2 levels of quotes, \'"<DB NAME>"\', \
+                      \nthe quotes will be removed automatically, program terminating')
+        else:
+            #Stripping away double quotes, single quotes are eaten by bash automatically
+            mongoDbName = mongoDbName[1:-1]
+
+        #Collection name has to be wrapped in two levels of quotes, single quotes, and inside them, double quotes
+        #This is done in an attempt to sanitize the data, though this can still be overcome by using 4 levels of quotes
+        if not ((mongoCollectionName[0] == '"') and (mongoCollectionName[-1] == '"')):
+            sys.exit('Collection name must be wrapped in 2 levels of quotes, \'"<COLLECTION NAME>"\', \
+                      \nthe quotes will be removed automatically, program terminating')
+        else:
+            #Stripping away double quotes, single quotes are eaten by bash automatically
+            mongoCollectionName = mongoCollectionName[1:-1]
+
+        #Mongo Database will not allow database names to be over 63 characters
+        if len(mongoDbName) >= 64:
+            sys.exit('Length of database name is over 63 characters, program terminating')
+
+        #Making sure any character from list above ^, is not present
+        for invalidChar in invalidCharDbList:
+            if invalidChar in mongoDbName:
+                sys.exit("Invalid char: '" + invalidChar + "' in database name, program terminating")
+
+        #Only illegal character for collections is '$'
+        if '$' in mongoCollectionName:
+            sys.exit("Invalid char: '$' in collection name, program terminating")
+
+        #Both collection and database names cannot be empty string
+        if mongoCollectionName == '':
+            sys.exit('Collection name cannot be empty string, program terminating')
+        if mongoDbName == '':
+            sys.exit('Database name cannot be empty string, program terminating')
+
+        #Collection name cannot start with 'system.'
+        if '.' in mongoCollectionName:
+            if mongoCollectionName.split('.')[0] == 'system':
+                sys.exit("Collection name cannot start with 'system.', program terminating")
+
+        #Total length of collection namespace has to be below 120 bytes, so 119 characters (there is a mandatory dot)
+        if len(mongoDbName) + len(mongoCollectionName) > 119:
+            sys.exit("Max size of collection namespace '<db name>.<collection name>' is 120 bytes, program terminating")
+
+        return mongoDbName, mongoCollectionName
+
+    #Function builds the document for a compressed segment, with its lookup information
+    #compressedFields holds the compressed data, 'compressedObject' for row segments, 'columns' and 'rowLengths' for columnar ones
+    def buildSegmentDocument(compressedFields, tag, mongoFieldNames, segmentMetadata):
+        #mongoFieldNames are the field (column) names defined by the user to break up the CSV on
+        #tag is the set of actual values for each field that make up this segment
+        #Zipping them together to create dictionary (JSON), allows for lookup in Mongo Db
+        dataTagDict = dict(zip(mongoFieldNames, tag))
+        #Adding new fields to dictionary for our compressed object
+        dataTagDict.update(compressedFields)
+        #Adding the payload format version, header row and uncompressed size
+        dataTagDict.update(segmentMetadata)
+        #'_id' is set here, rather than by the store, so a batch that is retried cannot insert a segment twice
+        dataTagDict['_id'] = ObjectId()
+
+        return dataTagDict
+
+    #Function returns the number of compressed bytes in a segment document
+    def getCompressedSize(document):
+        if 'columns' in document:
+            return sum(len(compressedColumn) for compressedColumn in document['columns'].values()) + len(document.get('rowLengths', b''))
+        return len(document['compressedObject'])
+
+    #Function turns the user's lookup information into a single Mongo Db query
+    #FIELD=VALUE matches the value, FIELD=V1|V2|V3 matches any of the values, FIELD=PREFIX* matches values starting with PREFIX,
+    #FIELD=* matches any value, as does leaving the field out, and FIELD~PATTERN matches values against a regular expression
+    #A literal '|' or '*' in a value is written '\\|' or '\\*'
+    def buildSegmentQuery(columnsToReconstructOn):
+        queryDict = {}
+
+        for fieldValuePair in columnsToReconstructOn:
+            #Splitting on the first '=' or '~', values can contain either
+            equalPosition = fieldValuePair.find('=')
+            tildePosition = fieldValuePair.find('~')
+            #User forgot to include '='
+            if equalPosition == -1 and tildePosition == -1:
+                sys.exit('Field name for decompression must be in format FIELD=VALUE or FIELD~PATTERN, no equal sign detected, program terminating')
+            elif tildePosition != -1 and (equalPosition == -1 or tildePosition < equalPosition):
+                field, pattern = fieldValuePair[:tildePosition], fieldValuePair[tildePosition + 1:]
+                try:
+                    fieldQuery = re.compile(pattern)
+                except re.error:
+                    sys.exit("Pattern: '" + pattern + "' for field: '" + field + "' is not a valid regular expression, program terminating")
+            else:
+                field, value = fieldValuePair[:equalPosition], fieldValuePair[equalPosition + 1:]
+                fieldQuery = Storage.buildValueQuery(value)
+
+            if field in queryDict:
+                sys.exit("Field: '" + field + "' is given more than once, list every value in one FIELD=V1|V2 instead, program terminating")
+            #'FIELD=*' places no condition on the field
+            if fieldQuery is not None:
+                queryDict[field] = fieldQuery
+
+        return queryDict
+
+    #Function turns the VALUE of FIELD=VALUE into the condition on that field, None when any value matches
+    def buildValueQuery(value):
+        alternatives = []
+        currentValue = ''
+        isPrefix = False
+        position = 0
+
+        #Splitting on '|' and finding trailing '*', skipping over escaped characters
+        while position <= len(value):
+            char = value[position] if position < len(value) else '|'
+            if char == '\\' and position + 1 < len(value):
+                currentValue += value[position + 1]
+                position += 1
+            elif char == '*' and (position + 1 == len(value) or value[position + 1] == '|'):
+                isPrefix = True
+            elif char == '|':
+                #An anchored prefix pattern can still use the index on the field
+                if isPrefix:
+                    alternatives.append(re.compile('^' + re.escape(currentValue)))
+                else:
+                    alternatives.append(currentValue)
+                currentValue = ''
+                isPrefix = False
+            else:
+                currentValue += char
+            position += 1
+
+        #A bare '*' matches every value
+        if any(isinstance(alternative, re.Pattern) and alternative.pattern == '^' for alternative in alternatives):
+            return None
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return {'$in': alternatives}
+
+    #Function builds the query for the user's lookup information, checked against the collection's lookup fields when they are known
+    #rowPredicates add conditions on the statistics of each block, blocks that fail them hold no matching rows
+    def buildRetrievalQuery(columnsToReconstructOn, metadata, rowPredicates):
+        queryDict = Storage.buildSegmentQuery(columnsToReconstructOn)
+
+        if metadata is not None:
+            lookupFields = metadata['lookupFields']
+            for field in queryDict:
+                if field not in lookupFields:
+                    sys.exit("Field: '" + field + "' is not one of the fields the collection was broken up on: " + str(lookupFields) + \
+                             ', program terminating')
+
+        #Conditions on the statistics of each block, checked by the store, the predicates themselves are checked on each row
+        statisticsQueries = [Statistics.buildStatisticsQuery(*rowPredicate) for rowPredicate in rowPredicates or []]
+        statisticsQueries = [statisticsQuery for statisticsQuery in statisticsQueries if statisticsQuery is not None]
+        if len(statisticsQueries) != 0:
+            queryDict['$and'] = statisticsQueries
+
+        return queryDict
+
+    #Function checks the query returned something, terminates if it did not, unless exitOnEmptyResult is unset,
+    #returns the segments, the first one included
+    def checkQueryResult(self, queryResult):
+        #Only the first segment is fetched, to see if the query returned anything
+        firstSegment = next(queryResult, None)
+
+        #Query returned nothing
+        if firstSegment is None:
+            if not self.exitOnEmptyResult:
+                return iter([])
+            sys.exit('Successfully queried input, 0 results, program terminating')
+        #Query returned something
+        else:
+            print('Successfully retrieved query results on:', self.collectionName + ', from ' + self.storeName + ':', self.databaseName)
+
+        return itertools.chain([firstSegment], queryResult)
+
+
+class LocalStore(Storage):
+    #Segments are kept in one file per collection, in a directory per database, under storePath, no server is needed
+    #The file is append only, each record holds a segment's compressed bytes, described by a line of JSON ahead of them
+    #An index footer, written at the end of every compression run, holds every segment's fields and where its bytes are
+    #The header at the start of the file points at the newest footer, it is the only part of the file ever written over
+    def __init__(self, storePath, databaseName, collectionName):
+        Storage.__init__(self, databaseName, collectionName)
+        self.storeName = 'local store'
+        self.fileName = os.path.join(storePath, databaseName, collectionName + LOCAL_STORE_EXTENSION)
+
+        self.index = None
+        self.segmentsByTag = None
+        self.indexEnd = LOCAL_STORE_HEADER.size
+        self.mappedFile = None
+
+    #Function drops the memory map when the object is pickled into a Pool worker, each process maps the file itself
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['mappedFile'] = None
+        return state
+
+    #Function checks a collection name can be used as a file name
+    def checkValidCollectionFileName(collectionName):
+        if os.sep in collectionName or (os.altsep is not None and os.altsep in collectionName):
+            sys.exit("Invalid char: '" + os.sep + "' in collection name, program terminating")
+
+    #Function turns bytes and ids into something JSON can hold, bytes are base64 encoded
+    def encodeJsonValue(value):
+        if isinstance(value, bytes):
+            return {'$binary': base64.b64encode(value).decode("ascii")}
+        #'_id' is an ObjectId, kept as its hex string
+        return str(value)
+
+    #Function turns base64 encoded bytes back into bytes, when JSON is loaded
+    def decodeJsonValue(jsonObject):
+        if len(jsonObject) == 1 and '$binary' in jsonObject:
+            return base64.b64decode(jsonObject['$binary'])
+        return jsonObject
+
+    #Function loads the index footer, once, the collection's metadata and every segment's fields
+    #A collection with no file yet, or no footer yet, has no metadata and no segments
+    #The index is only set once it is whole, the service's request threads share one store object and can load it at once
+    def loadIndex(self):
+        if self.index is not None:
+            return self.index
+
+        index = {'metadata': None, 'segments': []}
+        if os.path.isfile(self.fileName):
+            with open(self.fileName, 'rb') as openFile:
+                footerOffset, footerLength = LocalStore.readHeader(openFile, self.fileName)
+                if footerLength != 0:
+                    openFile.seek(footerOffset)
+                    index = json.loads(openFile.read(footerLength), object_hook = LocalStore.decodeJsonValue)
+                    self.indexEnd = footerOffset + footerLength
+
+        self.segmentsByTag = LocalStore.groupSegmentsByTag(index)
+        self.index = index
+        return self.index
+
+    #Function reads the header of a local store file, returns the offset and length of its footer
+    def readHeader(openFile, fileName):
+        openFile.seek(0)
+        magic, footerOffset, footerLength = LOCAL_STORE_HEADER.unpack(openFile.read(LOCAL_STORE_HEADER.size).ljust(LOCAL_STORE_HEADER.size, b'\0'))
+        if magic != LOCAL_STORE_MAGIC:
+            sys.exit("File '" + fileName + "' is not a local store file, program terminating")
+        return footerOffset, footerLength
+
+    #Function groups the segments of the index by tag, each tag's blocks in order, so looking up a tag is one probe
+    def indexSegments(self):
+        self.segmentsByTag = LocalStore.groupSegmentsByTag(self.index)
+
+    #Function returns the segments of an index grouped by tag, each tag's blocks in order
+    def groupSegmentsByTag(index):
+        segmentsByTag = {}
+        metadata = index['metadata']
+        if metadata is None:
+            return segmentsByTag
+
+        for segment in index['segments']:
+            tagKey = tuple(segment.get(field) for field in metadata['lookupFields'])
+            segmentsByTag.setdefault(tagKey, []).append(segment)
+        for segments in segmentsByTag.values():
+            segments.sort(key = lambda segment: segment.get('blockNumber', 0))
+        return segmentsByTag
+
+    #Function returns the collection's metadata, None if the collection has never been written
+    def readCollectionMetadata(self):
+        return self.loadIndex()['metadata']
+
+    #Function returns True if the collection holds any segments
+    def hasSegments(self):
+        return len(self.loadIndex()['segments']) != 0
+
+    #Function counts one more ingest run into the collection's metadata, returns the run's number
+    #Written with the footer, at the end of the run, only one compression run can write to a local store at a time
+    def startIngestRun(self):
+        metadata = self.readCollectionMetadata()
+        metadata['ingestRuns'] = metadata.get('ingestRuns', 0) + 1
+        return metadata['ingestRuns']
+
+    #Function returns the last block of a segment numbered before a block number, None if the segment has no such block
+    def findLastBlock(self, lookupFields, tag, beforeBlockNumber):
+        self.loadIndex()
+        earlierBlocks = [segment for segment in self.segmentsByTag.get(tuple(tag), []) if segment.get('blockNumber', 0) < beforeBlockNumber]
+        if len(earlierBlocks) == 0:
+            return None
+        return self.readSegment(earlierBlocks[-1], None)
+
+    #Function reads the content hash of every block in the collection, from the index, no compressed bytes are read
+    #Returns a dictionary, the tag and block number are the key, the value lists the hash and '_id' of each document with them
+    def readBlockHashes(self, lookupFields):
+        existingBlocks = {}
+
+        for segment in self.loadIndex()['segments']:
+            blockKey = (tuple(segment.get(field) for field in lookupFields), segment.get('blockNumber', 0))
+            existingBlocks.setdefault(blockKey, []).append((segment.get('blockHash'), segment['_id']))
+
+        return existingBlocks
+
+    #Function deletes segment documents by '_id', a record listing them is appended, they leave the index with the next footer
+    #Their compressed bytes stay in the file, it is only ever appended to
+    def deleteSegments(self, documentIds):
+        if len(documentIds) != 0:
+            self.appendRecords([({'deleted': [str(documentId) for documentId in documentIds]}, b'')])
+
+    #Function readies the collection for writing, records the lookup fields, header row, statistics columns and dictionary
+    #in its metadata, which is written with the footer, at the end of the run
+    def prepareCollection(self, lookupFields, headerRow, statisticsColumns, dictionary, dictionaryId):
+        metadata = self.readCollectionMetadata()
+
+        #Every segment in a collection has to be looked up on the same fields
+        if metadata is not None and metadata['lookupFields'] != lookupFields:
+            sys.exit("Collection '" + self.collectionName + "' is already broken up on field/s: " + str(metadata['lookupFields']) + \
+                     ', program terminating')
+        if metadata is None:
+            metadata = self.index['metadata'] = {'_id': self.collectionName}
+
+        #Segments are kept in order of lookup fields and block number, the same order Mongo Db's index keeps them in
+        metadata.update({'lookupFields': lookupFields, 'headerRow': headerRow, 'indexKeys': lookupFields + ['blockNumber'], \
+                         'statisticsColumns': statisticsColumns})
+        #Dictionaries are kept by id, segments compressed earlier with another dictionary can still be decompressed
+        if dictionary is not None:
+            metadata.setdefault('dictionaries', {})[dictionaryId] = dictionary
+        self.indexSegments()
+
+    #Function appends segment documents to the file, from the process that compressed them
+    #Each document's compressed bytes are written as they are, its other fields as JSON, the header row is left out,
+    #it is already in the metadata
+    def writeToDatabase(self, documents):
+        records = []
+
+        for document in documents:
+            description = {field: value for field, value in document.items() if field not in LOCAL_PAYLOAD_FIELDS + ['columns', 'headerRow']}
+            payloads = []
+            payloadOffset = 0
+            #Compressed bytes are described by their offset from the end of the description, and their length
+            for field in LOCAL_PAYLOAD_FIELDS:
+                if field in document:
+                    description[field] = [payloadOffset, len(document[field])]
+                    payloads.append(document[field])
+                    payloadOffset += len(document[field])
+            if 'columns' in document:
+                description['columns'] = {}
+                for columnPosition, compressedColumn in document['columns'].items():
+                    description['columns'][columnPosition] = [payloadOffset, len(compressedColumn)]
+                    payloads.append(compressedColumn)
+                    payloadOffset += len(compressedColumn)
+            records.append((description, b''.join(payloads)))
+
+        self.appendRecords(records)
+
+    #Function appends records to the end of the file, in one write, holding a lock on the file
+    #Pool workers append at once, the lock keeps each batch's records together
+    def appendRecords(self, records):
+        recordBytes = []
+        for description, payload in records:
+            descriptionBytes = json.dumps(description, default = LocalStore.encodeJsonValue, separators = (',', ':')).encode("utf-8")
+            recordBytes.extend([LOCAL_RECORD_HEADER.pack(len(descriptionBytes), len(payload)), descriptionBytes, payload])
+
+        os.makedirs(os.path.dirname(self.fileName), exist_ok = True)
+        #Opened for every batch, a lock is held by an open file, so processes and threads each need their own
+        with open(self.fileName, 'ab') as openFile:
+            fcntl.flock(openFile, fcntl.LOCK_EX)
+            try:
+                #First write to a new file, the header comes first, pointing at no footer
+                #Size is read once the lock is held, the position from opening it is stale if another writer got the lock first
+                if os.fstat(openFile.fileno()).st_size == 0:
+                    openFile.write(LOCAL_STORE_HEADER.pack(LOCAL_STORE_MAGIC, 0, 0))
+                openFile.write(b''.join(recordBytes))
+                openFile.flush()
+            finally:
+                fcntl.flock(openFile, fcntl.LOCK_UN)
+
+    #Function finishes a compression run, reads the records appended since the last footer into the index, then writes a new footer
+    #and points the header at it, a run that never gets here leaves the previous footer, and so the collection, as it was
+    def closeStore(self):
+        self.loadIndex()
+        #Nothing was written and there is no metadata to record
+        if self.index['metadata'] is None and not os.path.isfile(self.fileName):
+            return
+        #Creates the file, with its header, if no segment was ever written to it
+        self.appendRecords([])
+
+        #Not opened for appending, the header at the start of the file is written over
+        with open(self.fileName, 'r+b') as openFile:
+            fcntl.flock(openFile, fcntl.LOCK_EX)
+            try:
+                self.readNewRecords(openFile)
+
+                footerBytes = json.dumps(self.index, default = LocalStore.encodeJsonValue, separators = (',', ':')).encode("utf-8")
+                footerOffset = openFile.seek(0, os.SEEK_END)
+                openFile.write(footerBytes)
+                openFile.flush()
+                os.fsync(openFile.fileno())
+                #Footer is on disk before the header points at it
+                openFile.seek(0)
+                openFile.write(LOCAL_STORE_HEADER.pack(LOCAL_STORE_MAGIC, footerOffset, len(footerBytes)))
+                openFile.flush()
+                os.fsync(openFile.fileno())
+            finally:
+                fcntl.flock(openFile, fcntl.LOCK_UN)
+
+        self.indexEnd = footerOffset + len(footerBytes)
+        self.indexSegments()
+        print('Wrote index of', len(self.index['segments']), 'segments to local store:', self.fileName)
+
+    #Function reads every record appended after the current footer, adds the segments to the index and removes deleted ones
+    #Offsets of compressed bytes are made relative to the start of the file
+    def readNewRecords(self, openFile):
+        newSegments = []
+        deletedIds = set()
+        fileSize = openFile.seek(0, os.SEEK_END)
+        recordOffset = self.indexEnd
+
+        while recordOffset + LOCAL_RECORD_HEADER.size <= fileSize:
+            openFile.seek(recordOffset)
+            recordHeader = openFile.read(LOCAL_RECORD_HEADER.size)
+            #A file header in the middle of the file, records after it cannot be found, so the index would silently lose them
+            if recordHeader.startswith(LOCAL_STORE_MAGIC):
+                sys.exit("Local store file '" + self.fileName + "' has a second file header at byte " + str(recordOffset) + \
+                         ', it is corrupt, program terminating')
+            descriptionLength, payloadLength = LOCAL_RECORD_HEADER.unpack(recordHeader)
+            payloadStart = recordOffset + LOCAL_RECORD_HEADER.size + descriptionLength
+            #A record cut short by a run that was stopped part way, nothing after it was written whole
+            if payloadStart + payloadLength > fileSize:
+                print('Ignoring', fileSize - recordOffset, 'bytes at the end of local store file', "'" + self.fileName + "',", \
+                      'left by a run that was stopped part way')
+                break
+            try:
+                description = json.loads(openFile.read(descriptionLength), object_hook = LocalStore.decodeJsonValue)
+            except ValueError:
+                description = None
+            if not isinstance(description, dict):
+                sys.exit("Local store file '" + self.fileName + "' has a record that cannot be read at byte " + str(recordOffset) + \
+                         ', it is corrupt, program terminating')
+            recordOffset = payloadStart + payloadLength
+
+            if 'deleted' in description:
+                deletedIds.update(description['deleted'])
+                continue
+            for field in LOCAL_PAYLOAD_FIELDS:
+                if field in description:
+                    description[field][0] += payloadStart
+            for location in description.get('columns', {}).values():
+                location[0] += payloadStart
+            newSegments.append(description)
+
+        segments = self.index['segments'] + newSegments
+        self.index['segments'] = [segment for segment in segments if segment['_id'] not in deletedIds]
+
+    #Function returns a segment document from its index entry, with its compressed bytes read from the memory mapped file
+    #fetchColumns are the positions of the only columns read from columnar segments, None reads every column
+    #With payloads False, only the lookup fields and LISTING_FIELDS are returned, nothing is read from the file
+    def readSegment(self, segment, fetchColumns, payloads = True):
+        if not payloads:
+            return {field: value for field, value in segment.items() if field in self.index['metadata']['lookupFields'] + LISTING_FIELDS}
+        if self.mappedFile is None:
+            with open(self.fileName, 'rb') as openFile:
+                self.mappedFile = mmap.mmap(openFile.fileno(), 0, access = mmap.ACCESS_READ)
+        document = dict(segment)
+
+        for field in LOCAL_PAYLOAD_FIELDS:
+            if field in document:
+                offset, length = document[field]
+                document[field] = self.mappedFile[offset:offset + length]
+        if 'columns' in document:
+            document['columns'] = {columnPosition: self.mappedFile[offset:offset + length] \
+                                   for columnPosition, (offset, length) in document['columns'].items() \
+                                   if fetchColumns is None or int(columnPosition) in fetchColumns}
+            #Missing values are written as empty, row lengths are not needed for a projection
+            if fetchColumns is not None:
+                document.pop('rowLengths', None)
+
+        return document
+
+    #Function returns the segments matching the lookup information, each segment's blocks in order
+    #When every lookup field is given one value, the segments come straight from the index, otherwise every segment is checked
+    #Only the compressed bytes of matching segments are read, one segment at a time, as they are decompressed
+    #batchSize is not needed, nothing is fetched over a network
+    def retrieveSegmentsFromDatabase(self, columnsToReconstructOn, batchSize = DEFAULT_CURSOR_BATCH_SIZE, metadata = None, fetchColumns = None, \
+                                     rowPredicates = None, payloads = True):
+        self.loadIndex()
+        if metadata is None:
+            sys.exit('Successfully queried input, 0 results, program terminating')
+        queryDict = Storage.buildRetrievalQuery(columnsToReconstructOn, metadata, rowPredicates)
+        lookupFields = metadata['lookupFields']
+
+        if all(isinstance(queryDict.get(field), str) for field in lookupFields):
+            candidateSegments = self.segmentsByTag.get(tuple(queryDict[field] for field in lookupFields), [])
+        else:
+            candidateSegments = sorted(self.index['segments'], key = lambda segment: tuple(segment.get(field, '') for field in metadata['indexKeys']))
+
+        matchingSegments = (segment for segment in candidateSegments if LocalStore.matchesQuery(segment, queryDict))
+        return self.checkQueryResult(self.readSegment(segment, fetchColumns, payloads) for segment in matchingSegments)
+
+    #Function returns segment documents by '_id', in any order, fetchColumns are the only columns read, None reads every column
+    def retrieveSegmentsByIds(self, documentIds, metadata, fetchColumns):
+        documentIds = set(documentIds)
+        return [self.readSegment(segment, fetchColumns) for segment in self.loadIndex()['segments'] if segment['_id'] in documentIds]
+
+    #Function returns True if a segment's fields match a query, built the same way as a Mongo Db query
+    #Handles what lookup and statistics queries use, values, regular expressions, '$in', '$exists', '$or', '$and' and comparisons
+    def matchesQuery(segment, queryDict):
+        for field, condition in queryDict.items():
+            if field == '$and':
+                if not all(LocalStore.matchesQuery(segment, subQuery) for subQuery in condition):
+                    return False
+            elif field == '$or':
+                if not any(LocalStore.matchesQuery(segment, subQuery) for subQuery in condition):
+                    return False
+            elif not LocalStore.matchesCondition(LocalStore.getFieldValue(segment, field), condition):
+                return False
+
+        return True
+
+    #Function returns the value of a field, nested fields are separated by '.', MISSING_VALUE if the segment does not have it
+    def getFieldValue(segment, field):
+        value = segment
+        for fieldName in field.split('.'):
+            if not isinstance(value, dict) or fieldName not in value:
+                return MISSING_VALUE
+            value = value[fieldName]
+        return value
+
+    #Function returns True if a value matches the condition on its field
+    #As in Mongo Db, strings only compare with strings, and numbers with numbers
+    def matchesCondition(value, condition):
+        if isinstance(condition, re.Pattern):
+            return isinstance(value, str) and condition.search(value) is not None
+        if not isinstance(condition, dict):
+            return value is not MISSING_VALUE and value == condition
+
+        for queryOperator, operand in condition.items():
+            if queryOperator == '$in':
+                matches = any(LocalStore.matchesCondition(value, alternative) for alternative in operand)
+            elif queryOperator == '$exists':
+                matches = (value is not MISSING_VALUE) == operand
+            elif isinstance(value, str) and isinstance(operand, str):
+                matches = QUERY_OPERATORS[queryOperator](value, operand)
+            else:
+                numericTypes = (int, float)
+                matches = isinstance(value, numericTypes) and isinstance(operand, numericTypes) and not isinstance(value, bool) and \
+                          QUERY_OPERATORS[queryOperator](value, operand)
+            if not matches:
+                return False
+
+        return True
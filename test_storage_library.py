@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+import time
+import threading
+import fcntl
+import tempfile
+import unittest
+import multiprocessing
+from storage_library import Storage, LocalStore, LOCAL_STORE_HEADER, LOCAL_STORE_MAGIC, LOCAL_RECORD_HEADER
+
+#Number of processes appending to a new local store file at once
+WRITER_COUNT = 4
+#Number of threads loading the index of one store object at once, and number of segments in the index, enough to take a while to load
+READER_COUNT = 8
+INDEX_SEGMENT_COUNT = 5000
+#Delay before each writer takes the file lock, so every writer has the file open before any of them writes to it
+LOCK_DELAY_SECONDS = 0.05
+
+#Function appends one segment, tagged tagValue, to a local store
+def appendSegment(storeObject, tagValue):
+    storeObject.writeToDatabase([Storage.buildSegmentDocument({'compressedObject': tagValue.encode("utf-8")}, (tagValue,), ['TAG'], \
+                                                              {'formatVersion': 2, 'blockNumber': 0, 'uncompressedSize': len(tagValue)})])
+
+#Function appends one segment from its own process, once every writer is ready, taking the file lock late
+def appendSegmentInWriter(storeObject, tagValue, writersReady):
+    originalFlock = fcntl.flock
+    def delayedFlock(openFile, operation):
+        if operation == fcntl.LOCK_EX:
+            time.sleep(LOCK_DELAY_SECONDS)
+        originalFlock(openFile, operation)
+    #Only patched in the writer's own process
+    fcntl.flock = delayedFlock
+
+    writersReady.wait()
+    appendSegment(storeObject, tagValue)
+
+class LocalStoreAppendTest(unittest.TestCase):
+    def setUp(self):
+        self.storeDirectory = tempfile.TemporaryDirectory()
+        self.storeObject = LocalStore(self.storeDirectory.name, 'db', 'collection')
+        self.storeObject.prepareCollection(['TAG'], b'TAG,VALUE\n', [], None, None)
+
+    def tearDown(self):
+        self.storeDirectory.cleanup()
+
+    #Every writer opens the new file before any of them has written its header, only one header may be written
+    def testConcurrentAppendsToNewFile(self):
+        forkContext = multiprocessing.get_context('fork')
+        writersReady = forkContext.Barrier(WRITER_COUNT)
+        writers = [forkContext.Process(target = appendSegmentInWriter, args = (self.storeObject, 'tag' + str(writerNumber), writersReady)) \
+                   for writerNumber in range(WRITER_COUNT)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+            self.assertEqual(writer.exitcode, 0)
+
+        with open(self.storeObject.fileName, 'rb') as openFile:
+            self.assertEqual(openFile.read().count(LOCAL_STORE_MAGIC), 1)
+        self.storeObject.closeStore()
+
+        readStore = LocalStore(self.storeDirectory.name, 'db', 'collection')
+        self.assertEqual(sorted(segment['TAG'] for segment in readStore.loadIndex()['segments']), \
+                         ['tag' + str(writerNumber) for writerNumber in range(WRITER_COUNT)])
+
+    #A second file header in the middle of the file is reported, not read as a record that ends the index
+    def testSecondHeaderIsReported(self):
+        appendSegment(self.storeObject, 'first')
+        with open(self.storeObject.fileName, 'ab') as openFile:
+            openFile.write(LOCAL_STORE_HEADER.pack(LOCAL_STORE_MAGIC, 0, 0))
+        appendSegment(self.storeObject, 'second')
+
+        with self.assertRaises(SystemExit):
+            self.storeObject.closeStore()
+
+    #A record whose description cannot be read is reported, not treated as the end of the records
+    def testUnreadableRecordIsReported(self):
+        self.storeObject.appendRecords([])
+        with open(self.storeObject.fileName, 'ab') as openFile:
+            openFile.write(LOCAL_RECORD_HEADER.pack(4, 0) + b'{{{{')
+        appendSegment(self.storeObject, 'after')
+
+        with self.assertRaises(SystemExit):
+            self.storeObject.closeStore()
+
+    #A query matching nothing terminates the command line program, the library API gets no segments back instead
+    def testEmptyQueryResult(self):
+        appendSegment(self.storeObject, 'first')
+        metadata = self.storeObject.readCollectionMetadata()
+
+        with self.assertRaises(SystemExit):
+            self.storeObject.retrieveSegmentsFromDatabase(['TAG=missing'], metadata = metadata)
+        self.storeObject.exitOnEmptyResult = False
+        self.assertEqual(list(self.storeObject.retrieveSegmentsFromDatabase(['TAG=missing'], metadata = metadata)), [])
+        self.storeObject.closeStore()
+
+class LocalStoreIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.storeDirectory = tempfile.TemporaryDirectory()
+        storeObject = LocalStore(self.storeDirectory.name, 'db', 'collection')
+        storeObject.prepareCollection(['TAG'], b'TAG,VALUE\n', [], None, None)
+        storeObject.writeToDatabase([Storage.buildSegmentDocument({'compressedObject': b'row'}, ('tag' + str(segmentNumber),), ['TAG'], \
+                                                                  {'formatVersion': 2, 'blockNumber': 0, 'uncompressedSize': 3}) \
+                                     for segmentNumber in range(INDEX_SEGMENT_COUNT)])
+        storeObject.closeStore()
+
+    def tearDown(self):
+        self.storeDirectory.cleanup()
+
+    #Threads sharing a store object, as the service's request threads do, never see an index that is not loaded yet
+    def testConcurrentIndexLoads(self):
+        storeObject = LocalStore(self.storeDirectory.name, 'db', 'collection')
+        readersReady = threading.Barrier(READER_COUNT)
+        segmentCounts = []
+        def loadIndex():
+            readersReady.wait()
+            index = storeObject.loadIndex()
+            segmentCounts.append(len(index['segments']) if index['metadata'] is not None else 0)
+
+        readers = [threading.Thread(target = loadIndex) for readerNumber in range(READER_COUNT)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(segmentCounts, [INDEX_SEGMENT_COUNT] * READER_COUNT)
+        self.assertEqual(len(storeObject.segmentsByTag), INDEX_SEGMENT_COUNT)
+
+if __name__ == '__main__':
+    unittest.main()